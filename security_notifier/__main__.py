@@ -1,20 +1,102 @@
-from security_notifier.config import Config
+import argparse
+import datetime
+import sys
+from typing import List, Optional, Text
+
+from security_notifier.alert_stream import AlertStreamSource
+from security_notifier.config import Config, use_site
 from security_notifier.imap import get_events
+from security_notifier.imap.detection_info import EventType
+from security_notifier.imap.idle import wait_for_new_mail
 from security_notifier.imap.poller import PollerManager
+from security_notifier.journal import EventState, JournalEntry, get_journal, replay_unfinished_events
 from security_notifier.log_helper import setup_logger
-from security_notifier.vision import multi_process_capture
-
+from security_notifier.vision.capture_pool import CaptureWorkerPool
 
-def main():
-    setup_logger(Config.LOG_LEVEL)
 
+def run(args: argparse.Namespace):
     # Get the initial config instance, so it's loaded when we need it later.
-    Config.instance()
+    cfg = Config.instance()
 
-    mail_poll_mgr = PollerManager(get_events, multi_process_capture)
+    # Alerts come from the emails, unless we can listen to the DVR directly - in which case the emails are only
+    # checked for anything the DVR's stream missed.
+    event_source, waiter = get_events, wait_for_new_mail
+    if cfg.get("alert_stream.enabled", False):
+        alert_stream = AlertStreamSource(backfill=get_events,
+                                         backfill_interval=cfg.get("alert_stream.backfill_interval", None))
+        event_source, waiter = alert_stream, alert_stream.wait
+
+    # The capture workers are started once, when polling starts, and reused for every batch of events.
+    mail_poll_mgr = PollerManager(event_source,
+                                  CaptureWorkerPool(),
+                                  waiter=waiter,
+                                  replay_source=replay_unfinished_events)
     mail_poll_mgr.start()
     mail_poll_mgr.join()
 
 
+def format_entry(entry: JournalEntry) -> Text:
+    event = entry.event
+    cameras = ",".join(str(c) for c in event.camera_ids)
+    line = f"{event.date_and_time:%Y-%m-%d %H:%M:%S}  {event.type.name:<15} cameras {cameras:<8} {entry.state.value}"
+    if entry.motion_score is not None:
+        line += f"  motion {entry.motion_score:.3f}"
+    if entry.labels is not None:
+        line += f"  found: {', '.join(entry.labels) or 'nothing'}"
+    return line
+
+
+def list_events(args: argparse.Namespace):
+    with use_site(args.site):
+        journal = get_journal()
+    if journal is None:
+        sys.exit("There's no event journal to search - see the `journal` section of the config.")
+
+    entries = journal.query(start=args.since,
+                            end=args.until,
+                            camera_id=args.camera,
+                            event_types=[EventType[t] for t in args.type] if args.type else None,
+                            states=[EventState(s) for s in args.state] if args.state else None,
+                            label=args.found,
+                            min_motion=args.min_motion,
+                            limit=args.limit)
+    for entry in entries:
+        print(format_entry(entry))
+
+
+def _parse_args(argv: Optional[List[Text]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="security_notifier")
+    parser.set_defaults(func=run)
+    commands = parser.add_subparsers(title="commands")
+
+    run_parser = commands.add_parser("run", help="Watch the inbox and capture footage for each alert (the default).")
+    run_parser.set_defaults(func=run)
+
+    events_parser = commands.add_parser("events", help="Search the event journal.")
+    events_parser.add_argument("--site", help="Search this site's journal, for a config with several `[sites]`.")
+    events_parser.add_argument("--since", type=datetime.datetime.fromisoformat,
+                               help="Only events at or after this time, e.g. 2022-01-15 or 2022-01-15T19:30.")
+    events_parser.add_argument("--until", type=datetime.datetime.fromisoformat,
+                               help="Only events before this time.")
+    events_parser.add_argument("--camera", type=int, help="Only events on this camera.")
+    events_parser.add_argument("--type", action="append", choices=[t.name for t in EventType],
+                               help="Only events of this type. Can be given more than once.")
+    events_parser.add_argument("--state", action="append", choices=[s.value for s in EventState],
+                               help="Only events in this state. Can be given more than once.")
+    events_parser.add_argument("--found", help="Only events where the object detector found this, e.g. person.")
+    events_parser.add_argument("--min-motion", type=float,
+                               help="Only events whose capture had at least this motion score (0 to 1).")
+    events_parser.add_argument("--limit", type=int, help="Show at most this many events.")
+    events_parser.set_defaults(func=list_events)
+
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[Text]] = None):
+    args = _parse_args(argv)
+    setup_logger(Config.LOG_LEVEL)
+    args.func(args)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,307 @@
+from __future__ import annotations
+
+import datetime
+import http.client
+import threading
+import time
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+from collections import deque
+from typing import BinaryIO, Callable, Deque, Dict, Iterator, List, Optional, Text
+
+from .config import Config, current_site
+from .imap.detection_info import DetectionInfo, EventType
+from .journal import get_journal
+from .log_helper import get_logger
+from .vision.login import get_dvr_password
+
+logger = get_logger(__name__)
+
+ALERT_STREAM_PATH = "/ISAPI/Event/notification/alertStream"
+
+# The ISAPI event types we capture for, and what the emails would have called them. Everything else (including the
+# `videoloss` heartbeats the DVR sends while nothing's happening) is ignored.
+ISAPI_EVENT_TYPES = {
+    "vmd": EventType.Motion,
+    "linedetection": EventType.LineCrossing,
+    "fielddetection": EventType.Intrusion,
+}
+
+
+def _strip_namespace(tag: Text) -> Text:
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_alert(body: bytes) -> Optional[DetectionInfo]:
+    """Turn an `EventNotificationAlert` into a detection. Returns None for anything we don't capture for: heartbeats,
+    events ending, event types we don't know, and the repeats the DVR sends every second while an event carries on
+    (their `activePostCount` is above 1)."""
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError as err:
+        logger.warning(f"Couldn't parse alert from the DVR: {err}")
+        return None
+
+    fields = {_strip_namespace(e.tag): (e.text or "").strip() for e in root}
+    event_type = ISAPI_EVENT_TYPES.get(fields.get("eventType", "").lower())
+    if event_type is None or fields.get("eventState", "active").lower() != "active":
+        return None
+
+    try:
+        if int(fields.get("activePostCount") or 1) > 1:
+            return None
+        channel = int(fields.get("channelID") or fields.get("dynChannelID") or "")
+        # The DVR's clock is what the emails (and the recordings) go by, so we keep its local time and drop the offset.
+        date_and_time = datetime.datetime.fromisoformat(fields.get("dateTime", "")).replace(tzinfo=None)
+    except ValueError as err:
+        logger.warning(f"Ignoring malformed {event_type.name} alert from the DVR: {err}")
+        return None
+
+    return DetectionInfo(event_type, [channel], date_and_time)
+
+
+def _boundary(content_type: Text) -> Text:
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.strip().partition("=")
+        if name.lower() == "boundary":
+            return value.strip('"')
+    raise ValueError(f"No boundary in {content_type}")
+
+
+def iter_parts(stream: BinaryIO, boundary: Text) -> Iterator[bytes]:
+    """The bodies of a `multipart/mixed` stream's parts, as each one arrives. Parts with a Content-Length are read in
+    one go; anything else runs up to the next boundary. Some DVRs leave the leading `--` off the boundary, so we accept
+    it either way."""
+    markers = {f"--{boundary}".encode(), boundary.encode()}
+    end_markers = {f"--{boundary}--".encode(), f"{boundary}--".encode()}
+
+    line = stream.readline()
+    while line:
+        marker = line.strip()
+        if marker in end_markers:
+            return
+        if marker not in markers:
+            line = stream.readline()
+            continue
+
+        headers = {}
+        while True:
+            line = stream.readline()
+            if not line or not line.strip():
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if "content-length" in headers:
+            body = stream.read(int(headers["content-length"]))
+            line = stream.readline()
+        else:
+            lines = []
+            line = stream.readline()
+            while line and line.strip() not in markers | end_markers:
+                lines.append(line)
+                line = stream.readline()
+            body = b"".join(lines)
+
+        if body.strip():
+            yield body.strip()
+
+
+class AlertStream:
+    """A connection to one DVR's alert stream, read on a thread of its own.
+
+    The DVR holds the request open and pushes an XML notification down it (as a part of a never-ending multipart
+    response) as soon as anything happens, so alerts arrive within milliseconds rather than an email round-trip. We
+    parse each one as it comes and queue it up for `drain`, and `wait` blocks until there's something to drain.
+
+    If the connection drops, or nothing at all (not even a heartbeat) arrives for `timeout` seconds, we reconnect,
+    backing off from `reconnect_delay` up to `max_reconnect_delay` seconds while it keeps failing. Anything that
+    happened while we were disconnected is missed: `connections` counts the connections made, so the caller can tell
+    when to go back to the email for them."""
+
+    def __init__(self,
+                 url: Text,
+                 username: Text,
+                 password: Text,
+                 timeout: float = 30,
+                 reconnect_delay: float = 1,
+                 max_reconnect_delay: float = 60):
+        self.url = url
+        self.timeout = timeout
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        # Hikvision wants digest auth, but some firmware will only do basic. urllib picks whichever is asked for.
+        passwords = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+        passwords.add_password(None, url, username, password)
+        self._opener = urllib.request.build_opener(urllib.request.HTTPDigestAuthHandler(passwords),
+                                                   urllib.request.HTTPBasicAuthHandler(passwords))
+
+        self.connections = 0
+        self._events: Deque[DetectionInfo] = deque()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        # Guards all of the above, and is notified whenever any of it changes.
+        self._changed = threading.Condition()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name=f"alert-stream-{self.url}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop reconnecting. A read that's under way carries on until the next alert or timeout, so we don't wait
+        for the thread."""
+        with self._changed:
+            self._stopping = True
+            self._thread = None
+            self._changed.notify_all()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for alerts to arrive. Returns False if none did within `timeout` seconds."""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._events or self._stopping, timeout) and bool(self._events)
+
+    def drain(self) -> List[DetectionInfo]:
+        """Everything that's arrived since we last looked, oldest first."""
+        with self._changed:
+            events = list(self._events)
+            self._events.clear()
+        return events
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while not self._stopping:
+            try:
+                with self._opener.open(self.url, timeout=self.timeout) as response:
+                    with self._changed:
+                        self.connections += 1
+                        self._changed.notify_all()
+                    logger.info(f"Connected to the DVR's alert stream at {self.url}")
+                    delay = self.reconnect_delay
+                    self._read(response)
+                logger.warning("The DVR closed its alert stream - reconnecting")
+            except (OSError, http.client.HTTPException, ValueError) as err:
+                # URLError and socket timeouts are OSErrors too.
+                logger.warning(f"Lost the DVR's alert stream ({err}) - reconnecting in {delay:.0f}s")
+
+            with self._changed:
+                self._changed.wait_for(lambda: self._stopping, delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _read(self, response):
+        boundary = _boundary(response.headers.get("Content-Type", ""))
+        for body in iter_parts(response, boundary):
+            if self._stopping:
+                return
+            event = parse_alert(body)
+            if event is None:
+                continue
+
+            logger.debug(f"Alert from the DVR: {event}")
+            with self._changed:
+                self._events.append(event)
+                self._changed.notify_all()
+
+    @staticmethod
+    def from_config() -> AlertStream:
+        cfg = Config.instance()
+        host = cfg.get("dvr.host")
+        url = f"{cfg.get('alert_stream.scheme', 'http')}://{host}:{cfg.get('alert_stream.port', 80)}" \
+              f"{cfg.get('alert_stream.path', ALERT_STREAM_PATH)}"
+        return AlertStream(url,
+                           cfg.get("dvr.username", "admin"),
+                           get_dvr_password(),
+                           timeout=cfg.get("alert_stream.timeout", 30),
+                           reconnect_delay=cfg.get("alert_stream.reconnect_delay", 1),
+                           max_reconnect_delay=cfg.get("alert_stream.max_reconnect_delay", 60))
+
+
+class AlertStreamSource:
+    """An event source for the poller that listens to the DVR directly, rather than waiting for it to email us.
+
+    Pass it as the `event_generator`, and its `wait` as the `waiter`: `wait` returns as soon as an alert arrives, and
+    the next call hands over everything that has. The stream (one per site, see `use_site`) is connected the first
+    time it's called, in the poller process.
+
+    Alerts only come down the stream while we're connected, so `backfill` (in practice `get_events`, to read the
+    emails) is run too: on the first call, after every reconnection, and every `backfill_interval` seconds if that's
+    set. The journal drops anything the two sources both report. If the emails and the stream disagree on an alert's
+    time by a second, it gets through twice, but the coalescer merges the two into one capture.
+
+    `wait` also returns as soon as a backfill is due, and never blocks for more than `max_wait` seconds, so the poller
+    notices a stop request promptly."""
+
+    def __init__(self,
+                 backfill: Optional[Callable[[], Iterator[List[DetectionInfo]]]] = None,
+                 backfill_interval: Optional[float] = None,
+                 max_wait: float = 1.0,
+                 stream_factory: Callable[[], AlertStream] = AlertStream.from_config):
+        self.backfill = backfill
+        self.backfill_interval = backfill_interval
+        self.max_wait = max_wait
+        self.stream_factory = stream_factory
+
+        self._streams: Dict[Optional[Text], AlertStream] = {}
+        # When each site was last backfilled, and how many connections its stream had made by then.
+        self._backfilled: Dict[Optional[Text], tuple] = {}
+
+    def __getstate__(self):
+        if self._streams:
+            raise RuntimeError("Can't send a connected alert stream to another process")
+        return self.__dict__.copy()
+
+    def stream(self) -> AlertStream:
+        """The current site's stream, connecting it if it isn't already."""
+        site = current_site()
+        if site not in self._streams:
+            stream = self.stream_factory()
+            self._streams[site] = stream
+            stream.start()
+        return self._streams[site]
+
+    def _backfill_due(self, stream: AlertStream) -> bool:
+        if self.backfill is None:
+            return False
+
+        last = self._backfilled.get(current_site())
+        if last is None:
+            return True
+        backfilled_at, connections = last
+        if stream.connections > max(connections, 1):
+            logger.info("Reconnected to the DVR's alert stream - checking the emails for anything we missed")
+            return True
+        return self.backfill_interval is not None and time.monotonic() - backfilled_at >= self.backfill_interval
+
+    def __call__(self) -> Iterator[List[DetectionInfo]]:
+        stream = self.stream()
+        events = stream.drain()
+        if events:
+            journal = get_journal()
+            if journal is not None:
+                events = journal.add(events)
+            if events:
+                yield events
+
+        if self._backfill_due(stream):
+            self._backfilled[current_site()] = (time.monotonic(), stream.connections)
+            yield from self.backfill()
+
+    def wait(self, timeout: float) -> bool:
+        """Returns True when there are alerts to hand over, or the emails are due a look: the poller only calls us when
+        it's told there's something to fetch, and the emails matter most while the stream is quiet."""
+        stream = self.stream()
+        if self._backfill_due(stream):
+            return True
+        return stream.wait(min(timeout, self.max_wait)) or self._backfill_due(stream)
+
+    def close(self):
+        for stream in self._streams.values():
+            stream.stop()
+        self._streams = {}
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
-from typing import Any, Text, Dict, Optional, Union
+from typing import Any, Text, Dict, Iterator, List, Optional, Union
 
 import toml
 
@@ -29,6 +31,28 @@ class InvalidNestedIndexException(Exception):
     pass
 
 
+# The site whose settings `Config.get` is reading, if any - see `use_site`.
+_active_site: ContextVar[Optional[Text]] = ContextVar("active_site", default=None)
+
+_MISSING = object()
+
+
+def current_site() -> Optional[Text]:
+    return _active_site.get()
+
+
+@contextmanager
+def use_site(site: Optional[Text]) -> Iterator[None]:
+    """Read config as `site` sees it until the block ends: any key under `sites.<site>` overrides the top-level one,
+    e.g. `sites.garage.dvr.host` for `dvr.host`. Each thread and asyncio task has its own active site, so several
+    sites can be served side by side in one process."""
+    token = _active_site.set(site)
+    try:
+        yield
+    finally:
+        _active_site.reset(token)
+
+
 class DefaultValue:
     """We need to be able to differentiate between the user passing None as a default config value, and the user not
     providing a default value (in which case we will error about missing keys)."""
@@ -55,18 +79,33 @@ class Config:
 
         keys = key.split(".")
 
-        try:
-            ptr = self._data
-            for i in keys:
-                if not isinstance(ptr, dict):
-                    raise InvalidNestedIndexException(f"Trying to get field {i} from config item that is not a dict.")
-                ptr = ptr[i]
-
-            return ptr
-        except KeyError as err:
-            if not isinstance(default_val, DefaultValue):
-                return default_val
-            raise MissingConfigEntryException(f"Couldn't find key {key} in config.")
+        site = current_site()
+        if site is not None:
+            value = self._lookup(["sites", site] + keys)
+            if value is not _MISSING:
+                return value
+
+        value = self._lookup(keys)
+        if value is not _MISSING:
+            return value
+        if not isinstance(default_val, DefaultValue):
+            return default_val
+        raise MissingConfigEntryException(f"Couldn't find key {key} in config.")
+
+    def _lookup(self, keys: List[Text]) -> Any:
+        ptr = self._data
+        for i in keys:
+            if not isinstance(ptr, dict):
+                raise InvalidNestedIndexException(f"Trying to get field {i} from config item that is not a dict.")
+            if i not in ptr:
+                return _MISSING
+            ptr = ptr[i]
+        return ptr
+
+    def sites(self) -> List[Text]:
+        """The names of the sites under `[sites]`, if there are any."""
+        sites = self._lookup(["sites"])
+        return list(sites) if isinstance(sites, dict) else []
 
     def set(self, key: Text, value: Any, force: bool = False):
         if self._data is None:
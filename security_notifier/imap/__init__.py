@@ -1,56 +1,136 @@
-from typing import List
+from typing import Dict, List, Optional, Iterator, Tuple, Union
 
-import imap_tools.message
-from imap_tools import A
+from imap_tools import A, U, MailBox, MailMessage
 
 from .detection_info import DetectionInfo
+from .fetch import AlertMessage, fetch_alert_texts, fetch_full_messages
 from .login import (
     get_imap_password,
     set_imap_password,
     imap_password_is_set, get_mailbox
 )
-from .message_parser import parse_message
-from .utils import _full_mailbox_name, move_processed_messages
-from ..config import Config
+from .message_parser import parse_message, parse_messages, parse_message_batches
+from .session import MailboxSession, get_session, close_session
+from .state import MailboxState, load_state, save_state
+from .utils import _full_mailbox_name, batched, move_processed_messages
+from ..config import Config, current_site
+from .. import journal as event_journal
 from ..log_helper import get_logger
 
 logger = get_logger(__name__)
 
 
-def _fetch_cctv_alerts() -> List[imap_tools.message.MailMessage]:
-    """Fetch messages from the IMAP server. Filter them based on the sender, subject and seen-status; based on the
-    parameters in the application config.
+# Each site has its own mailbox, and so its own place in it.
+_states: Dict[Optional[str], MailboxState] = {}
 
-    We explicitly convert to a list here to allow us to release the mailbox connection and retain the data on-host.
-    Memory cost should be relatively small."""
+
+def _get_state() -> MailboxState:
+    site = current_site()
+    if site not in _states:
+        _states[site] = load_state()
+    return _states[site]
+
+
+def _search_cctv_alerts(mailbox: MailBox, state: MailboxState) -> List[str]:
+    """Search the IMAP server for alert messages. Filter them based on the sender, subject and seen-status; based on
+    the parameters in the application config.
+
+    If we have a high-water mark for the current UIDVALIDITY, only messages above it are searched for. Otherwise we
+    fall back to searching the whole inbox."""
+    cfg = Config.instance()
+
+    filters = {
+        "from_": cfg.get("cctv_alerts.email_sender"),
+        "subject": cfg.get("cctv_alerts.email_subject_filter")
+    }
+
+    if cfg.get("imap.unseen_only", default_val=False):
+        filters["seen"] = False
+
+    if state.last_uid > 0:
+        filters["uid"] = U(state.last_uid + 1, "*")
+
+    # `n:*` always matches the newest message, even when its UID is below n, so filter that out here.
+    return [uid for uid in mailbox.uids(A(**filters)) if int(uid) > state.last_uid]
+
+
+def _fetch_cctv_alerts(mailbox: MailBox, uids: List[str]) -> Iterator[Union[AlertMessage, MailMessage]]:
+    """Stream the alert messages down in batches of `imap.fetch_batch_size`. By default only the plain-text body of
+    each message is fetched (see `fetch_alert_texts`); set `imap.lean_fetch` to false to download messages in full."""
     cfg = Config.instance()
+    bulk_size = cfg.get("imap.fetch_batch_size", 50)
+
+    if cfg.get("imap.lean_fetch", True):
+        return fetch_alert_texts(mailbox, uids, bulk_size)
+    return fetch_full_messages(mailbox, uids, bulk_size)
 
-    with get_mailbox() as mailbox:
-        filters = {
-            "from_": cfg.get("cctv_alerts.email_sender"),
-            "subject": cfg.get("cctv_alerts.email_subject_filter")
-        }
 
-        if cfg.get("imap.unseen_only", default_val=False):
-            filters["seen"] = False
+def _fetch_alert_texts(session: MailboxSession, uids: List[str]) -> Iterator[str]:
+    """The alerts' texts, fetched `imap.fetch_batch_size` at a time. Each batch goes through `session.run`, so a
+    connection that's dropped since the last one is reconnected, and the batch retried."""
+    bulk_size = Config.instance().get("imap.fetch_batch_size", 50)
+    for batch in batched(uids, bulk_size):
+        yield from session.run(lambda mailbox: [m.text for m in _fetch_cctv_alerts(mailbox, batch)])
 
-        messages = mailbox.fetch(A(**filters))
-        data = [msg for msg in messages]
-    return data
 
+def _search_new_alerts(mailbox: MailBox) -> Tuple[List[str], MailboxState]:
+    state = _get_state()
+    status = mailbox.folder.status("INBOX", ["UIDVALIDITY", "UIDNEXT"])
+    uidvalidity = status["UIDVALIDITY"]
+    if not state.is_valid_for(uidvalidity):
+        logger.info("No high-water mark for this mailbox - searching the whole inbox")
+        state = MailboxState(uidvalidity)
+
+    ids = _search_cctv_alerts(mailbox, state)
+    logger.info(f"Found {len(ids)} events since last pull")
+
+    # Every matching message below UIDNEXT has now been seen, so that's the least we'll have got up to once these
+    # messages have been dealt with.
+    new_state = MailboxState(uidvalidity, max([state.last_uid, status["UIDNEXT"] - 1] + [int(i) for i in ids]))
+    return ids, new_state
+
+
+def _finish_alerts(mailbox: MailBox, ids: List[str], new_state: MailboxState):
+    """Record how far we've got before moving anything, so a failed move can't cause the messages to be
+    re-processed."""
+    if new_state != _states.get(current_site()):
+        save_state(new_state)
+        _states[current_site()] = new_state
+
+    move_processed_messages(ids, mailbox)
+
+
+def get_events() -> Iterator[List[DetectionInfo]]:
+    """Fetch all new events from the inbox, over this process's long-lived IMAP session.
+
+    Detections are yielded in batches of `imap.parse_batch_size` as they're parsed, so that capture of the first events
+    in a large backlog can start before the rest have been parsed. Backlogs of at least `imap.parse_pool_threshold`
+    messages are parsed across `imap.parse_processes` processes.
+
+    Each batch is written to the event journal before it's yielded, and events the journal has already seen are
+    dropped. Only once every batch has been consumed do we advance the high-water mark and move the messages to the
+    processed folder, so a crash (or a dropped connection) part way through means the messages are fetched again
+    rather than lost."""
+    cfg = Config.instance()
+    session = get_session()
+    journal = event_journal.get_journal()
+
+    ids, new_state = session.run(_search_new_alerts)
 
-def get_events() -> List[DetectionInfo]:
-    """Fetch all new events from the inbox"""
-    messages = _fetch_cctv_alerts()
-    logger.info(f"Downloaded {len(messages)} events since last pull")
-    ids = [m.uid for m in messages]
+    processes = 1
+    if len(ids) >= cfg.get("imap.parse_pool_threshold", 1000):
+        processes = cfg.get("imap.parse_processes", 1)
 
-    detections: List[DetectionInfo] = []
+    # Messages are fetched as the parser asks for them, so the first batch is parsed (and yielded) as soon as it's
+    # downloaded rather than after the whole backlog. A parse pool would ask from a thread of its own, though, and only
+    # this one may use the connection, so then the backlog is downloaded first.
+    texts = _fetch_alert_texts(session, ids)
+    if processes > 1:
+        texts = list(texts)
+    for detections in parse_message_batches(texts, cfg.get("imap.parse_batch_size", 100), processes):
+        if journal is not None:
+            detections = journal.add(detections)
+        logger.debug(detections)
+        yield detections
 
-    for m in messages:
-        det = parse_message(m.text)
-        logger.debug(det)
-        if det is not None:
-            detections.append(det)
-    move_processed_messages(ids)
-    return detections
+    session.run(lambda mailbox: _finish_alerts(mailbox, ids, new_state))
@@ -1,7 +1,7 @@
 import enum
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 
 class EventType(enum.Enum):
@@ -16,3 +16,13 @@ class DetectionInfo:
     type: EventType
     camera_ids: List[int]
     date_and_time: datetime
+    # How many seconds of footage to capture. None means the configured `stream_capture.detection_clip_length`.
+    duration: Optional[float] = None
+    # If this is several alerts merged into one capture, the alerts it was made from.
+    sources: List["DetectionInfo"] = field(default_factory=list, compare=False, repr=False)
+
+    @property
+    def key(self) -> str:
+        """Identifies the event: the same alert always gets the same key, e.g. `20220115T193049_motion_1-2`."""
+        cameras = "-".join(str(c) for c in self.camera_ids)
+        return f"{self.date_and_time:%Y%m%dT%H%M%S}_{self.type.name.lower()}_{cameras}"
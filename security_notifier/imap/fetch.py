@@ -0,0 +1,132 @@
+import email
+import re
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Text
+
+import imap_tools.message
+from imap_tools import A, MailBox
+from imap_tools.errors import MailboxFetchError
+from imap_tools.utils import check_command_status
+
+from .utils import batched
+from ..log_helper import get_logger
+
+logger = get_logger(__name__)
+
+HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (CONTENT-TYPE CONTENT-TRANSFER-ENCODING)]"
+
+# The body fetches deliberately aren't PEEKs: like the full fetch they replace, they mark the alert as seen.
+SINGLE_PART_BODY = "BODY[TEXT]"
+FIRST_PART_BODY = "BODY[1.MIME] BODY[1]"
+
+_MESSAGE_START = re.compile(rb"^(\d+) \(")
+_UID = re.compile(rb"UID (\d+)")
+_SECTION = re.compile(rb"BODY\[([^\]]*)\](?:<\d+>)? \{\d+\}$")
+
+
+@dataclass
+class AlertMessage:
+    """The only parts of an alert email we actually use. Has the same `uid` and `text` attributes as the full
+    `imap_tools.MailMessage`, so the two can be used interchangeably."""
+    uid: Text
+    text: Text
+
+
+def _parse_fetch_response(data: list) -> Dict[Text, Dict[Text, bytes]]:
+    """Turn the raw imaplib FETCH response into {uid: {section: literal}}.
+
+    Each message starts with `<seq> (`, and every literal comes as a (prefix, literal) tuple whose prefix names the
+    section. Servers are free to put the UID before or after the literals, so we key everything by sequence number
+    until we've seen the whole response."""
+    by_seq: Dict[bytes, Dict] = {}
+    current: Optional[Dict] = None
+
+    for item in data:
+        if item is None:
+            continue
+        prefix = item[0] if isinstance(item, tuple) else item
+
+        start = _MESSAGE_START.match(prefix)
+        if start is not None:
+            current = by_seq.setdefault(start.group(1), {"uid": None, "sections": {}})
+        if current is None:
+            continue
+
+        uid = _UID.search(prefix)
+        if uid is not None:
+            current["uid"] = uid.group(1).decode()
+
+        if isinstance(item, tuple):
+            section = _SECTION.search(prefix)
+            if section is not None:
+                # `HEADER.FIELDS (...)` may be echoed back with different quoting, so key it by the first word only.
+                name = section.group(1).decode().split(" ")[0].upper()
+                current["sections"][name] = item[1]
+
+    return {m["uid"]: m["sections"] for m in by_seq.values() if m["uid"] is not None}
+
+
+def _uid_fetch(mailbox: MailBox, uids: List[Text], items: Text) -> Dict[Text, Dict[Text, bytes]]:
+    result = mailbox.client.uid("FETCH", ",".join(uids), f"(UID {items})")
+    check_command_status(result, MailboxFetchError)
+    return _parse_fetch_response(result[1])
+
+
+def _decode_text(headers: bytes, body: bytes) -> Optional[Text]:
+    """Decode a body part using its Content-Type / Content-Transfer-Encoding headers. Returns None if the part isn't
+    plain text."""
+    part = email.message_from_bytes(headers.rstrip(b"\r\n") + b"\r\n\r\n" + body)
+    if part.get_content_type() != "text/plain":
+        return None
+
+    payload = part.get_payload(decode=True) or b""
+    return payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+
+
+def _is_multipart(headers: bytes) -> bool:
+    return email.message_from_bytes(headers).get_content_maintype() == "multipart"
+
+
+def _fetch_batch(mailbox: MailBox, uids: List[Text]) -> Iterator[AlertMessage]:
+    top_headers = _uid_fetch(mailbox, uids, HEADER_FIELDS)
+
+    headers = {uid: sections.get("HEADER.FIELDS", b"") for uid, sections in top_headers.items()}
+    single = [u for u in uids if u in headers and not _is_multipart(headers[u])]
+    multi = [u for u in uids if u in headers and u not in single]
+
+    bodies: Dict[Text, Optional[Text]] = {}
+    if single:
+        for uid, sections in _uid_fetch(mailbox, single, SINGLE_PART_BODY).items():
+            bodies[uid] = _decode_text(headers[uid], sections.get("TEXT", b""))
+    if multi:
+        for uid, sections in _uid_fetch(mailbox, multi, FIRST_PART_BODY).items():
+            bodies[uid] = _decode_text(sections.get("1.MIME", b""), sections.get("1", b""))
+
+    # Anything we couldn't pick the text out of (HTML-only mail, nested multiparts, ...) gets a normal full fetch.
+    fallback = [u for u in uids if bodies.get(u) is None]
+    if fallback:
+        logger.debug(f"Falling back to full fetch for {len(fallback)} messages")
+        for msg in mailbox.fetch(A(uid=fallback)):
+            bodies[msg.uid] = msg.text
+
+    for uid in uids:
+        if bodies.get(uid) is not None:
+            yield AlertMessage(uid, bodies[uid])
+
+
+def fetch_alert_texts(mailbox: MailBox, uids: Iterable[Text], bulk_size: int = 50) -> Iterator[AlertMessage]:
+    """Stream the plain-text body of each message, without downloading headers or attachments.
+
+    Messages are fetched `bulk_size` at a time: one small FETCH for the content-type headers, then one for the body
+    text (the whole body for single-part mail, or just the first MIME part for multipart mail with snapshots
+    attached). Only one batch is held in memory at a time."""
+    for batch in batched(uids, bulk_size):
+        yield from _fetch_batch(mailbox, batch)
+
+
+def fetch_full_messages(mailbox: MailBox,
+                        uids: Iterable[Text],
+                        bulk_size: int = 50) -> Iterator[imap_tools.message.MailMessage]:
+    """Same as `fetch_alert_texts`, but downloading each message in full and letting imap_tools parse it."""
+    for batch in batched(uids, bulk_size):
+        yield from mailbox.fetch(A(uid=batch), bulk=True)
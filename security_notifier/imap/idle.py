@@ -0,0 +1,95 @@
+import threading
+import time
+from typing import List
+
+from imap_tools import MailBox
+
+from .session import get_session
+from ..config import Config
+from ..log_helper import get_logger
+
+logger = get_logger(__name__)
+
+# RFC 2177 asks clients to re-issue IDLE at least every 29 minutes, and imap_tools enforces it.
+MAX_IDLE_TIMEOUT = 29 * 60
+
+# How often an IDLE checks whether it's been asked to stop.
+IDLE_POLL_INTERVAL = 1.0
+
+_warned_no_idle = False
+
+# Set when the poller is stopping, to cut short a wait between polls.
+_stopping = threading.Event()
+
+
+def interrupt_waits():
+    """Wake anything waiting in `wait_for_new_mail` (within `IDLE_POLL_INTERVAL` seconds, for an IDLE), and stop it
+    waiting again."""
+    _stopping.set()
+
+
+def reset_waits():
+    _stopping.clear()
+
+
+def supports_idle(mailbox: MailBox) -> bool:
+    return "IDLE" in mailbox.client.capabilities
+
+
+def _has_new_messages(responses: List[bytes]) -> bool:
+    return any(r.rstrip().upper().endswith(b"EXISTS") for r in responses)
+
+
+def _pending_new_messages(mailbox: MailBox) -> bool:
+    """Whether the server told us about new mail while we were doing something else (a SEARCH or FETCH, say). imaplib
+    files those responses away rather than handing them to us, so they'd never be seen by an IDLE. We clear them, so
+    the same EXISTS doesn't wake us twice."""
+    return bool(mailbox.client.untagged_responses.pop("EXISTS", None))
+
+
+def _idle_until_new_mail(mailbox: MailBox) -> bool:
+    if _pending_new_messages(mailbox):
+        logger.debug("New mail arrived since we last looked - not waiting for more")
+        return True
+
+    timeout = min(Config.instance().get("imap.idle_timeout", 300), MAX_IDLE_TIMEOUT)
+    deadline = time.monotonic() + timeout
+    responses = []
+    # Rather than one long wait, we poll in short steps, so a stop request doesn't have to wait out the IDLE.
+    mailbox.idle.start()
+    try:
+        while not _stopping.is_set() and not _has_new_messages(responses):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            responses += mailbox.idle.poll(timeout=min(IDLE_POLL_INTERVAL, remaining))
+    finally:
+        mailbox.idle.stop()
+
+    if responses:
+        logger.debug(f"IDLE responses: {responses}")
+    return _has_new_messages(responses)
+
+
+def wait_for_new_mail(polling_freq: float) -> bool:
+    """Block until there might be new alerts to fetch. Returns False if we woke up without anything new arriving.
+
+    With `imap.idle` enabled (the default) and a server that supports it, this parks the session in IMAP IDLE so the
+    server pushes a notification as soon as a message lands. The IDLE is re-issued every `imap.idle_timeout` seconds,
+    and ends early on `interrupt_waits`. Otherwise we fall back to sleeping for `polling_freq` seconds (or until
+    `interrupt_waits`) and always report that there may be new mail."""
+    global _warned_no_idle
+
+    if not Config.instance().get("imap.idle", True):
+        _stopping.wait(polling_freq)
+        return True
+
+    session = get_session()
+    if not supports_idle(session.mailbox()):
+        if not _warned_no_idle:
+            logger.warning("IMAP server doesn't support IDLE - falling back to polling.")
+            _warned_no_idle = True
+        _stopping.wait(polling_freq)
+        return True
+
+    return session.run(_idle_until_new_mail)
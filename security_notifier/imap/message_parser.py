@@ -1,11 +1,14 @@
 import datetime
+import multiprocessing
 import re
-from typing import Text, List, Optional
+from collections import Counter
+from typing import Callable, Iterable, Iterator, Text, List, Optional, Tuple, Union
 
 from .detection_info import (
     DetectionInfo,
     EventType
 )
+from .utils import batched
 from ..log_helper import get_logger
 
 logger = get_logger(__name__)
@@ -15,54 +18,130 @@ class MessageParseFailure(Exception):
     pass
 
 
-def _get_event_type(message_text: Text) -> EventType:
-    match = re.search(r"EVENT TYPE:\s+([\w ]+)", message_text)
-    if match is None:
-        raise MessageParseFailure("Could not extract the event type from the email.")
+# One pattern for all the fields we care about, so the body is only scanned once. Each alternative matches the same
+# text the old per-field searches did.
+_FIELDS = re.compile(
+    r"EVENT T(?:YPE:\s+(?P<type>[\w ]+)|IME:\s+(?P<time>\d{4}-\d{2}-\d{2},\d{2}:\d{2}:\d{2}))"
+    r"|CAMERA NAME\(NUM\):\s+(?P<cameras>.+)"
+)
+_CAMERA_ID = re.compile(r"Camera (\d\d)")
 
-    raw_event_type = match.group(1)
-    try:
-        return EventType(raw_event_type)
-    except ValueError:
+_EVENT_TYPES = {e.value: e for e in EventType}
+
+_NO_EVENT_TYPE = "Could not extract the event type from the email."
+_NO_CAMERA_IDS = "Could not extract the camera IDs from the email."
+_NO_DATE_TIME = "Could not extract the event date/time from the email."
+
+
+def _get_event_type(raw_event_type: Text) -> EventType:
+    event_type = _EVENT_TYPES.get(raw_event_type)
+    if event_type is None:
         logger.warning(f"Could not determine the event type '{raw_event_type}'")
         return EventType.Misc
+    return event_type
+
 
+def _get_camera_ids(camera_ids_text: Text) -> List[int]:
+    return [int(m) for m in _CAMERA_ID.findall(camera_ids_text)]
 
-def _get_camera_ids(message_text: Text) -> List[int]:
-    match = re.search(r"CAMERA NAME\(NUM\):\s+(.+)", message_text)
-    if match is None:
-        raise MessageParseFailure("Could not extract the camera IDs from the email.")
 
-    camera_ids_text = match.group(1)
-    matches = re.findall(r"Camera (\d\d)", camera_ids_text)
-    if not matches:
-        raise MessageParseFailure("Could not extract the camera IDs from the email.")
+def _get_date_time(date_time_text: Text) -> Optional[datetime.datetime]:
+    """The DVR always uses `YYYY-mm-dd,HH:MM:SS`, and the pattern has already checked the digits are where we expect,
+    so we can slice the fields out rather than going through `strptime`."""
+    s = date_time_text
+    try:
+        return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+    except ValueError:
+        return None
 
-    return [int(m) for m in matches]
 
+def _parse(message_text: Text) -> Union[DetectionInfo, Text]:
+    """Parse the message, returning either the detection or a description of why it couldn't be parsed. Malformed
+    emails are common enough that we don't want to pay for raising an exception for each one."""
+    fields = {}
+    for match in _FIELDS.finditer(message_text):
+        # Like `re.search`, the first occurrence of each field wins.
+        name = match.lastgroup
+        if name not in fields:
+            fields[name] = match.group(name)
+            if len(fields) == 3:
+                break
 
-def _get_date_time(message_text: Text) -> datetime.datetime:
-    match = re.search(r"EVENT TIME:\s+(\d{4}-\d{2}-\d{2},\d{2}:\d{2}:\d{2})", message_text)
-    if match is None:
-        raise MessageParseFailure("Could not extract the event date/time from the email.")
+    if "type" not in fields:
+        return _NO_EVENT_TYPE
 
-    return datetime.datetime.strptime(match.group(1), "%Y-%m-%d,%H:%M:%S")
+    camera_ids = _get_camera_ids(fields["cameras"]) if "cameras" in fields else None
+    if not camera_ids:
+        return _NO_CAMERA_IDS
 
+    date_time = _get_date_time(fields["time"]) if "time" in fields else None
+    if date_time is None:
+        return _NO_DATE_TIME
 
-def parse_message(message_text: Text) -> Optional[DetectionInfo]:
-    try:
-        event_type = _get_event_type(message_text)
-        camera_ids = _get_camera_ids(message_text)
-        date_time = _get_date_time(message_text)
-
-        return DetectionInfo(
-            event_type,
-            camera_ids,
-            date_time
-        )
-    except MessageParseFailure as err:
-        logger.warning(str(err))
-        return None
+    return DetectionInfo(
+        _get_event_type(fields["type"]),
+        camera_ids,
+        date_time
+    )
 
 
-__all__ = ['parse_message', 'MessageParseFailure']
+def parse_message(message_text: Text) -> Optional[DetectionInfo]:
+    result = _parse(message_text)
+    if isinstance(result, DetectionInfo):
+        return result
+
+    logger.warning(result)
+    return None
+
+
+def _parse_batch(message_texts: List[Text]) -> Tuple[List[DetectionInfo], List[Text]]:
+    detections, failures = [], []
+    for text in message_texts:
+        result = _parse(text)
+        if isinstance(result, DetectionInfo):
+            detections.append(result)
+        else:
+            failures.append(result)
+    return detections, failures
+
+
+def parse_message_batches(message_texts: Iterable[Text],
+                          batch_size: int = 100,
+                          processes: int = 1,
+                          on_failures: Optional[Callable[[int, List[Text]], None]] = None
+                          ) -> Iterator[List[DetectionInfo]]:
+    """Parse messages `batch_size` at a time, yielding each batch's detections as soon as it's done. Messages are
+    pulled from `message_texts` lazily, so it can itself be a stream.
+
+    Parse failures are logged once per batch rather than once per message; pass `on_failures` to be given the batch
+    index and the reasons as well. With `processes` > 1, batches are parsed in a process pool, which is only worth it
+    for large backlogs - for a normal poll, the cost of starting the pool far outweighs the parsing."""
+    batches = batched(message_texts, batch_size)
+
+    def report(results: Iterable[Tuple[List[DetectionInfo], List[Text]]]) -> Iterator[List[DetectionInfo]]:
+        for idx, (detections, failures) in enumerate(results):
+            if failures:
+                reasons = ", ".join(f"{r} (x{n})" for r, n in Counter(failures).items())
+                logger.warning(f"Failed to parse {len(failures)} of {len(detections) + len(failures)} messages in "
+                               f"batch {idx}: {reasons}")
+                if on_failures is not None:
+                    on_failures(idx, failures)
+            yield detections
+
+    if processes > 1:
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            yield from report(pool.imap(_parse_batch, batches))
+    else:
+        yield from report(map(_parse_batch, batches))
+
+
+def parse_messages(message_texts: Iterable[Text],
+                   batch_size: int = 100,
+                   processes: int = 1,
+                   on_failures: Optional[Callable[[int, List[Text]], None]] = None) -> Iterator[DetectionInfo]:
+    """Stream detections from many messages at once. See `parse_message_batches` for the arguments."""
+    for detections in parse_message_batches(message_texts, batch_size, processes, on_failures):
+        yield from detections
+
+
+__all__ = ['parse_message', 'parse_messages', 'parse_message_batches', 'MessageParseFailure']
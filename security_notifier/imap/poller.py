@@ -1,13 +1,23 @@
 import asyncio
+import contextvars
 import datetime
+import functools
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from multiprocessing import Process
 from multiprocessing import Value
-from typing import Optional, Iterable, Callable
+from typing import Optional, Iterable, Iterator, Callable, List, Text, Union
 
-from security_notifier.config import Config
-from security_notifier.imap import get_events
+from security_notifier.config import Config, use_site
+from security_notifier.imap import get_events, close_session
 from security_notifier.imap.detection_info import DetectionInfo, EventType
+from security_notifier.imap.idle import interrupt_waits, reset_waits
+from security_notifier.journal import close_journal
+from security_notifier.log_helper import get_logger
+
+logger = get_logger(__name__)
 
 
 def _generate_event_list():
@@ -28,62 +38,231 @@ def print_handler(events: Iterable[DetectionInfo]):
     print(e for e in events)
 
 
+@dataclass
+class PollerMetrics:
+    fetches: int = 0
+    events_fetched: int = 0
+    batches_handled: int = 0
+    # How long the last fetch took, from asking the server to having queued the last batch.
+    last_fetch_seconds: float = 0.0
+
+
+class SitePoller:
+    """Fetches one site's events and hands them to the handler.
+
+    Fetching and handling run side by side, and neither blocks the event loop: everything that talks to the site's
+    IMAP server runs on one worker thread (the session isn't thread-safe, and only one thing should be using it at a
+    time anyway), and the handler on another. A long batch of captures never holds up the next look at the inbox, and
+    a slow site never holds up another site's.
+
+    Everything runs with `site` as the active site (see `use_site`), so the generator, waiter and handler see that
+    site's config, IMAP session and journal. With `site` None, that's just the top-level config."""
+
+    def __init__(self,
+                 site: Optional[Text],
+                 polling_freq: int,
+                 event_generator: Callable = get_events,
+                 event_handler: Callable = print_handler,
+                 waiter: Optional[Callable[[int], bool]] = None,
+                 replay_source: Optional[Callable[[], List[DetectionInfo]]] = None):
+        self.site = site
+        self.polling_freq = polling_freq
+        self.event_generator = event_generator
+        self.event_handler = event_handler
+        self.waiter = waiter
+        self.replay_source = replay_source
+        self.metrics = PollerMetrics()
+
+        self.detection_queue: Optional[asyncio.Queue] = None
+        self._fetch_executor: Optional[ThreadPoolExecutor] = None
+        self._handler_executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def name(self) -> Text:
+        return self.site or "default"
+
+    async def _run_in(self, executor: ThreadPoolExecutor, func: Callable, *args):
+        # Executor threads don't inherit the task's context, so the active site has to be carried over.
+        call = functools.partial(contextvars.copy_context().run, func, *args)
+        return await asyncio.get_running_loop().run_in_executor(executor, call)
+
+    async def _fetch(self, func: Callable, *args):
+        return await self._run_in(self._fetch_executor, func, *args)
+
+    async def wait_for_events(self, running_flag: Value) -> bool:
+        """Wait until the next fetch is due. Without a waiter that's just the polling period; with one (e.g. IMAP
+        IDLE), the waiter blocks on the IMAP thread until it's told something has arrived."""
+        if self.waiter is None:
+            await asyncio.sleep(self.polling_freq)
+            return True
+
+        return await self._fetch(self.waiter, self.polling_freq)
+
+    async def queue_events(self, queue, events: Union[List[DetectionInfo], Iterator[List[DetectionInfo]]]):
+        """Event generators can either return a list of events, or yield them in batches. Batches are queued as they
+        come, so the handler can get started on the first before the rest are ready. Producing each batch can mean
+        talking to the server, so that happens on the IMAP thread."""
+        if isinstance(events, list):
+            self.metrics.events_fetched += len(events)
+            await queue.put(events)
+            return
+
+        batches = iter(events)
+        while True:
+            batch = await self._fetch(next, batches, None)
+            if batch is None:
+                return
+            self.metrics.events_fetched += len(batch)
+            await queue.put(batch)
+
+    async def get_events(self, queue, running_flag: Value):
+        # Anything left unfinished last time goes ahead of new events.
+        if self.replay_source is not None:
+            await self.queue_events(queue, await self._fetch(self.replay_source))
+
+        fetch = True
+        while bool(running_flag.value):
+            if fetch:
+                started = time.monotonic()
+                await self.queue_events(queue, await self._fetch(self.event_generator))
+                self.metrics.fetches += 1
+                self.metrics.last_fetch_seconds = time.monotonic() - started
+            fetch = await self.wait_for_events(running_flag)
+
+    async def handle_event(self, queue):
+        while True:
+            events = await queue.get()
+            try:
+                await self._run_in(self._handler_executor, self.event_handler, events)
+                self.metrics.batches_handled += 1
+            finally:
+                queue.task_done()
+
+    async def run(self, running_flag: Value):
+        """Poll until cancelled. A batch that's already been passed to the handler is seen through, and so is anything
+        already under way on the IMAP thread, so nobody closes the session under it."""
+        self.detection_queue = self.detection_queue or asyncio.Queue()
+        self._fetch_executor = ThreadPoolExecutor(1, thread_name_prefix=f"imap-{self.name}")
+        self._handler_executor = ThreadPoolExecutor(1, thread_name_prefix=f"event-handler-{self.name}")
+        try:
+            with use_site(self.site):
+                await asyncio.gather(
+                    self.get_events(self.detection_queue, running_flag),
+                    self.handle_event(self.detection_queue)
+                )
+        finally:
+            # Waiting for the threads happens off the event loop, so the other sites can shut down alongside this one.
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._handler_executor.shutdown)
+            await loop.run_in_executor(None, functools.partial(self._fetch_executor.shutdown, cancel_futures=True))
+            logger.info(f"Stopped polling site {self.name}: {self.metrics}")
+
+
 class EmailPoller(Process):
+    """Runs a `SitePoller` for each of `sites` (or just the one, for the top-level config, if there are none), side by
+    side in one process and sharing one event handler.
+
+    Clearing `running_flag` stops it within `stop_check_interval` seconds, give or take the batches the handler is
+    working on. A wait between polls, or an IMAP IDLE, is cut short (the IDLE within a second or so)."""
+
     def __init__(self,
                  running_flag: Value,
                  polling_freq: int,
                  event_generator: Callable = get_events,
-                 event_handler: Callable = print_handler):
+                 event_handler: Callable = print_handler,
+                 waiter: Optional[Callable[[int], bool]] = None,
+                 replay_source: Optional[Callable[[], List[DetectionInfo]]] = None,
+                 stop_check_interval: float = 0.1,
+                 sites: Optional[List[Text]] = None):
         super().__init__()
-        self.detection_queue: asyncio.Queue = asyncio.Queue()
-        self.polling_freq: int = polling_freq
         self._running_flag: Value = running_flag
+        self.stop_check_interval = stop_check_interval
         self.tasks: Optional[asyncio.futures.Future] = None
-
         self.event_generator = event_generator
         self.event_handler = event_handler
 
-    async def get_events(self, queue):
-        while bool(self._running_flag.value):
-            events = self.event_generator()
-            await queue.put(events)
-            await asyncio.sleep(self.polling_freq)
+        self.pollers = []
+        for site in sites or [None]:
+            # Each site can poll at its own pace, with `sites.<name>.imap.polling_frequency`.
+            with use_site(site):
+                site_freq = polling_freq if site is None else Config.instance().get("imap.polling_frequency",
+                                                                                    polling_freq)
+            self.pollers.append(SitePoller(site, site_freq, event_generator, event_handler, waiter, replay_source))
 
-    async def handle_event(self, queue):
+    @property
+    def metrics(self) -> dict:
+        """Each site's polling metrics, by site name."""
+        return {p.name: p.metrics for p in self.pollers}
+
+    async def wait_for_stop(self):
         while bool(self._running_flag.value):
-            if queue.empty():
-                await asyncio.sleep(0.5)
-                continue
-            events = await queue.get()
-            self.event_handler(events)
-        queue.task_done()
+            await asyncio.sleep(self.stop_check_interval)
 
     async def run_tasks(self):
-        self.tasks = asyncio.gather(
-            self.get_events(self.detection_queue),
-            self.handle_event(self.detection_queue)
-        )
-        await self.tasks
+        reset_waits()
+        self.tasks = asyncio.gather(*(p.run(self._running_flag) for p in self.pollers))
+        stop = asyncio.ensure_future(self.wait_for_stop())
+        try:
+            await asyncio.wait([self.tasks, stop], return_when=asyncio.FIRST_COMPLETED)
+            if self.tasks.done():
+                # Something went wrong - a clean stop never gets here before the flag is cleared.
+                self.tasks.result()
+        finally:
+            # A waiter sleeping between polls would otherwise hold up the IMAP threads' shutdown.
+            interrupt_waits()
+            stop.cancel()
+            self.tasks.cancel()
+            await asyncio.gather(self.tasks, stop, return_exceptions=True)
 
     def run(self):
-        asyncio.run(self.run_tasks())
+        # Handlers with their own resources (like the capture worker pool) are started here, in the poller process,
+        # so their processes and threads belong to the process that uses them.
+        if hasattr(self.event_handler, "start"):
+            self.event_handler.start()
+
+        try:
+            asyncio.run(self.run_tasks())
+        finally:
+            # The IMAP sessions are owned by this process, so make sure we log out cleanly when polling stops.
+            close_session()
+            if hasattr(self.event_generator, "close"):
+                self.event_generator.close()
+            if hasattr(self.event_handler, "close"):
+                self.event_handler.close()
+            # The handler may still be recording progress in the journals as it closes, so this goes last.
+            close_journal()
 
 
 class PollerManager:
-    def __init__(self, event_generator: Callable, event_handler: Callable):
+    """Starts and stops the poller process. Every site in the config's `[sites]` gets polled, or if there aren't any,
+    the top-level `[imap]` account."""
+
+    def __init__(self,
+                 event_generator: Callable,
+                 event_handler: Callable,
+                 waiter: Optional[Callable[[int], bool]] = None,
+                 replay_source: Optional[Callable[[], List[DetectionInfo]]] = None):
         self.poller: Optional[Process] = None
         self.sentinel = Value('i', 0)
 
         self.event_generator = event_generator
         self.event_handler = event_handler
+        self.waiter = waiter
+        self.replay_source = replay_source
 
     def start(self):
         self.sentinel.value = 1
-        polling_freq = Config.instance().get("imap.polling_frequency")
+        cfg = Config.instance()
+        sites = cfg.sites()
+        if sites:
+            logger.info(f"Polling {len(sites)} sites: {', '.join(sites)}")
         self.poller = EmailPoller(self.sentinel,
-                                  polling_freq=polling_freq,
+                                  polling_freq=cfg.get("imap.polling_frequency"),
                                   event_generator=self.event_generator,
-                                  event_handler=self.event_handler)
+                                  event_handler=self.event_handler,
+                                  waiter=self.waiter,
+                                  replay_source=self.replay_source,
+                                  sites=sites or None)
         self.poller.start()
 
     def stop(self):
@@ -0,0 +1,105 @@
+import imaplib
+import socket
+import time
+from typing import Callable, Dict, Optional, TypeVar
+
+import imap_tools
+from imap_tools import MailBox
+
+from .login import get_mailbox
+from ..config import Config, current_site
+from ..log_helper import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+# Errors that mean the connection itself has gone bad, rather than the command failing.
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, socket.error, EOFError)
+
+
+class MailboxSession:
+    """A long-lived, logged-in IMAP connection that is shared by everything the poller does in a cycle.
+
+    Logging in costs a TLS handshake, LOGIN, SELECT and a keyring lookup, so rather than doing that for every fetch
+    and move we hold on to the connection. If it has been idle for longer than `imap.keepalive_interval` seconds it
+    gets a NOOP before it's handed out; if the NOOP (or any command run through `run`) fails, we reconnect."""
+
+    def __init__(self, connect: Callable[[], MailBox] = get_mailbox, keepalive_interval: Optional[float] = None):
+        if keepalive_interval is None:
+            keepalive_interval = Config.instance().get("imap.keepalive_interval", 60)
+
+        self._connect = connect
+        self.keepalive_interval: float = keepalive_interval
+        self._mailbox: Optional[MailBox] = None
+        self._last_used: float = 0.0
+
+    @property
+    def connected(self) -> bool:
+        return self._mailbox is not None
+
+    def _is_healthy(self) -> bool:
+        if time.monotonic() - self._last_used < self.keepalive_interval:
+            return True
+
+        try:
+            status, _ = self._mailbox.client.noop()
+            return status == "OK"
+        except CONNECTION_ERRORS as err:
+            logger.info(f"IMAP connection failed keepalive check: {err}")
+            return False
+
+    def mailbox(self) -> imap_tools.MailBox:
+        """Get a healthy, logged-in mailbox, reconnecting if the existing connection has dropped."""
+        if self._mailbox is not None and not self._is_healthy():
+            self.close()
+
+        if self._mailbox is None:
+            logger.debug("Opening IMAP connection")
+            self._mailbox = self._connect()
+
+        self._last_used = time.monotonic()
+        return self._mailbox
+
+    def run(self, func: Callable[[MailBox], T]) -> T:
+        """Run `func` against the mailbox. If the connection drops part way through, reconnect and try once more."""
+        try:
+            result = func(self.mailbox())
+        except CONNECTION_ERRORS as err:
+            logger.warning(f"IMAP connection dropped ({err}) - reconnecting and retrying")
+            self.close()
+            result = func(self.mailbox())
+
+        # The connection has just proven itself, so there's no need for a keepalive before its next use.
+        self._last_used = time.monotonic()
+        return result
+
+    def close(self):
+        if self._mailbox is None:
+            return
+
+        try:
+            self._mailbox.logout()
+        except Exception as err:
+            logger.debug(f"Ignoring error while logging out of IMAP: {err}")
+        finally:
+            self._mailbox = None
+
+
+_sessions: Dict[Optional[str], MailboxSession] = {}
+
+
+def get_session() -> MailboxSession:
+    """Get the session for this process and the current site (see `use_site`). Sockets can't be shared between
+    processes, so each process that talks to the IMAP server (in practice, just the poller) lazily creates its own."""
+    site = current_site()
+    if site not in _sessions:
+        _sessions[site] = MailboxSession()
+    return _sessions[site]
+
+
+def close_session():
+    """Log out of every site's session."""
+    while _sessions:
+        _, session = _sessions.popitem()
+        session.close()
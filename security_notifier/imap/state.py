@@ -0,0 +1,61 @@
+import os
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Optional
+
+import toml
+
+from ..config import Config, TextPath, current_site, use_site
+from ..log_helper import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class MailboxState:
+    """Where we got up to in the inbox. UIDs are only meaningful for as long as the server's UIDVALIDITY stays the
+    same; if it changes, we have to go back to searching the whole inbox."""
+    uidvalidity: Optional[int] = None
+    last_uid: int = 0
+
+    def is_valid_for(self, uidvalidity: int) -> bool:
+        return self.uidvalidity == uidvalidity and self.last_uid > 0
+
+
+def _state_path() -> Path:
+    """`imap.state_file`, or `imap_state.toml` next to the config. Each site keeps its own: unless the site sets a
+    `state_file` of its own, its name goes into the shared one's, e.g. `imap_state.garage.toml`."""
+    cfg = Config.instance()
+    site = current_site()
+    path = Path(cfg.get("imap.state_file", None) or Path(Config.DEFAULT_CONFIG_PATH).parent / "imap_state.toml")
+    if site is None:
+        return path
+
+    with use_site(None):
+        shared = cfg.get("imap.state_file", None)
+    if shared is not None and path != Path(shared):
+        return path
+    return path.with_name(f"{path.stem}.{site}{path.suffix}")
+
+
+def load_state(path: Optional[TextPath] = None) -> MailboxState:
+    path = Path(path) if path is not None else _state_path()
+    if not path.is_file():
+        return MailboxState()
+
+    with open(path, "r") as fh:
+        data = toml.load(fh)
+    return MailboxState(data.get("uidvalidity"), data.get("last_uid", 0))
+
+
+def save_state(state: MailboxState, path: Optional[TextPath] = None):
+    """Write the state via a temporary file, so a crash mid-write can't leave us with a truncated high-water mark."""
+    path = Path(path) if path is not None else _state_path()
+    tmp_path = path.with_name(path.name + ".tmp")
+
+    with open(tmp_path, "w") as fh:
+        toml.dump({k: v for k, v in asdict(state).items() if v is not None}, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+    logger.debug(f"Saved IMAP state {state}")
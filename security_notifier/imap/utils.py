@@ -1,11 +1,26 @@
-from typing import Iterable
+import itertools
+from typing import Iterable, Iterator, List, Optional, TypeVar
 
-from . import get_mailbox
+from imap_tools import MailBox
+
+from .login import get_mailbox
 from ..config import Config
 from ..log_helper import get_logger
 
 logger = get_logger(__name__)
 
+T = TypeVar("T")
+
+
+def batched(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Lazily split `items` into lists of up to `size` items."""
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
 
 def _full_mailbox_name(delim="/"):
     """Get the full mailbox name, including 'INBOX'. Allows the user to specify the delimiter as we need pipe '|' for
@@ -18,36 +33,51 @@ def _full_mailbox_name(delim="/"):
     return f"INBOX{delim}{fld}"
 
 
-def create_processed_folder_if_not_exist():
+def create_processed_folder_if_not_exist(mailbox: Optional[MailBox] = None):
     """Create a folder to archive all processed messages (if it doesn't already exist).
 
     As the inbox grows, operations on it will become less and less efficient. It's useful to keep the old emails for
     looking back on when detections happened, but we'll move them to a sub-folder once they've been downloaded and
     parsed.
 
-    This behaviour can be disabled by setting the `imap.processed_folder` option in the config to null."""
+    This behaviour can be disabled by setting the `imap.processed_folder` option in the config to null.
+
+    If `mailbox` is given, that connection is used; otherwise a new one is opened for the call."""
     fld = _full_mailbox_name("|")
     if fld is None:
         logger.warning("Folder for processed messages isn't configured. INBOX size will grow, affecting performance.")
         return
 
-    with get_mailbox() as mailbox:
-        if not mailbox.folder.exists(fld):
-            mailbox.folder.create(fld)
+    if mailbox is None:
+        with get_mailbox() as mailbox:
+            return create_processed_folder_if_not_exist(mailbox)
+
+    if not mailbox.folder.exists(fld):
+        mailbox.folder.create(fld)
 
 
-def move_processed_messages(message_ids: Iterable[str]):
+def move_processed_messages(message_ids: Iterable[str], mailbox: Optional[MailBox] = None):
     """Move a set of messages to the processed folder.
 
     As the inbox grows, operations on it will become less and less efficient. It's useful to keep the old emails for
     looking back on when detections happened, but we'll move them to a sub-folder once they've been downloaded and
     parsed.
 
-    This behaviour can be disabled by setting the `imap.processed_folder` option in the config to null."""
+    This behaviour can be disabled by setting the `imap.processed_folder` option in the config to null.
+
+    If `mailbox` is given, that connection is used; otherwise a new one is opened for the call."""
     fld = _full_mailbox_name("/")
     if fld is None:
         logger.warning("Folder for processed messages isn't configured. INBOX size will grow, affecting performance.")
         return
 
-    with get_mailbox() as mailbox:
-        mailbox.move(message_ids, fld)
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+
+    if mailbox is None:
+        with get_mailbox() as mailbox:
+            mailbox.move(message_ids, fld)
+        return
+
+    mailbox.move(message_ids, fld)
@@ -0,0 +1,346 @@
+from __future__ import annotations
+
+import datetime
+import enum
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Text
+
+from .config import Config, TextPath, current_site
+from .imap.detection_info import DetectionInfo, EventType
+from .log_helper import get_logger
+
+logger = get_logger(__name__)
+
+
+class EventState(enum.Enum):
+    Queued = "queued"
+    Capturing = "capturing"
+    Done = "done"
+    Failed = "failed"
+
+
+UNFINISHED_STATES = (EventState.Queued, EventState.Capturing)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    key TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    camera_ids TEXT NOT NULL,
+    date_and_time TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_state ON events (state);
+CREATE INDEX IF NOT EXISTS events_time ON events (date_and_time);
+CREATE INDEX IF NOT EXISTS events_type_time ON events (type, date_and_time);
+
+-- One row per camera per event, so "what happened on camera N between X and Y" is a single index range scan.
+CREATE TABLE IF NOT EXISTS event_cameras (
+    camera_id INTEGER NOT NULL,
+    date_and_time TEXT NOT NULL,
+    key TEXT NOT NULL REFERENCES events (key),
+    PRIMARY KEY (camera_id, date_and_time, key)
+) WITHOUT ROWID;
+
+-- What the object detector found in each event's capture, laid out like event_cameras.
+CREATE TABLE IF NOT EXISTS event_labels (
+    label TEXT NOT NULL,
+    date_and_time TEXT NOT NULL,
+    key TEXT NOT NULL REFERENCES events (key),
+    PRIMARY KEY (label, date_and_time, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS event_labels_key ON event_labels (key);
+"""
+
+# Each migration runs once on every journal, new or old, so a new journal is built up by running the lot.
+_SCHEMA_VERSION = 2
+_MIGRATIONS = {
+    # Journals created before event_cameras existed need it filling in from the events table.
+    1: """
+    INSERT OR IGNORE INTO event_cameras (camera_id, date_and_time, key)
+    SELECT CAST(j.value AS INTEGER), e.date_and_time, e.key FROM events e, json_each('[' || e.camera_ids || ']') j;
+    """,
+    # How much the motion gate saw moving in each event's capture.
+    2: """
+    ALTER TABLE events ADD COLUMN motion_score REAL;
+    CREATE INDEX IF NOT EXISTS events_motion ON events (motion_score);
+    """,
+}
+
+
+@dataclass
+class JournalEntry:
+    event: DetectionInfo
+    state: EventState
+    attempts: int
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
+    # What the detector found in the capture. None if it hasn't been run over it.
+    labels: Optional[List[Text]] = None
+    # The motion gate's score for the capture. None if the gate was off.
+    motion_score: Optional[float] = None
+
+
+def _to_row(event: DetectionInfo) -> tuple:
+    return event.key, event.type.name, ",".join(str(c) for c in event.camera_ids), event.date_and_time.isoformat()
+
+
+def _to_event(type_name: str, camera_ids: str, date_and_time: str) -> DetectionInfo:
+    return DetectionInfo(
+        EventType[type_name],
+        [int(c) for c in camera_ids.split(",") if c],
+        datetime.datetime.fromisoformat(date_and_time)
+    )
+
+
+class EventJournal:
+    """An on-disk record of every event and how far we've got with capturing it, so that a restart (or crash) doesn't
+    lose anything that had been fetched from the inbox but not yet captured.
+
+    It's a SQLite database in WAL mode. Writes are grouped into one transaction per call, so adding a batch of
+    events costs a single fsync rather than one per event. The connection is shared between threads, so all access
+    goes through a lock."""
+
+    def __init__(self, path: TextPath):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        for v in range(version + 1, _SCHEMA_VERSION + 1):
+            logger.info(f"Migrating event journal to version {v}")
+            self._conn.executescript(f"BEGIN; {_MIGRATIONS[v]} PRAGMA user_version = {v}; COMMIT;")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def add(self, events: Iterable[DetectionInfo]) -> List[DetectionInfo]:
+        """Record new events as queued. Returns the ones we hadn't already seen - the rest are duplicates of events
+        that are either already captured or already waiting to be."""
+        events = list(events)
+        if not events:
+            return []
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                added = []
+                for event in events:
+                    cursor = self._conn.execute(
+                        "INSERT OR IGNORE INTO events (key, type, camera_ids, date_and_time, state, created_at, "
+                        "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        _to_row(event) + (EventState.Queued.value, now, now))
+                    if cursor.rowcount:
+                        added.append(event)
+                        self._conn.executemany(
+                            "INSERT OR IGNORE INTO event_cameras (camera_id, date_and_time, key) VALUES (?, ?, ?)",
+                            [(c, event.date_and_time.isoformat(), event.key) for c in event.camera_ids])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return added
+
+    def set_state(self, events: Iterable[DetectionInfo], state: EventState):
+        keys = [(state.value, time.time(), e.key) for e in events]
+        if not keys:
+            return
+
+        attempts = 1 if state == EventState.Capturing else 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    f"UPDATE events SET state = ?, updated_at = ?, attempts = attempts + {attempts} WHERE key = ?",
+                    keys)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def set_labels(self, events: Iterable[DetectionInfo], labels: Iterable[Text]):
+        """Record what the detector found in the events' capture, replacing anything recorded before."""
+        events, labels = list(events), sorted(set(labels))
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for event in events:
+                    self._conn.execute("DELETE FROM event_labels WHERE key = ?", (event.key,))
+                    # An empty string records that the detector ran and found nothing.
+                    self._conn.executemany(
+                        "INSERT INTO event_labels (label, date_and_time, key) VALUES (?, ?, ?)",
+                        [(label, event.date_and_time.isoformat(), event.key) for label in labels or [""]])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def set_motion_score(self, events: Iterable[DetectionInfo], score: float):
+        """Record how much moved in the events' capture."""
+        keys = [(score, e.key) for e in events]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("UPDATE events SET motion_score = ? WHERE key = ?", keys)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _select(self,
+                where: str = "",
+                params: tuple = (),
+                join: str = "",
+                order_by: str = "events.date_and_time",
+                limit: Optional[int] = None) -> List[JournalEntry]:
+        columns = ", ".join(f"events.{c}" for c in
+                            ("type", "camera_ids", "date_and_time", "state", "attempts", "created_at", "updated_at",
+                             "motion_score"))
+        columns += ", (SELECT group_concat(label, ',') FROM event_labels WHERE event_labels.key = events.key)"
+        sql = f"SELECT {columns} FROM events {join} {where} ORDER BY {order_by}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        return [
+            JournalEntry(_to_event(t, c, d), EventState(s), a,
+                         datetime.datetime.fromtimestamp(created), datetime.datetime.fromtimestamp(updated),
+                         None if labels is None else [label for label in labels.split(",") if label],
+                         motion_score)
+            for t, c, d, s, a, created, updated, motion_score, labels in rows
+        ]
+
+    def unfinished(self) -> List[DetectionInfo]:
+        """Events that were queued or mid-capture, e.g. when we last shut down."""
+        return [e.event for e in self.query(states=UNFINISHED_STATES)]
+
+    def query(self,
+              start: Optional[datetime.datetime] = None,
+              end: Optional[datetime.datetime] = None,
+              camera_id: Optional[int] = None,
+              event_types: Optional[Iterable[EventType]] = None,
+              states: Optional[Iterable[EventState]] = None,
+              label: Optional[Text] = None,
+              min_motion: Optional[float] = None,
+              limit: Optional[int] = None) -> List[JournalEntry]:
+        """Find events, oldest first. Every filter is optional; `start` is inclusive and `end` exclusive. `label`
+        finds events where the detector found that kind of object, and `min_motion` those whose capture had at least
+        that motion score.
+
+        Time ranges are answered from the date/time index, or from the per-camera or per-label index when a camera or
+        label is given, so queries stay fast however much history has built up."""
+        clauses, params, joins = [], [], []
+        time_column = "events.date_and_time"
+
+        if label is not None:
+            joins.append("JOIN event_labels ON event_labels.key = events.key")
+            time_column = "event_labels.date_and_time"
+            clauses.append("event_labels.label = ?")
+            params.append(label)
+        if camera_id is not None:
+            joins.append("JOIN event_cameras ON event_cameras.key = events.key")
+            time_column = "event_cameras.date_and_time"
+            clauses.append("event_cameras.camera_id = ?")
+            params.append(camera_id)
+        if start is not None:
+            clauses.append(f"{time_column} >= ?")
+            params.append(start.isoformat())
+        if end is not None:
+            clauses.append(f"{time_column} < ?")
+            params.append(end.isoformat())
+        if event_types is not None:
+            event_types = list(event_types)
+            clauses.append(f"events.type IN ({','.join('?' for _ in event_types)})")
+            params.extend(t.name for t in event_types)
+        if states is not None:
+            states = list(states)
+            clauses.append(f"events.state IN ({','.join('?' for _ in states)})")
+            params.extend(s.value for s in states)
+        if min_motion is not None:
+            clauses.append("events.motion_score >= ?")
+            params.append(min_motion)
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return self._select(where, tuple(params), " ".join(joins), time_column, limit)
+
+    def history(self,
+                start: Optional[datetime.datetime] = None,
+                end: Optional[datetime.datetime] = None) -> List[JournalEntry]:
+        """Every event (optionally between `start` and `end`), oldest first."""
+        return self.query(start, end)
+
+    def counts(self) -> Dict[EventState, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM events GROUP BY state").fetchall()
+        return {EventState(s): n for s, n in rows}
+
+
+def _journal_path() -> Optional[Path]:
+    cfg = Config.instance()
+    path = cfg.get("journal.path", None)
+    if path is not None:
+        return Path(path)
+
+    storage = cfg.get("stream_capture.storage_location", None)
+    if storage is None:
+        return None
+    return Path(storage) / "events.sqlite3"
+
+
+_journals: Dict[Optional[Text], EventJournal] = {}
+
+
+def get_journal() -> Optional[EventJournal]:
+    """Get this process's journal for the current site (see `use_site`). Returns None if it's been disabled with
+    `journal.enabled`, or if there's nowhere to put it (neither `journal.path` nor `stream_capture.storage_location` is
+    set)."""
+    site = current_site()
+    if site in _journals:
+        return _journals[site]
+
+    if not Config.instance().get("journal.enabled", True):
+        return None
+
+    path = _journal_path()
+    if path is None:
+        logger.warning("Nowhere to keep the event journal - events won't survive a restart.")
+        return None
+
+    _journals[site] = EventJournal(path)
+    return _journals[site]
+
+
+def close_journal():
+    """Close every site's journal."""
+    while _journals:
+        _, journal = _journals.popitem()
+        journal.close()
+
+
+def replay_unfinished_events() -> List[DetectionInfo]:
+    """Events that weren't finished last time we ran, to be captured before anything new."""
+    journal = get_journal()
+    if journal is None:
+        return []
+
+    events = journal.unfinished()
+    if events:
+        logger.info(f"Replaying {len(events)} unfinished events from the journal")
+    return events
@@ -1,22 +1,63 @@
 import getpass
+import time
 from os import getenv
-from typing import Text, Optional
+from typing import Dict, Text, Optional, Tuple
 
 from keyrings.cryptfile.cryptfile import CryptFileKeyring
 
 from .config import Config
 
+# Unlocking the keyring runs its key-derivation function, which is deliberately slow, and we look passwords up on the
+# hot capture path (once per camera per event). So we keep the unlocked keyring and the passwords we've read from it
+# for `keyring.cache_ttl` seconds. A TTL of 0 turns the cache off.
+_keyring: Optional[CryptFileKeyring] = None
+_keyring_unlocked_at: float = 0.0
+_passwords: Dict[Tuple[Text, Text], Tuple[Text, float]] = {}
+
+
+def _cache_ttl() -> float:
+    return Config.instance().get("keyring.cache_ttl", 3600)
+
+
+def _is_fresh(cached_at: float) -> bool:
+    return time.monotonic() - cached_at < _cache_ttl()
+
+
+def invalidate_cache():
+    """Forget the unlocked keyring and any cached passwords, e.g. after the keyring file has been changed
+    externally."""
+    global _keyring
+    _keyring = None
+    _passwords.clear()
+
 
 def _get_keyring():
+    global _keyring, _keyring_unlocked_at
+    if _keyring is not None and _is_fresh(_keyring_unlocked_at):
+        return _keyring
+
     keyring = CryptFileKeyring()
     keyring.keyring_key = getenv("KEYRING_CRYPTFILE_PASSWORD") or getpass.getpass("Enter your keyring password: ")
+
+    _keyring, _keyring_unlocked_at = keyring, time.monotonic()
     return keyring
 
 
 def get_password(cfg_pwd_key, cfg_username_key):
     cfg = Config.instance()
+    key = (cfg.get(cfg_pwd_key), cfg.get(cfg_username_key))
+
+    cached = _passwords.get(key)
+    if cached is not None and _is_fresh(cached[1]):
+        return cached[0]
+
     keyring = _get_keyring()
-    return keyring.get_password(cfg.get(cfg_pwd_key), cfg.get(cfg_username_key))
+    password = keyring.get_password(*key)
+
+    # Missing passwords aren't cached, so that they're picked up as soon as they've been set.
+    if password is not None:
+        _passwords[key] = (password, time.monotonic())
+    return password
 
 
 def set_password(pwd_name, cfg_pwd_key, cfg_username_key, passwd_text: Optional[Text] = None):
@@ -24,8 +65,10 @@ def set_password(pwd_name, cfg_pwd_key, cfg_username_key, passwd_text: Optional[
         passwd_text = getpass.getpass(f"Enter your {pwd_name} password to store in the keyring: ")
 
     cfg = Config.instance()
+    key = (cfg.get(cfg_pwd_key), cfg.get(cfg_username_key))
     keyring = _get_keyring()
-    keyring.set_password(cfg.get(cfg_pwd_key), cfg.get(cfg_username_key), passwd_text)
+    keyring.set_password(*key, passwd_text)
+    _passwords[key] = (passwd_text, time.monotonic())
 
 
 def password_is_set(cfg_pwd_key, cfg_username_key) -> bool:
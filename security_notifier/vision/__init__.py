@@ -1,15 +1,25 @@
 import logging
 import multiprocessing
 import time
-from typing import Optional, List, Callable
+from pathlib import Path
+from typing import Optional, List, Callable, Text
 
 import cv2
 
 from security_notifier.config import Config
 from security_notifier.imap import DetectionInfo
 from security_notifier.log_helper import get_logger
+from security_notifier.vision.compositor import FrameCompositor
+from security_notifier.vision.detector import DetectionBatcher, DetectionWorker, get_detector
+from security_notifier.vision.frame_bus import get_worker_bus
 from security_notifier.vision.login import get_dvr_password
+from security_notifier.vision.motion import MotionGate
+from security_notifier.vision.passthrough import copy_stream, open_passthrough_capture, open_passthrough_writer
+from security_notifier.vision.pipeline import CapturePipeline
+from security_notifier.vision.retry import RetryScheduler
 from security_notifier.vision.utils import (
+    CaptureResult,
+    clip_length,
     event_to_filename,
     get_capture_uris,
     NoFrameFromFeedException
@@ -22,53 +32,186 @@ from security_notifier.vision.writer import (
 logger = get_logger(__name__, logging.DEBUG)
 
 
-def get_rtsp_capture(event: DetectionInfo, camera_idx: Optional[int] = None) -> bool:
+def _measure_bitrate(caps: List[cv2.VideoCapture], output_path: Path, seconds: float) -> Optional[float]:
+    """The bitrate of the feeds in Mbit/s, as reported by the backend. If it can't tell us, we estimate it from the
+    size of what we wrote out, which is at least in the right ballpark."""
+    kbps = sum(max(0.0, c.get(cv2.CAP_PROP_BITRATE)) for c in caps)
+    if kbps > 0:
+        return kbps / 1000
+    if output_path.exists() and seconds > 0:
+        return output_path.stat().st_size * 8 / seconds / 1e6
+    return None
+
+
+def _copy_capture(event: DetectionInfo,
+                  camera_idx: Optional[int],
+                  uri: Text,
+                  start_time: float,
+                  end_time: float,
+                  stream_length: Optional[float]) -> Optional[CaptureResult]:
+    """Capture a single camera by copying its packets into the output file as they are, without decoding them.
+    Returns None if the stream can't be copied like that, and has to go through the decode / encode path instead."""
+    output_path = event_to_filename(event, camera_idx)
+    cap = open_passthrough_capture(uri)
+    writer = None
+    try:
+        if not cap.isOpened():
+            logger.warning(f"Failed to open the feed for event {event} - logging for retry")
+            return CaptureResult(False)
+
+        writer = open_passthrough_writer(cap, output_path, Config.instance().get("dvr.camera_fps", 15))
+        if writer is None:
+            logger.info(f"Can't copy the feed for {event} as it is - decoding and re-encoding it instead")
+            return None
+
+        logger.info(f"Copying capture to {output_path}")
+        stats = copy_stream(cap, writer, end_time, stream_length)
+        logger.info(f"Captured {event}: {stats}")
+
+        writer.release()
+        writer = None
+        return CaptureResult(True, _measure_bitrate([cap], output_path, time.time() - start_time))
+    except NoFrameFromFeedException:
+        logger.warning(f"Failed to process event {event} - logging for retry")
+        return CaptureResult(False)
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.release()
+
+
+def get_rtsp_capture(event: DetectionInfo,
+                     camera_idx: Optional[int] = None,
+                     stream_id: Optional[int] = None) -> CaptureResult:
     cfg = Config.instance()
 
-    cam_uris = get_capture_uris(event, camera_idx)
+    cam_uris = get_capture_uris(event, camera_idx, stream_id)
     for c in cam_uris:
         logger.info(f"Reading capture from {c}")
 
-    caps = [cv2.VideoCapture(u) for u in cam_uris]
-
-    # OpenCV / RTSP doesn't seem to kill the feed at "endtime", so we'll have to manually do it.
-    # TODO: If find a way to fast-fwd this feed, will need to account for the time difference.
-    run_time = time.time()
-    end_time = run_time + cfg.get("stream_capture.detection_clip_length", 5)
+    # In fast playback mode we read the recording as fast as the DVR will send it, and stop on the stream's own
+    # timestamps, with the wall-clock deadline only as a fallback. Otherwise, OpenCV / RTSP doesn't seem to kill the
+    # feed at "endtime", so we stop it ourselves once the clip's length of real time has passed.
+    fast_playback = cfg.get("stream_capture.fast_playback", False)
+    stream_length = clip_length(event)
+    start_time = time.time()
+    end_time = start_time + stream_length
+    if fast_playback:
+        end_time += cfg.get("stream_capture.playback_timeout", 10)
+
+    # A single camera can go straight into the file as it came from the DVR. Only when we're tiling several together,
+    # or something needs to look at the frames (the detector, the motion gate, or whoever's on the frame bus), do we
+    # need to decode them (and so encode them again).
+    frame_bus = get_worker_bus()
+    detector = get_detector()
+    motion_gate = MotionGate.from_config()
+    needs_frames = frame_bus is not None or detector is not None or motion_gate is not None
+    if len(cam_uris) == 1 and not needs_frames and cfg.get("stream_capture.passthrough", True):
+        result = _copy_capture(event, camera_idx, cam_uris[0], start_time, end_time,
+                               stream_length if fast_playback else None)
+        if result is not None:
+            return result
 
-    # TODO: This is a pretty rubbish implementation. Should not be blocking reads with time taken to write
+    caps = [cv2.VideoCapture(u) for u in cam_uris]
     writer = None
-    try:
-        while run_time < end_time:
-            run_time = time.time()
-            imgs = []
-            for c_idx, cap in enumerate(caps):
-                ret, img = cap.read()
-                imgs.append(img)
-                if not ret:
-                    raise NoFrameFromFeedException(f"Failed to capture frame from RTSP feed for capture {c_idx}.")
-
+    compositor = None
+    camera_ids = [event.camera_ids[camera_idx]] if camera_idx is not None else event.camera_ids
+    detection = None
+    if detector is not None:
+        detection = DetectionWorker(DetectionBatcher(detector,
+                                                     frame_stride=cfg.get("detector.frame_stride", 5),
+                                                     batch_size=cfg.get("detector.batch_size", 1)),
+                                    max_pending=cfg.get("detector.max_pending", 16))
+
+    oversized = set()
+
+    def write(imgs):
+        nonlocal writer, compositor
+        # Static stretches aren't written at all, and the file isn't even created until something moves.
+        if motion_gate is None or motion_gate.keep(imgs):
             if writer is None:
-                writer = create_writer(event, camera_idx, imgs)
+                compositor = FrameCompositor.from_config(imgs)
+                writer = create_writer(event, camera_idx, compositor.size)
+            write_all_frames(writer, imgs, compositor)
+
+        if frame_bus is not None:
+            now = time.time()
+            for camera_id, img in zip(camera_ids, imgs):
+                if img.nbytes > frame_bus.frame_bytes:
+                    # Too big for the bus's slots. The capture doesn't need the bus, so it carries on without it.
+                    if camera_id not in oversized:
+                        logger.warning(f"Camera {camera_id}'s {img.shape} frames are too big for the frame bus "
+                                       f"({frame_bus.frame_bytes} bytes) - not publishing them")
+                        oversized.add(camera_id)
+                    continue
+                frame_bus.publish(img, camera_id, now, event.key)
+        if detection is not None:
+            detection.add(imgs)
+
+    # Each camera is read on its own thread, so a slow encode doesn't stall the reads.
+    pipeline = CapturePipeline(caps,
+                               write,
+                               buffer_size=cfg.get("stream_capture.frame_buffer_size", 64),
+                               late_threshold=cfg.get("stream_capture.late_frame_threshold", 1.0),
+                               frame_timeout=cfg.get("stream_capture.frame_timeout", 10))
+    try:
+        stats = pipeline.run(end_time, stream_length if fast_playback else None)
+        logger.info(f"Captured {event}: {stats}")
 
-            write_all_frames(writer, imgs)
+        # The writer has to be finished with the file before we can see how big it is.
+        if writer is not None:
+            writer.release()
+            writer = None
+        bitrate = _measure_bitrate(caps, event_to_filename(event, camera_idx), time.time() - start_time)
+
+        labels = None
+        if detection is not None:
+            found = detection.finish()
+            if found is not None:
+                labels = sorted(found)
+                logger.info(f"Found {dict(found) or 'nothing'} in {detection.batcher.frames_analysed} frames of "
+                            f"{event}")
+
+        motion_score = None
+        if motion_gate is not None:
+            motion_score = motion_gate.peak_score
+            if motion_gate.motion:
+                logger.info(f"Kept {motion_gate.frames_kept} of {motion_gate.frames_seen} frames of {event} "
+                            f"(motion score {motion_score:.3f})")
+            else:
+                logger.info(f"Nothing moved in {event} (motion score {motion_score:.3f}) - discarded the clip")
     except NoFrameFromFeedException:
         logger.warning(f"Failed to process event {event} - logging for retry")
-        return False
+        return CaptureResult(False)
     finally:
         for cap in caps:
             cap.release()
 
         if writer is not None:
             writer.release()
-    return True
+        if detection is not None:
+            detection.cancel()
+    return CaptureResult(True, bitrate, labels, motion_score)
 
 
 def _run_retry_loop(all_events: List[DetectionInfo], handler: Callable, p: multiprocessing.Pool, status: List[bool]):
-    retry_events = all_events
-    while not all(status):
-        retry_events = [retry_events[i] for i, r in enumerate(status) if not r]
-        status = p.map(handler, retry_events)
+    """Retry the failed events with backoff until they succeed or run out of attempts."""
+    retries = RetryScheduler()
+    for event, success in zip(all_events, status):
+        if not success:
+            retries.record_failure(event)
+
+    while retries:
+        time.sleep(max(0.0, retries.next_due() - time.monotonic()))
+        retry_events = retries.pop_due()
+        for event, success in zip(retry_events, p.map(handler, retry_events)):
+            if success:
+                retries.record_success(event)
+            else:
+                retries.record_failure(event)
+
+    if retries.dead_letters:
+        logger.error(f"Gave up capturing {len(retries.dead_letters)} events: {retries.dead_letters}")
 
 
 def multi_process_capture(events: List[DetectionInfo], handler: Callable = get_rtsp_capture):
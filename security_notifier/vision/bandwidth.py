@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from security_notifier.config import Config
+from security_notifier.log_helper import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class Admission:
+    """A capture that's been let through: which stream it should use, and what it's been counted as using."""
+    stream_id: int
+    streams: int
+    bandwidth: float
+
+
+class BandwidthScheduler:
+    """Decides how many RTSP streams we can have open on the DVR at once, and which of its streams to use.
+
+    The number of concurrent streams is an AIMD window, like TCP's congestion window: it starts at one, goes up by one
+    per successful capture until the first failure ("slow start"), then by one per window's worth of successes after
+    that, and is multiplied by `decrease` whenever a capture fails. A capture for several cameras needs one stream per
+    camera.
+
+    On top of that, if the DVR has a `budget` (in Mbit/s), captures are only admitted while the bitrate of the open
+    streams stays under it. Each stream's bitrate starts as a guess (`bitrates`) and is replaced by a running average of
+    what captures actually measure. If the preferred stream won't fit but the (lower resolution) fallback stream will,
+    the capture is admitted on the fallback stream instead.
+
+    Whatever the window and budget say, a capture is always admitted when nothing else is running, so we can't stall."""
+
+    def __init__(self,
+                 max_streams: int,
+                 budget: Optional[float] = None,
+                 preferred_stream: int = 1,
+                 fallback_stream: Optional[int] = 2,
+                 bitrates: Optional[Dict[int, float]] = None,
+                 decrease: float = 0.5,
+                 smoothing: float = 0.3):
+        self.max_streams = max_streams
+        self.budget = budget
+        self.preferred_stream = preferred_stream
+        self.fallback_stream = fallback_stream if fallback_stream != preferred_stream else None
+        self.bitrates: Dict[int, float] = dict(bitrates or {})
+        self.decrease = decrease
+        self.smoothing = smoothing
+
+        self.window = 1.0
+        self._slow_start = True
+        self.active_streams = 0
+        self.active_bandwidth = 0.0
+
+    @staticmethod
+    def from_config(max_streams: int) -> BandwidthScheduler:
+        cfg = Config.instance()
+        preferred = cfg.get("dvr.stream_to_capture", 1)
+        fallback = cfg.get("dvr.fallback_stream", 2)
+        return BandwidthScheduler(max_streams=cfg.get("dvr.max_streams", max_streams),
+                                  budget=cfg.get("dvr.bandwidth_budget", None),
+                                  preferred_stream=preferred,
+                                  fallback_stream=fallback,
+                                  bitrates={preferred: cfg.get("dvr.stream_bitrate", 4.0),
+                                            fallback: cfg.get("dvr.fallback_stream_bitrate", 0.5)})
+
+    def _fits(self, streams: int, stream_id: int) -> bool:
+        if self.budget is None:
+            return True
+        return self.active_bandwidth + streams * self.bitrates.get(stream_id, 0.0) <= self.budget
+
+    def admit(self, streams: int) -> Optional[Admission]:
+        """Try to open `streams` more streams. Returns None if the capture has to wait for others to finish."""
+        if self.active_streams == 0:
+            # Always let one capture through: on the preferred stream if it fits the budget, otherwise the fallback.
+            stream_id = self.preferred_stream
+            if not self._fits(streams, stream_id) and self.fallback_stream is not None:
+                stream_id = self.fallback_stream
+        elif self.active_streams + streams > int(self.window):
+            return None
+        elif self._fits(streams, self.preferred_stream):
+            stream_id = self.preferred_stream
+        elif self.fallback_stream is not None and self._fits(streams, self.fallback_stream):
+            logger.debug(f"Using stream {self.fallback_stream} to stay under the {self.budget} Mbit/s budget")
+            stream_id = self.fallback_stream
+        else:
+            return None
+
+        admission = Admission(stream_id, streams, streams * self.bitrates.get(stream_id, 0.0))
+        self.active_streams += admission.streams
+        self.active_bandwidth += admission.bandwidth
+        return admission
+
+    def release(self, admission: Admission, success: bool, bitrate: Optional[float] = None):
+        """A capture has finished. `bitrate` is what it measured, in Mbit/s across all of its streams."""
+        self.active_streams -= admission.streams
+        self.active_bandwidth = max(0.0, self.active_bandwidth - admission.bandwidth)
+
+        if bitrate:
+            per_stream = bitrate / admission.streams
+            previous = self.bitrates.get(admission.stream_id)
+            self.bitrates[admission.stream_id] = per_stream if previous is None else \
+                previous + self.smoothing * (per_stream - previous)
+
+        if success:
+            self.window = min(float(self.max_streams),
+                              self.window + (1.0 if self._slow_start else 1.0 / self.window))
+        else:
+            self._slow_start = False
+            self.window = max(1.0, self.window * self.decrease)
+            logger.info(f"Capture failed - cutting concurrent streams to {int(self.window)}")
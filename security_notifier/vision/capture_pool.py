@@ -0,0 +1,481 @@
+import concurrent.futures
+import functools
+import multiprocessing
+import multiprocessing.pool
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Text
+
+from security_notifier.config import Config, current_site, use_site
+from security_notifier.imap import DetectionInfo
+from security_notifier.journal import EventJournal, EventState, get_journal
+from security_notifier.log_helper import get_logger
+from security_notifier.vision import get_rtsp_capture
+from security_notifier.vision.bandwidth import Admission, BandwidthScheduler
+from security_notifier.vision.coalesce import EventCoalescer
+from security_notifier.vision.detector import get_detector
+from security_notifier.vision.frame_bus import FrameBus, attach_worker_bus, frame_bus_names, frame_bus_settings
+from security_notifier.vision.login import get_dvr_password
+from security_notifier.vision.preroll import LiveBuffer
+from security_notifier.vision.priority import CapturePriority, CaptureQueue
+from security_notifier.vision.retry import RetryPolicy, RetryScheduler
+
+logger = get_logger(__name__)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _claim_bus(names: Sequence[Text], owners) -> Optional[Text]:
+    """Take the first bus that no living worker has. A worker replacing one that died gets the dead one's bus (the
+    pool has reaped it by then, so its pid is gone)."""
+    with owners.get_lock():
+        for idx, owner in enumerate(owners):
+            if owner == 0 or not _alive(owner):
+                owners[idx] = os.getpid()
+                return names[idx]
+    return None
+
+
+def _init_worker(frame_buses: Optional[tuple] = None):
+    """Runs once in each worker as the pool starts. Unpickling this function has already imported cv2 and friends;
+    here we also load the config, unlock the keyring and load the object detector (if there is one), so none of that
+    lands on the first capture.
+
+    If the pool has frame buses, `frame_buses` is their names and which worker has each, and the worker takes one of
+    them to publish its frames to."""
+    cfg = Config.instance()
+    for site in cfg.sites() or [None]:
+        with use_site(site):
+            if cfg.get("dvr.keyring_secret_name", None) is not None:
+                get_dvr_password()
+    get_detector()
+
+    if frame_buses is not None:
+        name = _claim_bus(*frame_buses)
+        if name is None:
+            logger.warning("No frame bus left for this capture worker - its frames won't be published")
+        else:
+            attach_worker_bus(name)
+
+
+def _capture_for_site(handler: Callable, site: Optional[Text], event: DetectionInfo, **kwargs):
+    """Runs in a worker: capture `event` with its site's config (its DVR, storage location and so on)."""
+    with use_site(site):
+        return handler(event, **kwargs)
+
+
+@dataclass
+class SiteMetrics:
+    submitted: int = 0
+    captured: int = 0
+    failed: int = 0
+    retried: int = 0
+    # Of those captured, how many came from the live pre-roll buffer rather than the recordings.
+    live: int = 0
+    # Captures currently running.
+    in_flight: int = 0
+
+
+@dataclass
+class _SiteCaptures:
+    """Everything the pool keeps track of for one site: each site has its own DVR, so its own bandwidth budget,
+    queue, retries (a camera that keeps failing is that site's problem) and journal."""
+    name: Optional[Text]
+    journal: Optional[EventJournal]
+    retries: RetryScheduler
+    coalescer: Optional[EventCoalescer]
+    bandwidth: BandwidthScheduler
+    waiting: CaptureQueue
+    metrics: SiteMetrics = field(default_factory=SiteMetrics)
+
+    @property
+    def idle(self) -> bool:
+        return self.metrics.in_flight == 0 and not self.waiting and not self.retries and not self.coalescer
+
+
+class CaptureWorkerPool:
+    """A long-lived pool of capture processes, used as the poller's event handler.
+
+    Spawning a worker means re-importing cv2, numpy, imap_tools and re-loading the config, which takes seconds we
+    don't have once the DVR's playback window is ticking. So the pool is started once, in the poller process, when
+    polling starts, and stays up until it stops. Calling the pool with a batch of events submits them and returns
+    straight away, so batches overlap rather than the poller waiting on each in turn.
+
+    Waiting captures are started in priority order as each site's `BandwidthScheduler` makes room, after a short hold
+    to merge bursts of alerts (unless `coalesce` is False), and retried when they fail. Events on cameras a site's
+    `LiveBuffer` covers are written out from there instead. All of that is kept per site (see `use_site`), while the
+    workers are shared: sites take turns at them, so one busy site can't starve the rest.
+
+    The pool isn't started on construction, so it can be handed to the poller process before it has any processes or
+    threads of its own."""
+
+    def __init__(self,
+                 handler: Callable[[DetectionInfo], bool] = get_rtsp_capture,
+                 processes: Optional[int] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 use_journal: bool = True,
+                 coalesce: bool = True,
+                 priority: Optional[CapturePriority] = None):
+        self.handler = handler
+        self.processes = processes
+        self.retry_policy = retry_policy
+        self.use_journal = use_journal
+        self.coalesce = coalesce
+        self.priority = priority
+
+        self._pool: Optional[multiprocessing.pool.Pool] = None
+        self._size = 0
+        # In the order they'll next get a turn at a free worker.
+        self._sites: Dict[Optional[Text], _SiteCaptures] = {}
+        self._live: Dict[Optional[Text], LiveBuffer] = {}
+        self._live_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._live_in_flight = 0
+        self._frame_buses: List[FrameBus] = []
+        self._dispatcher: Optional[threading.Thread] = None
+        self._closing = False
+        self._in_flight = 0
+        # Guards all of the above, and is notified whenever any of it changes.
+        self._changed = threading.Condition()
+
+    def __getstate__(self):
+        if self._pool is not None:
+            raise RuntimeError("Can't send a running capture pool to another process")
+        state = self.__dict__.copy()
+        del state["_changed"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._changed = threading.Condition()
+
+    @property
+    def running(self) -> bool:
+        return self._pool is not None
+
+    @property
+    def pending(self) -> int:
+        """Captures that are running, waiting to start or be retried, or being held back to merge with any further
+        alerts."""
+        with self._changed:
+            held = sum(len(s.coalescer) for s in self._sites.values() if s.coalescer is not None)
+            retries = sum(len(s.retries) for s in self._sites.values())
+            waiting = sum(len(s.waiting) for s in self._sites.values())
+            return self._in_flight + self._live_in_flight + waiting + retries + held
+
+    @property
+    def frame_buses(self) -> List[Text]:
+        """Names of the workers' frame buses, for `FrameBus.attach`."""
+        return [b.name for b in self._frame_buses]
+
+    @property
+    def dead_letters(self) -> List[DetectionInfo]:
+        """Events we've given up trying to capture."""
+        return [e for s in self._sites.values() for e in s.retries.dead_letters]
+
+    @property
+    def metrics(self) -> Dict[Optional[Text], SiteMetrics]:
+        """A snapshot of each site's counts, by site name (None for the top-level config)."""
+        with self._changed:
+            return {name: SiteMetrics(**vars(s.metrics)) for name, s in self._sites.items()}
+
+    def start(self):
+        if self._pool is not None:
+            return
+
+        processes = self.processes or Config.instance().get("stream_capture.max_capture_processes", 5)
+        logger.info(f"Starting {processes} capture workers")
+
+        # Issue in Python < 3.8 where just using multiprocessing.Pool causes processes to fail due to fork safety
+        # https://stackoverflow.com/a/69405247/168735
+        context = multiprocessing.get_context("spawn")
+        frame_buses = None
+        settings = frame_bus_settings()
+        if settings is not None:
+            slots, frame_bytes = settings
+            names = frame_bus_names(processes)
+            self._frame_buses = [FrameBus.create(slots, frame_bytes, name) for name in names]
+            frame_buses = (names, context.Array("i", processes))
+            logger.info(f"Capture workers are publishing frames to {', '.join(names)}")
+
+        self._pool = context.Pool(processes, initializer=_init_worker, initargs=(frame_buses,))
+        self._size = processes
+        self._sites = {}
+        self._start_live_buffers()
+        self._closing = False
+        self._dispatcher = threading.Thread(target=self._dispatch, name="capture-dispatch", daemon=True)
+        self._dispatcher.start()
+
+    def _start_live_buffers(self):
+        self._live = {}
+        cfg = Config.instance()
+        for site in cfg.sites() or [None]:
+            with use_site(site):
+                live = LiveBuffer.from_config()
+            if live is not None and live.recorders:
+                logger.info(f"Buffering the live feeds of cameras {sorted(live.recorders)} "
+                            f"for site {site or 'default'}")
+                live.start()
+                self._live[site] = live
+
+        if self._live:
+            # A dump holds its thread until the clip's end comes round, so there's one per camera being buffered.
+            cameras = sum(len(live.recorders) for live in self._live.values())
+            self._live_executor = concurrent.futures.ThreadPoolExecutor(cameras, thread_name_prefix="live-capture")
+
+    def _stop_live_buffers(self, wait: bool = True):
+        for live in self._live.values():
+            live.stop()
+        self._live = {}
+        if self._live_executor is not None:
+            self._live_executor.shutdown(wait=wait)
+            self._live_executor = None
+
+    def _site(self, name: Optional[Text]) -> _SiteCaptures:
+        # Must hold self._changed
+        site = self._sites.get(name)
+        if site is None:
+            with use_site(name):
+                site = _SiteCaptures(name,
+                                     journal=get_journal() if self.use_journal else None,
+                                     retries=RetryScheduler(self.retry_policy),
+                                     coalescer=EventCoalescer.from_config() if self.coalesce else None,
+                                     bandwidth=BandwidthScheduler.from_config(self._size),
+                                     waiting=CaptureQueue(self.priority or CapturePriority.from_config()))
+            self._sites[name] = site
+        return site
+
+    def _submit(self, site: _SiteCaptures, events: List[DetectionInfo]):
+        # Must hold self._changed. Everything is queued before anything starts, so a batch is started in priority order.
+        live = self._live.get(site.name)
+        for event in events:
+            if live is not None and live.covers(event):
+                self._start_live(site, live, event)
+            else:
+                site.waiting.push(event)
+        self._start_waiting()
+
+    def _start_live(self, site: _SiteCaptures, live: LiveBuffer, event: DetectionInfo):
+        # Must hold self._changed
+        self._record(site, event, EventState.Capturing)
+        self._live_in_flight += 1
+        site.metrics.in_flight += 1
+        future = self._live_executor.submit(_capture_for_site, live.capture, site.name, event)
+        future.add_done_callback(functools.partial(self._on_live_result, site, event))
+
+    def _on_live_result(self, site: _SiteCaptures, event: DetectionInfo, future: concurrent.futures.Future):
+        # Runs on the live capture thread. A dump that doesn't work out isn't a failure: it goes to the recordings.
+        try:
+            success = bool(future.result())
+        except Exception as err:
+            logger.error(f"Live capture of {event} raised {err!r}")
+            success = False
+
+        with self._changed:
+            self._live_in_flight -= 1
+            site.metrics.in_flight -= 1
+            if success:
+                site.metrics.captured += 1
+                site.metrics.live += 1
+                self._record(site, event, EventState.Done)
+            else:
+                site.waiting.push(event)
+                self._start_waiting()
+            self._changed.notify_all()
+
+    def _start_waiting(self):
+        """Start as many of the waiting captures as there are free workers and the sites' bandwidth schedulers will let
+        us, highest priority first. Sites take turns, one capture at a time."""
+        # Must hold self._changed
+        while self._in_flight < self._size:
+            for site in self._sites.values():
+                if self._start_next(site):
+                    # To the back of the line.
+                    self._sites[site.name] = self._sites.pop(site.name)
+                    break
+            else:
+                return
+
+    def _start_next(self, site: _SiteCaptures) -> bool:
+        """Start the site's most important waiting capture, if its bandwidth scheduler has room for it."""
+        # Must hold self._changed
+        while site.waiting:
+            event = site.waiting.peek()
+            blocked = site.retries.blocked_until(event.camera_ids)
+            if blocked is not None:
+                logger.info(f"Holding back {event} until its camera is back")
+                site.waiting.pop()
+                site.retries.defer(event, blocked)
+                self._changed.notify_all()
+                continue
+
+            admission = site.bandwidth.admit(len(event.camera_ids))
+            if admission is None:
+                return False
+            site.waiting.pop()
+            self._start(site, event, admission)
+            return True
+        return False
+
+    def _start(self, site: _SiteCaptures, event: DetectionInfo, admission: Admission):
+        # Handlers only need to know about `stream_id` if the scheduler ever picks the fallback stream.
+        kwargs = {} if admission.stream_id == site.bandwidth.preferred_stream else {"stream_id": admission.stream_id}
+
+        self._record(site, event, EventState.Capturing)
+        self._in_flight += 1
+        site.metrics.in_flight += 1
+        self._pool.apply_async(_capture_for_site, (self.handler, site.name, event), kwargs,
+                               callback=functools.partial(self._on_result, site, event, admission),
+                               error_callback=functools.partial(self._on_error, site, event, admission))
+
+    @staticmethod
+    def _record(site: _SiteCaptures, event: DetectionInfo, state: EventState):
+        # A merged capture isn't in the journal itself - the alerts it was made from are.
+        if site.journal is not None:
+            site.journal.set_state(event.sources or [event], state)
+
+    def submit(self, event: DetectionInfo):
+        if self._pool is None:
+            raise RuntimeError("Capture pool hasn't been started")
+
+        with self._changed:
+            site = self._site(current_site())
+            site.metrics.submitted += 1
+            self._submit(site, [event])
+
+    def __call__(self, events: List[DetectionInfo]):
+        if self._pool is None:
+            raise RuntimeError("Capture pool hasn't been started")
+
+        with self._changed:
+            site = self._site(current_site())
+            site.metrics.submitted += len(events)
+            if site.coalescer is None:
+                self._submit(site, events)
+                return
+
+            site.coalescer.add(events)
+            self._changed.notify_all()
+
+    def _on_result(self, site: _SiteCaptures, event: DetectionInfo, admission: Admission, result: bool):
+        # Runs on the pool's result-handler thread. `result` may be a CaptureResult, which also carries the bitrate.
+        success = bool(result)
+        with self._changed:
+            self._in_flight -= 1
+            site.metrics.in_flight -= 1
+            site.bandwidth.release(admission, success, getattr(result, "bitrate", None))
+            if success:
+                site.metrics.captured += 1
+                site.retries.record_success(event)
+                self._record(site, event, EventState.Done)
+                labels = getattr(result, "labels", None)
+                if labels is not None and site.journal is not None:
+                    site.journal.set_labels(event.sources or [event], labels)
+                motion_score = getattr(result, "motion_score", None)
+                if motion_score is not None and site.journal is not None:
+                    site.journal.set_motion_score(event.sources or [event], motion_score)
+            else:
+                due = site.retries.record_failure(event)
+                if due is not None:
+                    site.metrics.retried += 1
+                    logger.warning(f"Failed to capture {event} - retrying in {due - time.monotonic():.1f}s")
+                else:
+                    site.metrics.failed += 1
+                    self._record(site, event, EventState.Failed)
+            self._changed.notify_all()
+
+    def _on_error(self, site: _SiteCaptures, event: DetectionInfo, admission: Admission, err: BaseException):
+        logger.error(f"Capture of {event} raised {err!r}")
+        self._on_result(site, event, admission, False)
+
+    def _dispatch(self):
+        """Starts waiting captures as the schedulers make room for them, and submits retries and merged events as
+        they come due."""
+        with self._changed:
+            while not self._closing:
+                due = []
+                for site in list(self._sites.values()):
+                    ready = site.retries.pop_due()
+                    if site.coalescer is not None:
+                        ready += site.coalescer.pop_ready()
+                    self._submit(site, ready)
+
+                    due.append(site.retries.next_due())
+                    if site.coalescer is not None:
+                        due.append(site.coalescer.next_due())
+                # A worker may have come free.
+                self._start_waiting()
+
+                due = [d for d in due if d is not None]
+                self._changed.wait(max(0.0, min(due) - time.monotonic()) if due else None)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for every submitted capture to finish, including any retries. Returns False on timeout."""
+        with self._changed:
+            return self._changed.wait_for(lambda: all(s.idle for s in self._sites.values()), timeout)
+
+    def close(self):
+        """Let running and waiting captures finish, then shut the workers down. Anything being held back for merging is
+        captured straight away. Anything still waiting to be retried is dropped, and put back in the journal's queue to
+        be picked up on the next run."""
+        if self._pool is None:
+            return
+
+        with self._changed:
+            for site in list(self._sites.values()):
+                if site.coalescer is not None:
+                    self._submit(site, site.coalescer.flush())
+            self._changed.wait_for(lambda: self._in_flight == 0 and self._live_in_flight == 0
+                                   and not any(s.waiting for s in self._sites.values()))
+            self._closing = True
+            dropped = {name: s.retries.clear() for name, s in self._sites.items()}
+            self._changed.notify_all()
+
+        for name, events in dropped.items():
+            if not events:
+                continue
+            site = self._sites[name]
+            logger.warning(f"Dropping {len(events)} captures that were waiting to be retried: {events}")
+            if site.journal is not None:
+                site.journal.set_state([s for e in events for s in (e.sources or [e])], EventState.Queued)
+
+        for name, site in self._sites.items():
+            logger.info(f"Capture metrics for site {name or 'default'}: {site.metrics}")
+
+        self._dispatcher.join()
+        self._stop_live_buffers()
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+        self._close_frame_buses()
+
+    def _close_frame_buses(self):
+        for bus in self._frame_buses:
+            bus.mark_closed()
+            bus.close()
+            bus.unlink()
+        self._frame_buses = []
+
+    def terminate(self):
+        if self._pool is None:
+            return
+
+        with self._changed:
+            self._closing = True
+            self._changed.notify_all()
+
+        self._dispatcher.join()
+        self._stop_live_buffers(wait=False)
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+        self._close_frame_buses()
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import datetime
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from security_notifier.config import Config
+from security_notifier.imap import DetectionInfo
+from security_notifier.imap.detection_info import EventType
+from security_notifier.log_helper import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class _Window:
+    start: datetime.datetime
+    end: datetime.datetime
+    sources: List[DetectionInfo]
+    ready_at: float
+
+    def to_event(self) -> DetectionInfo:
+        if len(self.sources) == 1:
+            return self.sources[0]
+
+        types = {e.type for e in self.sources}
+        return DetectionInfo(types.pop() if len(types) == 1 else EventType.Misc,
+                             list(self.sources[0].camera_ids),
+                             self.start,
+                             duration=(self.end - self.start).total_seconds(),
+                             sources=list(self.sources))
+
+
+class EventCoalescer:
+    """Merges bursts of alerts into one capture per burst.
+
+    The DVR will often send a motion alert, a line crossing and an intrusion for the same camera within a few seconds
+    of each other. Captured separately, that's three playback streams of largely the same footage. Instead, alerts for
+    the same camera(s) whose clips overlap, or are no more than `merge_gap` seconds apart, are merged into a single
+    event covering all of them, as long as it stays within `max_clip_length` seconds.
+
+    Alerts are merged with whatever they arrive alongside. More of a burst may still be on its way, so an event can also
+    be held back until no alert has been added to it for `hold` seconds (of wall time, not event time), but that delays
+    every capture, lone alerts included, so it's off by default. A held event is let go as soon as a later alert for
+    its cameras turns out not to belong to it."""
+
+    def __init__(self,
+                 merge_gap: float = 10.0,
+                 max_clip_length: float = 60.0,
+                 clip_length: float = 5.0,
+                 hold: float = 0.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.merge_gap = merge_gap
+        self.max_clip_length = max_clip_length
+        self.clip_length = clip_length
+        self.hold = hold
+        self._clock = clock
+
+        self._open: Dict[Tuple[int, ...], _Window] = {}
+        self._closed: List[_Window] = []
+
+    @staticmethod
+    def from_config() -> EventCoalescer:
+        cfg = Config.instance()
+        hold = cfg.get("stream_capture.merge_hold", 0)
+        if cfg.get("preroll.enabled", False):
+            # A held event's pre-roll has to still be in the live buffer once we let go of it, with time to spare for
+            # however late the alert reached us.
+            max_hold = max(0, cfg.get("preroll.seconds", 30) - cfg.get("preroll.pre_roll", 5)) / 2
+            if hold > max_hold:
+                logger.warning(f"stream_capture.merge_hold is too long for the pre-roll buffer - using {max_hold}s")
+                hold = max_hold
+        return EventCoalescer(merge_gap=cfg.get("stream_capture.merge_gap", 10),
+                              max_clip_length=cfg.get("stream_capture.max_clip_length", 60),
+                              clip_length=cfg.get("stream_capture.detection_clip_length", 5),
+                              hold=hold)
+
+    def __len__(self) -> int:
+        return len(self._open) + len(self._closed)
+
+    def _can_merge(self, window: _Window, start: datetime.datetime, end: datetime.datetime) -> bool:
+        gap = datetime.timedelta(seconds=self.merge_gap)
+        if start > window.end + gap or end < window.start - gap:
+            return False
+        return (max(end, window.end) - min(start, window.start)).total_seconds() <= self.max_clip_length
+
+    def add(self, events: Iterable[DetectionInfo]):
+        now = self._clock()
+        for event in sorted(events, key=lambda e: e.date_and_time):
+            start = event.date_and_time
+            end = start + datetime.timedelta(seconds=event.duration or self.clip_length)
+
+            cameras = tuple(event.camera_ids)
+            window = self._open.get(cameras)
+            if window is not None and self._can_merge(window, start, end):
+                window.start = min(start, window.start)
+                window.end = max(end, window.end)
+                window.sources.append(event)
+                window.ready_at = now + self.hold
+                continue
+
+            if window is not None:
+                # The burst is over, so there's no reason to keep holding it back.
+                window.ready_at = now
+                self._closed.append(window)
+            self._open[cameras] = _Window(start, end, [event], now + self.hold)
+
+    def next_due(self) -> Optional[float]:
+        """When the next merged event will be ready."""
+        windows = self._closed + list(self._open.values())
+        return min((w.ready_at for w in windows), default=None)
+
+    def pop_ready(self) -> List[DetectionInfo]:
+        """Take every merged event that's finished waiting for more alerts."""
+        now = self._clock()
+        ready = [w for w in self._closed if w.ready_at <= now]
+        self._closed = [w for w in self._closed if w.ready_at > now]
+        for cameras, window in list(self._open.items()):
+            if window.ready_at <= now:
+                ready.append(window)
+                del self._open[cameras]
+        return self._to_events(ready)
+
+    def flush(self) -> List[DetectionInfo]:
+        """Take everything, whether or not it's finished waiting."""
+        ready = self._closed + list(self._open.values())
+        self._closed = []
+        self._open = {}
+        return self._to_events(ready)
+
+    @staticmethod
+    def _to_events(windows: List[_Window]) -> List[DetectionInfo]:
+        events = [w.to_event() for w in sorted(windows, key=lambda w: w.start)]
+        for e in events:
+            if e.sources:
+                logger.info(f"Merged {len(e.sources)} alerts into one {e.duration:.0f}s capture of cameras "
+                            f"{e.camera_ids}")
+        return events
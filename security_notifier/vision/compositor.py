@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import math
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from security_notifier.config import Config
+
+
+class FrameCompositor:
+    """Tiles a frame from each camera into one output frame, `columns` cameras to a row.
+
+    The output canvas is allocated once, up front, and every frame is copied into its slot in place, so writing a
+    frame doesn't allocate anything. Each slot is `tile_size` (width, height); frames of any other size are resized
+    into a buffer kept for that camera. Slots left over in the last row stay black.
+
+    With a single camera there's nothing to tile, and frames are passed through untouched."""
+
+    def __init__(self,
+                 num_cameras: int,
+                 tile_size: Tuple[int, int],
+                 columns: Optional[int] = None,
+                 channels: int = 3,
+                 dtype=np.uint8):
+        self.num_cameras = num_cameras
+        self.tile_width, self.tile_height = tile_size
+        self.columns = min(columns or num_cameras, num_cameras)
+        self.rows = math.ceil(num_cameras / self.columns)
+
+        self.canvas = np.zeros((self.rows * self.tile_height, self.columns * self.tile_width, channels), dtype=dtype)
+        self._slots = [self.canvas[r * self.tile_height:(r + 1) * self.tile_height,
+                                   c * self.tile_width:(c + 1) * self.tile_width]
+                       for r, c in (divmod(i, self.columns) for i in range(num_cameras))]
+        self._resized: List[Optional[np.ndarray]] = [None] * num_cameras
+
+    @staticmethod
+    def from_config(imgs: List[np.ndarray]) -> FrameCompositor:
+        """A compositor for frames like `imgs`. Unless the config says otherwise, the tiles are the size of the first
+        camera's frames, all in one row."""
+        cfg = Config.instance()
+        height, width = imgs[0].shape[:2]
+        tile_size = (cfg.get("stream_capture.tile_width", width), cfg.get("stream_capture.tile_height", height))
+        return FrameCompositor(len(imgs),
+                               tile_size,
+                               columns=cfg.get("stream_capture.grid_columns", None),
+                               channels=imgs[0].shape[2] if imgs[0].ndim == 3 else 1,
+                               dtype=imgs[0].dtype)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """The output frame's (width, height), as `cv2.VideoWriter` wants it."""
+        if self.num_cameras == 1:
+            return self.tile_width, self.tile_height
+        return self.canvas.shape[1], self.canvas.shape[0]
+
+    def _fit(self, idx: int, img: np.ndarray) -> np.ndarray:
+        if img.shape[:2] == (self.tile_height, self.tile_width):
+            return img
+
+        if self._resized[idx] is None:
+            self._resized[idx] = np.empty((self.tile_height, self.tile_width) + img.shape[2:], dtype=img.dtype)
+        return cv2.resize(img, (self.tile_width, self.tile_height), dst=self._resized[idx],
+                          interpolation=cv2.INTER_AREA)
+
+    def compose(self, imgs: List[np.ndarray]) -> np.ndarray:
+        """Tile `imgs` into the canvas and return it. The canvas is reused, so it's only valid until the next call."""
+        if self.num_cameras == 1:
+            return self._fit(0, imgs[0])
+
+        for idx, (slot, img) in enumerate(zip(self._slots, imgs)):
+            np.copyto(slot, self._fit(idx, img))
+        return self.canvas
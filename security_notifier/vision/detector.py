@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import queue
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Sequence, Text, Tuple
+
+import cv2
+import numpy as np
+
+from security_notifier.config import Config
+from security_notifier.log_helper import get_logger
+
+logger = get_logger(__name__)
+
+COCO_LABELS = [
+    "person", "bicycle", "car", "motorcycle", "airplane", "bus", "train", "truck", "boat", "traffic light",
+    "fire hydrant", "stop sign", "parking meter", "bench", "bird", "cat", "dog", "horse", "sheep", "cow", "elephant",
+    "bear", "zebra", "giraffe", "backpack", "umbrella", "handbag", "tie", "suitcase", "frisbee", "skis", "snowboard",
+    "sports ball", "kite", "baseball bat", "baseball glove", "skateboard", "surfboard", "tennis racket", "bottle",
+    "wine glass", "cup", "fork", "knife", "spoon", "bowl", "banana", "apple", "sandwich", "orange", "broccoli",
+    "carrot", "hot dog", "pizza", "donut", "cake", "chair", "couch", "potted plant", "bed", "dining table", "toilet",
+    "tv", "laptop", "mouse", "remote", "keyboard", "cell phone", "microwave", "oven", "toaster", "sink",
+    "refrigerator", "book", "clock", "vase", "scissors", "teddy bear", "hair drier", "toothbrush",
+]
+
+
+@dataclass
+class Detection:
+    label: Text
+    confidence: float
+    # x, y, width, height in the original frame's pixels.
+    box: Tuple[int, int, int, int]
+
+
+class ObjectDetector:
+    """A YOLO-style object detector, run on the CPU with OpenCV's DNN module.
+
+    `model` is anything `cv2.dnn.readNet` can load - in practice an ONNX export of YOLOv5 or YOLOv8. Their outputs are
+    laid out differently: YOLOv8 gives (batch, 4 + classes, anchors) and YOLOv5 (batch, anchors, 5 + classes), with an
+    objectness score before the class scores, so `output_format` has to say which it is.
+
+    Only detections whose label is in `classes` (if given) and that score at least `confidence` are kept."""
+
+    def __init__(self,
+                 model: Text,
+                 labels: Sequence[Text] = COCO_LABELS,
+                 input_size: Tuple[int, int] = (640, 640),
+                 confidence: float = 0.5,
+                 nms_threshold: float = 0.45,
+                 classes: Optional[Sequence[Text]] = None,
+                 output_format: Text = "yolov8"):
+        self.labels = list(labels)
+        self.input_size = tuple(input_size)
+        self.confidence = confidence
+        self.nms_threshold = nms_threshold
+        self.classes = set(classes) if classes is not None else None
+        self.output_format = output_format
+
+        self.net = cv2.dnn.readNet(str(model))
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+    @staticmethod
+    def from_config() -> Optional[ObjectDetector]:
+        """The detector described by the `[detector]` config, or None if there's no `detector.model`."""
+        cfg = Config.instance()
+        model = cfg.get("detector.model", None)
+        if model is None:
+            return None
+
+        labels_file = cfg.get("detector.labels_file", None)
+        labels = Path(labels_file).read_text().splitlines() if labels_file is not None else COCO_LABELS
+        return ObjectDetector(model,
+                              labels=labels,
+                              input_size=tuple(cfg.get("detector.input_size", [640, 640])),
+                              confidence=cfg.get("detector.confidence", 0.5),
+                              nms_threshold=cfg.get("detector.nms_threshold", 0.45),
+                              classes=cfg.get("detector.classes", None),
+                              output_format=cfg.get("detector.output_format", "yolov8"))
+
+    def _label(self, class_id: int) -> Text:
+        return self.labels[class_id] if class_id < len(self.labels) else f"class_{class_id}"
+
+    def _parse(self, output: np.ndarray, frame_shape: Tuple[int, ...]) -> List[Detection]:
+        """Turn one frame's worth of raw output into detections, in the frame's own coordinates."""
+        if self.output_format == "yolov5":
+            boxes, objectness, scores = output[:, :4], output[:, 4:5], output[:, 5:]
+            scores = scores * objectness
+        else:
+            output = output.T
+            boxes, scores = output[:, :4], output[:, 4:]
+
+        class_ids = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), class_ids]
+        keep = confidences >= self.confidence
+        if not keep.any():
+            return []
+
+        x_scale = frame_shape[1] / self.input_size[0]
+        y_scale = frame_shape[0] / self.input_size[1]
+        cx, cy, w, h = boxes[keep].T
+        rects = np.stack([(cx - w / 2) * x_scale, (cy - h / 2) * y_scale, w * x_scale, h * y_scale], axis=1)
+        confidences, class_ids = confidences[keep], class_ids[keep]
+
+        indices = cv2.dnn.NMSBoxes(rects.tolist(), confidences.tolist(), self.confidence, self.nms_threshold)
+        detections = []
+        for i in np.array(indices).flatten():
+            label = self._label(int(class_ids[i]))
+            if self.classes is None or label in self.classes:
+                detections.append(Detection(label, float(confidences[i]), tuple(int(v) for v in rects[i])))
+        return detections
+
+    def detect(self, frames: List[np.ndarray]) -> List[List[Detection]]:
+        """Run the detector over a batch of frames at once: one forward pass for all of them."""
+        if not frames:
+            return []
+
+        blob = cv2.dnn.blobFromImages(frames, 1 / 255, self.input_size, swapRB=True, crop=False)
+        self.net.setInput(blob)
+        outputs = self.net.forward()
+        return [self._parse(out, frame.shape) for out, frame in zip(outputs, frames)]
+
+
+class DetectionBatcher:
+    """Runs a detector over every `frame_stride`th set of frames from a capture, `batch_size` frames at a time.
+
+    Frames from all of the capture's cameras go into the same batches. On the CPU, batching doesn't make the forward
+    pass any cheaper per frame (see the detector benchmark), so frames go one at a time unless asked otherwise. A
+    higher stride means fewer frames to look at and a better chance of missing something brief."""
+
+    def __init__(self, detector: ObjectDetector, frame_stride: int = 5, batch_size: int = 1):
+        self.detector = detector
+        self.frame_stride = max(1, frame_stride)
+        self.batch_size = max(1, batch_size)
+
+        self._pending: List[np.ndarray] = []
+        self._sets_seen = 0
+        self.frames_analysed = 0
+        self.detections: List[Detection] = []
+
+    def add(self, frames: List[np.ndarray]):
+        """Add the next set of frames (one per camera)."""
+        if self.skip():
+            return
+        self._take(frames)
+
+    def skip(self) -> bool:
+        """Count the next set of frames, and say whether the stride skips it."""
+        self._sets_seen += 1
+        return bool((self._sets_seen - 1) % self.frame_stride)
+
+    def _take(self, frames: List[np.ndarray]):
+        self._pending.extend(frames)
+        while len(self._pending) >= self.batch_size:
+            self._run(self._pending[:self.batch_size])
+            self._pending = self._pending[self.batch_size:]
+
+    def _run(self, frames: List[np.ndarray]):
+        for detections in self.detector.detect(frames):
+            self.detections.extend(detections)
+        self.frames_analysed += len(frames)
+
+    def finish(self) -> Counter:
+        """Run whatever's left, and count how many times each label was seen."""
+        if self._pending:
+            self._run(self._pending)
+            self._pending = []
+        return Counter(d.label for d in self.detections)
+
+
+class DetectionWorker:
+    """Runs a `DetectionBatcher` on a thread of its own, so inference never holds up writing the capture.
+
+    Up to `max_pending` sets of frames can wait for the detector. If it falls further behind than that, further sets are
+    dropped (and counted), rather than the capture waiting for it. If the detector raises, we log it and stop looking:
+    the capture itself is fine, it just won't have any labels."""
+
+    def __init__(self, batcher: DetectionBatcher, max_pending: int = 16):
+        self.batcher = batcher
+        self.dropped = 0
+        self.failed = False
+        self._queue: queue.Queue = queue.Queue(max(1, max_pending))
+        self._thread = threading.Thread(target=self._run, name="detector", daemon=True)
+        self._thread.start()
+
+    def add(self, frames: List[np.ndarray]):
+        """Queue the next set of frames (one per camera), if the batcher's stride wants it."""
+        if self.failed or self.batcher.skip():
+            return
+        try:
+            self._queue.put_nowait(frames)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            frames = self._queue.get()
+            if frames is None:
+                return
+            if self.failed:
+                continue
+            try:
+                self.batcher._take(frames)
+            except Exception as err:
+                logger.error(f"Object detection failed, so this capture won't be labelled: {err!r}")
+                self.failed = True
+
+    def _stop(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def cancel(self):
+        """Stop looking, without waiting for the detector to get through what's queued. Does nothing once finished."""
+        self.failed = self.failed or self._thread.is_alive()
+        self._stop()
+
+    def finish(self) -> Optional[Counter]:
+        """Wait for the detector to catch up, and count how many times each label was seen. None if it failed."""
+        self._stop()
+        if self.dropped:
+            logger.warning(f"The detector fell behind, and skipped {self.dropped} sets of frames")
+        if self.failed:
+            return None
+
+        try:
+            return self.batcher.finish()
+        except Exception as err:
+            logger.error(f"Object detection failed, so this capture won't be labelled: {err!r}")
+            self.failed = True
+            return None
+
+
+_detector: Optional[ObjectDetector] = None
+_detector_loaded = False
+
+
+def get_detector() -> Optional[ObjectDetector]:
+    """This process's detector, loaded the first time it's asked for. None if detection isn't configured."""
+    global _detector, _detector_loaded
+    if not _detector_loaded:
+        _detector = ObjectDetector.from_config()
+        _detector_loaded = True
+        if _detector is not None:
+            logger.info(f"Loaded object detector from {Config.instance().get('detector.model')}")
+    return _detector
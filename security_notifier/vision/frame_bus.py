@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import sys
+import time
+import uuid
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from typing import List, Optional, Text, Tuple
+
+import numpy as np
+
+from security_notifier.config import Config
+from security_notifier.log_helper import get_logger
+
+logger = get_logger(__name__)
+
+_HEADER = np.dtype([("write_seq", "<i8"), ("slots", "<i8"), ("frame_bytes", "<i8"), ("closed", "<i8")])
+_SLOT = np.dtype([
+    ("seq", "<i8"),
+    ("camera_id", "<i4"),
+    ("height", "<i4"),
+    ("width", "<i4"),
+    ("channels", "<i4"),
+    ("timestamp", "<f8"),
+    ("event_key", "S64"),
+])
+_ALIGN = 64
+
+# A slot that's being written has this sequence number, so readers know to leave it alone.
+_WRITING = -1
+
+
+def _align(n: int) -> int:
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+@dataclass
+class FrameMeta:
+    sequence: int
+    camera_id: int
+    timestamp: float
+    event_key: Text
+
+
+class FrameBus:
+    """A ring buffer of frames in shared memory, written by one capture process and read by any number of others.
+
+    The bus has a fixed number of slots, each big enough for one `frame_bytes` frame plus its metadata. The writer
+    fills them in turn, overwriting the oldest, and never waits for readers: a reader that falls more than a ring's
+    worth behind skips ahead (see `FrameSubscriber`). Readers get numpy views straight onto the shared memory, so a
+    frame is never copied between processes. Writers can avoid copying too, by decoding straight into `reserve()`.
+
+    Each slot is guarded by its sequence number, seqlock style: it's set to -1 while the slot is being written and
+    to the frame's sequence number once it's done, so a reader can always tell whether what it's looking at is still
+    the frame it asked for.
+
+    One process `create`s the bus, and is responsible for `unlink`ing it. Everyone else `attach`es by name."""
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self._shm = shm
+        self.owner = owner
+        self.name = shm.name
+
+        self._header = np.ndarray((), dtype=_HEADER, buffer=shm.buf)
+        self.slots = int(self._header["slots"])
+        self.frame_bytes = int(self._header["frame_bytes"])
+
+        slots_offset = _align(_HEADER.itemsize)
+        self._meta = np.ndarray((self.slots,), dtype=_SLOT, buffer=shm.buf, offset=slots_offset)
+        self._frames_offset = _align(slots_offset + self.slots * _SLOT.itemsize)
+        self._reserved: Optional[int] = None
+
+    @staticmethod
+    def create(slots: int, frame_bytes: int, name: Optional[Text] = None) -> FrameBus:
+        """Create a bus. If there's already one called `name` (left behind by a run that didn't shut down cleanly),
+        it's replaced."""
+        size = _align(_align(_HEADER.itemsize) + slots * _SLOT.itemsize) + slots * _align(frame_bytes)
+        name = name or f"sn_frames_{uuid.uuid4().hex[:12]}"
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            logger.warning(f"Replacing the stale frame bus {name}")
+            FrameBus.attach(name).unlink(force=True)
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        header = np.ndarray((), dtype=_HEADER, buffer=shm.buf)
+        header["write_seq"] = 0
+        header["slots"] = slots
+        header["frame_bytes"] = _align(frame_bytes)
+        header["closed"] = 0
+        del header
+
+        bus = FrameBus(shm, owner=True)
+        bus._meta["seq"] = _WRITING
+        return bus
+
+    @staticmethod
+    def attach(name: Text) -> FrameBus:
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+            # Before 3.13, attaching registers the segment with this process's resource tracker too, which would
+            # delete it out from under everyone else when we exit. It's the creator's to clean up.
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return FrameBus(shm, owner=False)
+
+    @property
+    def write_seq(self) -> int:
+        """The sequence number the next frame will get."""
+        return int(self._header["write_seq"])
+
+    @property
+    def closed(self) -> bool:
+        return bool(self._header["closed"])
+
+    def _frame_view(self, slot: int, shape: Tuple[int, ...]) -> np.ndarray:
+        offset = self._frames_offset + slot * self.frame_bytes
+        return np.ndarray(shape, dtype=np.uint8, buffer=self._shm.buf, offset=offset)
+
+    def reserve(self, shape: Tuple[int, ...]) -> np.ndarray:
+        """Get the next slot to write a frame of `shape` into - e.g. `capture.read(image=...)` - then `commit` it."""
+        if int(np.prod(shape)) > self.frame_bytes:
+            raise ValueError(f"A {shape} frame won't fit in the bus's {self.frame_bytes} byte slots")
+
+        seq = self.write_seq
+        slot = seq % self.slots
+        self._meta[slot]["seq"] = _WRITING
+        self._meta[slot]["height"], self._meta[slot]["width"] = shape[:2]
+        self._meta[slot]["channels"] = shape[2] if len(shape) > 2 else 1
+        self._reserved = seq
+        return self._frame_view(slot, shape)
+
+    def commit(self, camera_id: int, timestamp: float, event_key: Text = "") -> int:
+        """Publish the frame written to the last `reserve`d slot. Returns its sequence number."""
+        if self._reserved is None:
+            raise RuntimeError("Nothing has been reserved")
+
+        seq, self._reserved = self._reserved, None
+        slot = self._meta[seq % self.slots]
+        slot["camera_id"] = camera_id
+        slot["timestamp"] = timestamp
+        slot["event_key"] = event_key.encode()[:_SLOT["event_key"].itemsize]
+        slot["seq"] = seq
+        self._header["write_seq"] = seq + 1
+        return seq
+
+    def publish(self, frame: np.ndarray, camera_id: int, timestamp: float, event_key: Text = "") -> int:
+        """Copy a frame into the bus. Returns its sequence number."""
+        np.copyto(self.reserve(frame.shape), frame)
+        return self.commit(camera_id, timestamp, event_key)
+
+    def read(self, seq: int) -> Optional[Tuple[FrameMeta, np.ndarray]]:
+        """The frame with sequence number `seq`, if it's still in the ring."""
+        slot = self._meta[seq % self.slots]
+        if int(slot["seq"]) != seq:
+            return None
+
+        channels = int(slot["channels"])
+        shape = (int(slot["height"]), int(slot["width"])) + ((channels,) if channels > 1 else ())
+        meta = FrameMeta(seq, int(slot["camera_id"]), float(slot["timestamp"]), slot["event_key"].decode())
+        frame = self._frame_view(seq % self.slots, shape)
+
+        # Check it wasn't overwritten while we were reading the metadata.
+        return (meta, frame) if self.is_current(meta) else None
+
+    def is_current(self, meta: FrameMeta) -> bool:
+        """Whether the frame `meta` describes is still there, i.e. the writer hasn't lapped it since it was read."""
+        return int(self._meta[meta.sequence % self.slots]["seq"]) == meta.sequence
+
+    def mark_closed(self):
+        """Tell readers nothing more is coming."""
+        self._header["closed"] = 1
+
+    def close(self):
+        # The numpy views have to go before the shared memory can be closed.
+        self._header = self._meta = None
+        self._shm.close()
+
+    def unlink(self, force: bool = False):
+        if self.owner or force:
+            if not self.owner and sys.version_info < (3, 13):
+                # `attach` took it off the resource tracker's books, and unlinking would try to do the same.
+                resource_tracker.register(self._shm._name, "shared_memory")
+            self._shm.unlink()
+
+
+class FrameSubscriber:
+    """Reads frames from a `FrameBus`, in order, starting from the newest frame at the time it subscribes.
+
+    `next()` returns views onto the bus's memory rather than copies. They're only good until the writer comes round
+    the ring again: check `bus.is_current(meta)` after using one if that matters, or pass `copy=True`. If the reader
+    falls so far behind that frames are overwritten before it gets to them, it skips to the oldest frame still there
+    and counts the rest in `dropped`."""
+
+    def __init__(self, bus: FrameBus, poll_interval: float = 0.001):
+        self.bus = bus
+        self.poll_interval = poll_interval
+        self.cursor = bus.write_seq
+        self.dropped = 0
+
+    def next(self, timeout: Optional[float] = None, copy: bool = False) -> Optional[Tuple[FrameMeta, np.ndarray]]:
+        """Wait for the next frame. Returns None on timeout, or once the bus is closed and we've read everything."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            write_seq = self.bus.write_seq
+            if self.cursor < write_seq:
+                oldest = max(0, write_seq - self.bus.slots)
+                if self.cursor < oldest:
+                    self.dropped += oldest - self.cursor
+                    self.cursor = oldest
+
+                result = self.bus.read(self.cursor)
+                self.cursor += 1
+                if result is None:
+                    self.dropped += 1
+                    continue
+
+                meta, frame = result
+                return (meta, frame.copy()) if copy else result
+
+            if self.bus.closed or (deadline is not None and time.monotonic() >= deadline):
+                return None
+            time.sleep(self.poll_interval)
+
+
+_worker_bus: Optional[FrameBus] = None
+
+
+def frame_bus_names(count: Optional[int] = None) -> List[Text]:
+    """The names of the capture workers' buses, for `FrameBus.attach`: `frame_bus.name`, then the worker's number,
+    e.g. `sn_frames_0`. There's one per capture process (`stream_capture.max_capture_processes`, unless `count` says
+    otherwise)."""
+    cfg = Config.instance()
+    if count is None:
+        count = cfg.get("stream_capture.max_capture_processes", 5)
+    prefix = cfg.get("frame_bus.name", "sn_frames")
+    return [f"{prefix}_{i}" for i in range(count)]
+
+
+def attach_worker_bus(name: Text):
+    """Called as each capture worker starts, with the bus it's to publish to."""
+    global _worker_bus
+    _worker_bus = FrameBus.attach(name)
+
+
+def get_worker_bus() -> Optional[FrameBus]:
+    """The bus this capture worker publishes frames to, if the pool gave it one."""
+    return _worker_bus
+
+
+def frame_bus_settings() -> Optional[Tuple[int, int]]:
+    """(slots, frame_bytes) for each capture worker's bus, or None if `frame_bus.enabled` is off."""
+    cfg = Config.instance()
+    if not cfg.get("frame_bus.enabled", False):
+        return None
+    return cfg.get("frame_bus.slots", 32), cfg.get("frame_bus.max_frame_bytes", 1920 * 1080 * 3)
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Text, Tuple
+
+import cv2
+
+from security_notifier.log_helper import get_logger
+from .utils import NoFrameFromFeedException
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class CopyStats:
+    packets_read: int = 0
+    packets_written: int = 0
+    # Packets before the first keyframe, which can't be decoded without what came before them.
+    packets_skipped: int = 0
+    stream_seconds: float = 0.0
+
+
+def open_passthrough_capture(uri: Text) -> cv2.VideoCapture:
+    """Open a feed without decoding it: `read()` then returns each compressed packet as it arrived."""
+    return cv2.VideoCapture(uri, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+
+
+@dataclass
+class StreamFormat:
+    """What a packet writer needs to know about the stream the packets came from."""
+    fourcc: int
+    fps: float
+    size: Tuple[int, int]
+
+    @staticmethod
+    def of(capture: cv2.VideoCapture, fps: float) -> Optional[StreamFormat]:
+        """`capture`'s format, if the backend can tell us. `fps` is the fallback if it doesn't know the frame rate."""
+        fourcc = int(capture.get(cv2.CAP_PROP_FOURCC))
+        size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        if fourcc == 0 or 0 in size:
+            return None
+        return StreamFormat(fourcc, capture.get(cv2.CAP_PROP_FPS) or fps, size)
+
+
+def open_raw_writer(output_path: Path, stream_format: StreamFormat) -> Optional[cv2.VideoWriter]:
+    """A writer that muxes packets in `stream_format` straight into `output_path`. Returns None if the backend can't
+    do that for this codec."""
+    writer = cv2.VideoWriter(str(output_path), cv2.CAP_FFMPEG, stream_format.fourcc, stream_format.fps,
+                             stream_format.size, [cv2.VIDEOWRITER_PROP_RAW_VIDEO, 1])
+    if not writer.isOpened():
+        writer.release()
+        return None
+    return writer
+
+
+def open_passthrough_writer(capture: cv2.VideoCapture, output_path: Path, fps: float) -> Optional[cv2.VideoWriter]:
+    """A writer that muxes `capture`'s packets straight into `output_path`, in the same codec. Returns None if the
+    backend can't do that for this stream, in which case it'll have to be decoded and re-encoded after all."""
+    stream_format = StreamFormat.of(capture, fps)
+    return open_raw_writer(output_path, stream_format) if stream_format is not None else None
+
+
+def copy_stream(capture: cv2.VideoCapture,
+                writer: cv2.VideoWriter,
+                end_time: float,
+                stream_length: Optional[float] = None) -> CopyStats:
+    """Copy packets from `capture` to `writer` until `end_time`, or with `stream_length` until that many seconds of
+    the stream (by its own timestamps) have been copied - see `CapturePipeline`, which this mirrors.
+
+    Nothing is decoded or encoded, so unlike the pipeline there's no need for a separate reader thread: copying a
+    packet costs next to nothing next to waiting for the next one. Copying starts at the first keyframe."""
+    stats = CopyStats()
+    first_position = None
+
+    while time.time() < end_time:
+        ret, packet = capture.read()
+        if not ret:
+            if stream_length is None or stats.packets_read == 0:
+                raise NoFrameFromFeedException("Failed to read a packet from the RTSP feed.")
+            break
+        stats.packets_read += 1
+
+        if stream_length is not None:
+            position = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            first_position = position if first_position is None else first_position
+            if position - first_position >= stream_length:
+                break
+            stats.stream_seconds = position - first_position
+
+        if stats.packets_written == 0 and not capture.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+            stats.packets_skipped += 1
+            continue
+
+        writer.write(packet)
+        stats.packets_written += 1
+
+    return stats
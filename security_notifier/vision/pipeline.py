@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from security_notifier.log_helper import get_logger
+from .utils import NoFrameFromFeedException
+
+logger = get_logger(__name__)
+
+TimedFrame = Tuple[float, np.ndarray]
+
+
+@dataclass
+class CaptureStats:
+    frames_read: List[int] = field(default_factory=list)
+    frames_dropped: List[int] = field(default_factory=list)
+    frames_written: int = 0
+    frames_late: int = 0
+    # How far into the stream (by its own timestamps) the slowest camera got, in seconds.
+    stream_seconds: float = 0.0
+
+
+class FrameReader(threading.Thread):
+    """Reads frames from one camera as fast as they arrive, into a bounded ring buffer.
+
+    If the encoder falls behind and the buffer fills, the oldest frame is dropped (and counted) rather than blocking
+    the read, so the RTSP client's own buffer never overruns.
+
+    If `stream_length` is given, we're reading recorded footage as fast as it'll come rather than a live feed. The
+    reader then stops on the stream's own timestamps, once it's `stream_length` seconds past the first frame (or when
+    the stream ends), and a full buffer makes it wait rather than drop frames, since there's no live feed to fall
+    behind."""
+
+    def __init__(self,
+                 camera_idx: int,
+                 capture,
+                 buffer_size: int,
+                 stop: threading.Event,
+                 stream_length: Optional[float] = None):
+        super().__init__(name=f"frame-reader-{camera_idx}", daemon=True)
+        self.camera_idx = camera_idx
+        self.capture = capture
+        self.stop = stop
+        self.stream_length = stream_length
+
+        self.frames: Deque[TimedFrame] = deque(maxlen=buffer_size)
+        self._available = threading.Condition()
+        self.finished = False
+        self.error: Optional[Exception] = None
+
+        self.read_count = 0
+        self.dropped_count = 0
+        self.stream_seconds = 0.0
+
+    def _past_end(self) -> bool:
+        position = self.capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        if self._first_position is None:
+            self._first_position = position
+        self.stream_seconds = position - self._first_position
+        return self.stream_seconds >= self.stream_length
+
+    def run(self):
+        self._first_position: Optional[float] = None
+        try:
+            while not self.stop.is_set():
+                ret, img = self.capture.read()
+                if not ret:
+                    # Recorded playback ends when the DVR gets to the URL's `endtime`, which is how it should end.
+                    if self.stream_length is None or self.read_count == 0:
+                        self.error = NoFrameFromFeedException(
+                            f"Failed to capture frame from RTSP feed for capture {self.camera_idx}.")
+                    break
+
+                if self.stream_length is not None and self._past_end():
+                    break
+
+                with self._available:
+                    if self.stream_length is not None:
+                        self._available.wait_for(lambda: len(self.frames) < self.frames.maxlen or self.stop.is_set())
+                    elif len(self.frames) == self.frames.maxlen:
+                        self.dropped_count += 1
+                    self.frames.append((time.monotonic(), img))
+                    self.read_count += 1
+                    self._available.notify_all()
+        except Exception as e:
+            # Otherwise the capture would just look as if it had come to an end.
+            logger.exception(f"Frame reader for capture {self.camera_idx} failed")
+            self.error = NoFrameFromFeedException(
+                f"Failed to read from the RTSP feed for capture {self.camera_idx}: {e}")
+        finally:
+            with self._available:
+                self.finished = True
+                self._available.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[TimedFrame]:
+        """Wait for the next frame. Returns None once the reader has stopped and its buffer is empty. Raises
+        `NoFrameFromFeedException` if the feed stalls for `timeout` seconds, or the reader has died."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._available:
+            while not self.frames and not self.finished:
+                if not self.is_alive():
+                    raise NoFrameFromFeedException(f"The frame reader for capture {self.camera_idx} has died.")
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise NoFrameFromFeedException(
+                        f"No frame from the RTSP feed for capture {self.camera_idx} in {timeout}s.")
+                # Waking up every so often to check on the reader.
+                self._available.wait(1.0 if remaining is None else min(remaining, 1.0))
+            if self.frames:
+                frame = self.frames.popleft()
+                self._available.notify_all()
+                return frame
+            return None
+
+    def cancel(self):
+        """Tell the reader to stop, waking it if it's waiting for room in the buffer."""
+        with self._available:
+            self.stop.set()
+            self._available.notify_all()
+
+
+class CapturePipeline:
+    """Reads from a set of cameras on one thread each, and hands a frame from every camera at a time to `write`, on
+    the calling thread, until `end_time`. Encoding latency therefore no longer holds up reading.
+
+    A set of frames counts as late if the oldest of them had been waiting for more than `late_threshold` seconds by
+    the time it was written. If a camera goes `frame_timeout` seconds without a frame, the capture fails with
+    `NoFrameFromFeedException`, so it can be retried, rather than hanging.
+
+    With `stream_length`, the captures are recorded footage to be read as fast as they can be delivered, and reading
+    stops on the stream timestamps (see `FrameReader`). `end_time` is then just a safety net, for a stream that stalls
+    or doesn't report timestamps."""
+
+    def __init__(self,
+                 captures: List,
+                 write: Callable[[List[np.ndarray]], None],
+                 buffer_size: int = 64,
+                 late_threshold: float = 1.0,
+                 frame_timeout: float = 10.0):
+        self.captures = captures
+        self.write = write
+        self.buffer_size = buffer_size
+        self.late_threshold = late_threshold
+        self.frame_timeout = frame_timeout
+
+    def run(self, end_time: float, stream_length: Optional[float] = None) -> CaptureStats:
+        stop = threading.Event()
+        readers = [FrameReader(i, c, self.buffer_size, stop, stream_length) for i, c in enumerate(self.captures)]
+        stats = CaptureStats()
+
+        for r in readers:
+            r.start()
+
+        try:
+            while time.time() < end_time:
+                frames = [r.get(self.frame_timeout) for r in readers]
+                failed = [r for r, f in zip(readers, frames) if f is None]
+                if failed:
+                    if failed[0].error is not None:
+                        raise failed[0].error
+                    break
+
+                if time.monotonic() - min(t for t, _ in frames) > self.late_threshold:
+                    stats.frames_late += 1
+
+                self.write([img for _, img in frames])
+                stats.frames_written += 1
+        finally:
+            for r in readers:
+                r.cancel()
+            # The readers have to be finished with the captures before anyone releases them.
+            for r in readers:
+                r.join()
+
+        stats.frames_read = [r.read_count for r in readers]
+        stats.frames_dropped = [r.dropped_count for r in readers]
+        stats.stream_seconds = min(r.stream_seconds for r in readers)
+        return stats
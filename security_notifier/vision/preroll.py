@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from security_notifier.config import Config
+from security_notifier.imap import DetectionInfo
+from security_notifier.log_helper import get_logger
+from .passthrough import StreamFormat, open_passthrough_capture, open_raw_writer
+from .utils import CaptureResult, clip_length, event_to_filename, get_live_uri
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class Packet:
+    data: np.ndarray
+    # When it arrived, by our clock.
+    timestamp: float
+    keyframe: bool
+
+
+class PacketRing:
+    """The last `max_seconds` of a stream's compressed packets, up to `max_bytes` of them.
+
+    Packets are dropped from the front a whole GOP at a time, so the oldest packet is always a keyframe and anything
+    handed out can be decoded from the start."""
+
+    def __init__(self, max_seconds: float, max_bytes: int):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._packets: Deque[Packet] = deque()
+
+    def __len__(self) -> int:
+        return len(self._packets)
+
+    @property
+    def oldest(self) -> Optional[float]:
+        return self._packets[0].timestamp if self._packets else None
+
+    @property
+    def newest(self) -> Optional[float]:
+        return self._packets[-1].timestamp if self._packets else None
+
+    def append(self, packet: Packet):
+        if not self._packets and not packet.keyframe:
+            # Nothing can be decoded until the first keyframe.
+            return
+
+        self._packets.append(packet)
+        self.nbytes += packet.data.nbytes
+
+        cutoff = packet.timestamp - self.max_seconds
+        while self._packets and (self._packets[0].timestamp < cutoff or self.nbytes > self.max_bytes):
+            self._drop_front()
+            while self._packets and not self._packets[0].keyframe:
+                self._drop_front()
+
+    def _drop_front(self):
+        self.nbytes -= self._packets.popleft().data.nbytes
+
+    def between(self, start: float, end: float) -> List[Packet]:
+        """The packets from `start` to `end`, starting at the last keyframe at or before `start` (or the oldest, if
+        the ring doesn't go back that far)."""
+        packets = [p for p in self._packets if p.timestamp <= end]
+        first = 0
+        for i, p in enumerate(packets):
+            if p.timestamp > start:
+                break
+            if p.keyframe:
+                first = i
+        return packets[first:]
+
+    def clear(self):
+        self._packets.clear()
+        self.nbytes = 0
+
+
+class LiveRecorder:
+    """Keeps a camera's live feed running in the background, with the last `max_seconds` of it in a `PacketRing`.
+
+    The feed is read on a thread of its own, in raw mode, so nothing is decoded: holding a minute of a low-res
+    sub-stream costs a few megabytes. If the feed drops, we reconnect after `reconnect_delay` seconds (and the ring
+    starts again from empty, as the gap would confuse anything spanning it)."""
+
+    def __init__(self, camera_id: int, uri: str, max_seconds: float, max_bytes: int, reconnect_delay: float = 1,
+                 fps: float = 15):
+        self.camera_id = camera_id
+        self.uri = uri
+        self.reconnect_delay = reconnect_delay
+        self.fps = fps
+
+        self.ring = PacketRing(max_seconds, max_bytes)
+        self.stream_format: Optional[StreamFormat] = None
+        self.connected = False
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        # Guards all of the above, and is notified whenever a packet arrives.
+        self._changed = threading.Condition()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name=f"live-camera-{self.camera_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._changed:
+            self._stopping = True
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping:
+            capture = open_passthrough_capture(self.uri)
+            try:
+                stream_format = StreamFormat.of(capture, self.fps) if capture.isOpened() else None
+                if stream_format is None:
+                    logger.warning(f"Couldn't open the live feed for camera {self.camera_id}")
+                else:
+                    with self._changed:
+                        self.stream_format = stream_format
+                        self.connected = True
+                    self._read(capture)
+                    logger.warning(f"Lost the live feed for camera {self.camera_id} - reconnecting")
+            finally:
+                capture.release()
+                with self._changed:
+                    self.connected = False
+                    self.ring.clear()
+                    self._changed.notify_all()
+
+            with self._changed:
+                self._changed.wait_for(lambda: self._stopping, self.reconnect_delay)
+
+    def _read(self, capture: cv2.VideoCapture):
+        while not self._stopping:
+            ret, data = capture.read()
+            if not ret:
+                return
+            packet = Packet(data.copy(), time.time(), bool(capture.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME)))
+            with self._changed:
+                self.ring.append(packet)
+                self._changed.notify_all()
+
+    def clip(self, start: float, end: float, timeout: float) -> Optional[List[Packet]]:
+        """The packets from `start` to `end` (wall-clock times), waiting up to `timeout` seconds past `end` for them
+        to arrive. Returns None if the ring doesn't have all of them: the feed's down, or `start` has already dropped
+        out of it."""
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self._stopping or not self.connected or (self.ring.newest or 0) >= end,
+                max(0.0, end - time.time()) + timeout)
+            if not self.connected or self.ring.oldest is None or self.ring.oldest > start:
+                return None
+            return self.ring.between(start, end)
+
+
+class LiveBuffer:
+    """Captures events from the live feeds of `recorders`' cameras, rather than from the DVR's recordings.
+
+    With a live recorder per camera, a clip that starts up to the ring's length in the past is already in memory, so
+    capturing it means writing out what's buffered (from `pre_roll` seconds before the event), then whatever arrives
+    until the clip's end. There's no playback stream to set up, and nothing is decoded: the packets go into the file as
+    they came from the camera. A multi-camera event gets a file per camera.
+
+    Events we can't serve (a camera we don't record, a feed that's down, or an event whose pre-roll has already dropped
+    out of the ring) go back to being captured from the recordings."""
+
+    def __init__(self, recorders: Dict[int, LiveRecorder], pre_roll: float = 5, timeout: float = 5):
+        self.recorders = recorders
+        self.pre_roll = pre_roll
+        self.timeout = timeout
+
+    @staticmethod
+    def from_config() -> Optional[LiveBuffer]:
+        """The buffer described by the `[preroll]` config, or None if `preroll.enabled` is off."""
+        cfg = Config.instance()
+        if not cfg.get("preroll.enabled", False):
+            return None
+
+        stream_id = cfg.get("preroll.stream", 2)
+        seconds = cfg.get("preroll.seconds", 30)
+        max_bytes = int(cfg.get("preroll.max_megabytes", 32) * 1024 * 1024)
+        recorders = {
+            camera: LiveRecorder(camera, get_live_uri(camera, stream_id), seconds, max_bytes,
+                                 reconnect_delay=cfg.get("preroll.reconnect_delay", 1),
+                                 fps=cfg.get("dvr.camera_fps", 15))
+            for camera in cfg.get("preroll.cameras", [])
+        }
+        return LiveBuffer(recorders, pre_roll=cfg.get("preroll.pre_roll", 5), timeout=cfg.get("preroll.timeout", 5))
+
+    def start(self):
+        for recorder in self.recorders.values():
+            recorder.start()
+
+    def stop(self):
+        for recorder in self.recorders.values():
+            recorder.stop()
+
+    def covers(self, event: DetectionInfo) -> bool:
+        """Whether every camera in `event` has a live feed running."""
+        return all(c in self.recorders and self.recorders[c].connected for c in event.camera_ids)
+
+    def capture(self, event: DetectionInfo) -> CaptureResult:
+        """Write out the event's clip from the live feeds. Blocks until the clip's end has come round."""
+        # The alert's time is the DVR's clock, which we take to agree with ours.
+        event_time = event.date_and_time.timestamp()
+        start, end = event_time - self.pre_roll, event_time + clip_length(event)
+
+        clips = []
+        for camera in event.camera_ids:
+            recorder = self.recorders.get(camera)
+            packets = recorder.clip(start, end, self.timeout) if recorder is not None else None
+            if not packets:
+                logger.info(f"Camera {camera}'s live feed doesn't have {event} - capturing it from the recordings")
+                return CaptureResult(False)
+            clips.append((recorder, packets))
+
+        # Every writer is opened before anything's written, so a camera we can't write doesn't leave the others' files
+        # behind when the event goes to the recordings instead.
+        writers = []
+        for idx, (recorder, _) in enumerate(clips):
+            output_path = event_to_filename(event, idx if len(clips) > 1 else None)
+            writer = open_raw_writer(output_path, recorder.stream_format)
+            if writer is None:
+                logger.warning(f"Can't write camera {recorder.camera_id}'s live feed to {output_path} as it is")
+                for opened, opened_path in writers:
+                    opened.release()
+                    opened_path.unlink(missing_ok=True)
+                output_path.unlink(missing_ok=True)
+                return CaptureResult(False)
+            writers.append((writer, output_path))
+
+        for (recorder, packets), (writer, output_path) in zip(clips, writers):
+            try:
+                for packet in packets:
+                    writer.write(packet.data)
+            finally:
+                writer.release()
+            logger.info(f"Wrote {len(packets)} buffered packets from camera {recorder.camera_id} to {output_path}")
+
+        return CaptureResult(True)
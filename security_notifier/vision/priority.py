@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from security_notifier.config import Config
+from security_notifier.imap import DetectionInfo
+from security_notifier.imap.detection_info import EventType
+
+DEFAULT_TYPE_WEIGHTS = {
+    EventType.Intrusion: 10.0,
+    EventType.LineCrossing: 5.0,
+    EventType.Motion: 1.0,
+    EventType.Misc: 1.0,
+}
+
+
+@dataclass
+class CapturePriority:
+    """How important an event is to capture: the weight of its type, plus a bonus for any of its cameras that have
+    one. A merged event counts as its most important alert.
+
+    Every minute an event waits adds `aging` to its priority, so that under a steady flood of high-priority events
+    the rest are still captured eventually."""
+    type_weights: Dict[EventType, float] = field(default_factory=lambda: dict(DEFAULT_TYPE_WEIGHTS))
+    camera_weights: Dict[int, float] = field(default_factory=dict)
+    aging: float = 0.1
+
+    @staticmethod
+    def from_config() -> CapturePriority:
+        cfg = Config.instance()
+        type_weights = dict(DEFAULT_TYPE_WEIGHTS)
+        type_weights.update({EventType[k]: v for k, v in cfg.get("capture_priority.event_types", {}).items()})
+        return CapturePriority(type_weights=type_weights,
+                               camera_weights={int(k): v for k, v in cfg.get("capture_priority.cameras", {}).items()},
+                               aging=cfg.get("capture_priority.aging", 0.1))
+
+    def weight(self, event: DetectionInfo) -> float:
+        type_weight = max(self.type_weights.get(e.type, 0.0) for e in event.sources or [event])
+        camera_weight = max((self.camera_weights.get(c, 0.0) for c in event.camera_ids), default=0.0)
+        return type_weight + camera_weight
+
+
+class CaptureQueue:
+    """Events waiting to be captured, highest priority first.
+
+    An event's priority is `weight + aging * minutes_waited`. Since every event ages at the same rate, the order
+    between two events never changes while they wait, so we can order the heap by `weight - aging * enqueued_at`
+    and never have to re-sort it. Events of the same priority come out in the order they went in."""
+
+    def __init__(self, priority: Optional[CapturePriority] = None, clock: Callable[[], float] = time.monotonic):
+        self.priority = priority or CapturePriority()
+        self._clock = clock
+        self._heap: List[Tuple[float, int, DetectionInfo]] = []
+        self._seq = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, event: DetectionInfo):
+        minutes = self._clock() / 60
+        key = -(self.priority.weight(event) - self.priority.aging * minutes)
+        heapq.heappush(self._heap, (key, next(self._seq), event))
+
+    def peek(self) -> DetectionInfo:
+        return self._heap[0][2]
+
+    def pop(self) -> DetectionInfo:
+        return heapq.heappop(self._heap)[2]
+
+    def clear(self):
+        self._heap.clear()
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import random
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from security_notifier.config import Config
+from security_notifier.imap import DetectionInfo
+from security_notifier.log_helper import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class RetryPolicy:
+    base_delay: float = 5.0
+    max_delay: float = 300.0
+    jitter: float = 0.25
+    max_attempts: int = 6
+    breaker_threshold: int = 3
+    breaker_cooldown: float = 120.0
+
+    @staticmethod
+    def from_config() -> RetryPolicy:
+        cfg = Config.instance()
+        default = RetryPolicy()
+        return RetryPolicy(
+            base_delay=cfg.get("stream_capture.retry_base_delay", default.base_delay),
+            max_delay=cfg.get("stream_capture.retry_max_delay", default.max_delay),
+            jitter=cfg.get("stream_capture.retry_jitter", default.jitter),
+            max_attempts=cfg.get("stream_capture.retry_max_attempts", default.max_attempts),
+            breaker_threshold=cfg.get("stream_capture.camera_failure_threshold", default.breaker_threshold),
+            breaker_cooldown=cfg.get("stream_capture.camera_cooldown", default.breaker_cooldown),
+        )
+
+    def delay(self, attempt: int, rng: random.Random) -> float:
+        """Exponential backoff for the given (1-based) attempt, +/- `jitter` as a fraction of the delay."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1 + rng.uniform(-self.jitter, self.jitter))
+
+
+class RetryScheduler:
+    """Decides when failed captures should be tried again.
+
+    Each failure of an event pushes its next attempt further out, with jitter so a batch that failed together doesn't
+    retry together. After `max_attempts` the event is given up on and goes to `dead_letters`.
+
+    Failures are also counted per camera: after `breaker_threshold` in a row the camera's circuit opens, and nothing
+    for that camera is tried again until `breaker_cooldown` has passed. Events held back by an open circuit don't use
+    up their attempts. Any success for a camera closes its circuit."""
+
+    def __init__(self,
+                 policy: Optional[RetryPolicy] = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 rng: Optional[random.Random] = None):
+        self.policy = policy or RetryPolicy.from_config()
+        self._clock = clock
+        self._rng = rng or random.Random()
+
+        self._queue: List[Tuple[float, int, DetectionInfo]] = []
+        self._seq = itertools.count()
+        self._attempts: Dict[str, int] = {}
+
+        self._camera_failures: Dict[int, int] = {}
+        self._camera_open_until: Dict[int, float] = {}
+
+        self.dead_letters: List[DetectionInfo] = []
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _schedule(self, event: DetectionInfo, due: float):
+        heapq.heappush(self._queue, (due, next(self._seq), event))
+
+    def blocked_until(self, camera_ids: Iterable[int]) -> Optional[float]:
+        """If any of the cameras has an open circuit, when the last of them closes again."""
+        now = self._clock()
+        until = [self._camera_open_until[c] for c in camera_ids if self._camera_open_until.get(c, 0) > now]
+        return max(until) if until else None
+
+    def defer(self, event: DetectionInfo, until: float):
+        """Hold an event back until `until` without counting it as an attempt."""
+        self._schedule(event, until)
+
+    def record_success(self, event: DetectionInfo):
+        self._attempts.pop(event.key, None)
+        for c in event.camera_ids:
+            self._camera_failures.pop(c, None)
+            self._camera_open_until.pop(c, None)
+
+    def record_failure(self, event: DetectionInfo) -> Optional[float]:
+        """Schedule the next attempt for a failed event. Returns when it's due, or None if we've given up on it."""
+        now = self._clock()
+        for c in event.camera_ids:
+            self._camera_failures[c] = self._camera_failures.get(c, 0) + 1
+            # Once a circuit's cooldown is over, a single further failure is enough to open it again.
+            is_open = self._camera_open_until.get(c, 0) > now
+            if self._camera_failures[c] >= self.policy.breaker_threshold and not is_open:
+                logger.warning(f"Camera {c} has failed {self._camera_failures[c]} captures in a row - pausing it "
+                               f"for {self.policy.breaker_cooldown}s")
+                self._camera_open_until[c] = now + self.policy.breaker_cooldown
+
+        attempts = self._attempts.get(event.key, 0) + 1
+        if attempts >= self.policy.max_attempts:
+            logger.error(f"Giving up on {event} after {attempts} attempts")
+            self._attempts.pop(event.key, None)
+            self.dead_letters.append(event)
+            return None
+
+        self._attempts[event.key] = attempts
+        due = now + self.policy.delay(attempts, self._rng)
+        self._schedule(event, due)
+        return due
+
+    def next_due(self) -> Optional[float]:
+        return self._queue[0][0] if self._queue else None
+
+    def pop_due(self) -> List[DetectionInfo]:
+        """Take every event whose retry is due. Events for cameras with an open circuit are pushed back to when it
+        closes instead."""
+        now = self._clock()
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            _, _, event = heapq.heappop(self._queue)
+            blocked = self.blocked_until(event.camera_ids)
+            if blocked is not None:
+                self._schedule(event, blocked)
+            else:
+                due.append(event)
+        return due
+
+    def clear(self) -> List[DetectionInfo]:
+        """Drop everything that's waiting to be retried, returning it."""
+        events = [e for _, _, e in sorted(self._queue)]
+        self._queue.clear()
+        return events
@@ -1,4 +1,5 @@
 import datetime
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional, Text, List
 
@@ -11,25 +12,73 @@ class NoFrameFromFeedException(Exception):
     pass
 
 
-def _get_rtsp_url(event: DetectionInfo, camera_idx: int = 0) -> Text:
+@dataclass
+class CaptureResult:
+    """What a capture handler returns. It's truthy if the capture succeeded, so it can stand in for a plain bool.
+    `bitrate` is the total over all of the capture's streams, in Mbit/s, if we could measure it. `labels` are the
+    kinds of object the detector found, if it ran, and `motion_score` the motion gate's score for the clip, if it's
+    on (see `MotionGate.peak_score`)."""
+    success: bool
+    bitrate: Optional[float] = None
+    labels: Optional[List[Text]] = None
+    motion_score: Optional[float] = None
+
+    def __bool__(self) -> bool:
+        return self.success
+
+
+def clip_length(event: DetectionInfo) -> float:
+    """How many seconds of footage to capture for an event."""
+    if event.duration is not None:
+        return event.duration
+    return Config.instance().get("stream_capture.detection_clip_length", 5)
+
+
+# Hikvision's playback URL. Set `dvr.uri_template` to capture from somewhere else - e.g. a directory of video files
+# (`/path/to/footage/{camera}.mkv`) to try things out without a DVR.
+DEFAULT_URI_TEMPLATE = "rtsp://{username}:{password}@{host}:{port}/Streaming/tracks/{device_id}/" \
+                       "?starttime={start_time}&endtime={end_time}"
+
+
+# Hikvision's live view URL, for the pre-roll buffer. `preroll.uri_template` overrides it.
+LIVE_URI_TEMPLATE = "rtsp://{username}:{password}@{host}:{port}/Streaming/Channels/{device_id}"
+
+
+def _format_uri(template: Text, camera: int, stream_id: int, **kwargs) -> Text:
     cfg = Config.instance()
-    username = cfg.get("dvr.username", "admin")
 
-    password = get_dvr_password()
+    # Don't go to the keyring unless we actually need the password.
+    password = get_dvr_password() if "{password}" in template else None
+
+    return template.format(username=cfg.get("dvr.username", "admin"),
+                           password=password,
+                           host=cfg.get("dvr.host", None),
+                           port=cfg.get("dvr.rtsp_port", 554),
+                           camera=camera,
+                           stream=stream_id,
+                           device_id=f"{camera}{stream_id:02d}",
+                           **kwargs)
+
+
+def _get_rtsp_url(event: DetectionInfo, camera_idx: int = 0, stream_id: Optional[int] = None) -> Text:
+    cfg = Config.instance()
+    template = cfg.get("dvr.uri_template", DEFAULT_URI_TEMPLATE)
 
-    host = cfg.get("dvr.host")
-    port = cfg.get("dvr.rtsp_port", 554)
+    if stream_id is None:
+        stream_id = cfg.get("dvr.stream_to_capture", 1)
 
-    stream_id = cfg.get("dvr.stream_to_capture", 1)
-    device_id = f"{event.camera_ids[camera_idx]}{stream_id:02d}"
+    time_delta = datetime.timedelta(seconds=clip_length(event))
 
-    start_time = event.date_and_time.strftime("%Y%m%dT%H%M%SZ")
+    return _format_uri(template,
+                       event.camera_ids[camera_idx],
+                       stream_id,
+                       start_time=event.date_and_time.strftime("%Y%m%dT%H%M%SZ"),
+                       end_time=(event.date_and_time + time_delta).strftime("%Y%m%dT%H%M%SZ"))
 
-    time_delta = datetime.timedelta(seconds=cfg.get("stream_capture.detection_clip_length", 5))
-    end_time = (event.date_and_time + time_delta).strftime("%Y%m%dT%H%M%SZ")
 
-    return f"rtsp://{username}:{password}@{host}:{port}/Streaming/tracks/{device_id}/" \
-           f"?starttime={start_time}&endtime={end_time}"
+def get_live_uri(camera: int, stream_id: int) -> Text:
+    """The URL of a camera's live feed."""
+    return _format_uri(Config.instance().get("preroll.uri_template", LIVE_URI_TEMPLATE), camera, stream_id)
 
 
 def event_to_filename(event: DetectionInfo, camera_idx: int = 0) -> Path:
@@ -46,6 +95,8 @@ def event_to_filename(event: DetectionInfo, camera_idx: int = 0) -> Path:
     return output_directory / filename
 
 
-def get_capture_uris(event: DetectionInfo, camera_idx: Optional[int] = None) -> List[Text]:
+def get_capture_uris(event: DetectionInfo,
+                     camera_idx: Optional[int] = None,
+                     stream_id: Optional[int] = None) -> List[Text]:
     cams_to_capture = [camera_idx] if camera_idx is not None else range(len(event.camera_ids))
-    return [_get_rtsp_url(event, c) for c in cams_to_capture]
+    return [_get_rtsp_url(event, c, stream_id) for c in cams_to_capture]
@@ -0,0 +1,91 @@
+import base64
+import re
+from typing import Dict, List
+
+from security_notifier.imap.fetch import fetch_alert_texts, _parse_fetch_response
+
+ALERT_TEXT = """EVENT TYPE:      Motion Detected
+EVENT TIME:      2022-01-15,19:30:57
+CAMERA NAME(NUM):    Camera 01(A1)"""
+
+SINGLE_PART = {
+    "headers": b"Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n",
+    "TEXT": ALERT_TEXT.replace("=", "=3D").encode(),
+}
+
+MULTI_PART = {
+    "headers": b'Content-Type: multipart/mixed; boundary="XX"\r\n\r\n',
+    "1.MIME": b"Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: base64\r\n\r\n",
+    "1": base64.b64encode(ALERT_TEXT.encode()),
+}
+
+HTML_ONLY = {
+    "headers": b"Content-Type: text/html\r\n\r\n",
+    "TEXT": b"<p>hello</p>",
+}
+
+
+class FakeClient:
+    """Answers UID FETCH with responses shaped the way imaplib returns them."""
+
+    def __init__(self, messages: Dict[str, Dict[str, bytes]]):
+        self.messages = messages
+        self.commands: List[str] = []
+
+    def uid(self, command, uid_set, items):
+        self.commands.append(items)
+        data = []
+        for seq, uid in enumerate(uid_set.split(","), start=1):
+            msg = self.messages[uid]
+            sections = re.findall(r"BODY(?:\.PEEK)?\[([^\]]*)\]", items)
+            for i, section in enumerate(sections):
+                literal = msg["headers"] if section.startswith("HEADER") else msg[section]
+                start = f"{seq} (" if i == 0 else " "
+                data.append((f"{start}BODY[{section}] {{{len(literal)}}}".encode(), literal))
+            # Put the UID at the end, as some servers do.
+            data.append(f" UID {uid})".encode())
+        return "OK", data
+
+
+class FakeMailbox:
+    def __init__(self, messages):
+        self.client = FakeClient(messages)
+        self.full_fetches = []
+
+    def fetch(self, criteria):
+        self.full_fetches.append(str(criteria))
+        return []
+
+
+def test_parse_fetch_response():
+    data = [
+        (b"1 (UID 5 BODY[HEADER.FIELDS (CONTENT-TYPE)] {4}", b"abcd"),
+        (b" BODY[1] {2}", b"xy"),
+        b")",
+        (b'2 (FLAGS (\\Seen) BODY[HEADER.FIELDS ("CONTENT-TYPE")] {1}', b"z"),
+        b" UID 9)",
+    ]
+    assert _parse_fetch_response(data) == {
+        "5": {"HEADER.FIELDS": b"abcd", "1": b"xy"},
+        "9": {"HEADER.FIELDS": b"z"},
+    }
+
+
+def test_lean_fetch_decodes_text():
+    mailbox = FakeMailbox({"3": SINGLE_PART, "4": MULTI_PART})
+    messages = list(fetch_alert_texts(mailbox, ["3", "4"]))
+
+    assert [m.uid for m in messages] == ["3", "4"]
+    assert all(m.text == ALERT_TEXT for m in messages)
+    assert not mailbox.full_fetches
+    assert not any("BODY[]" in c for c in mailbox.client.commands), "Should never fetch a whole message"
+
+
+def test_lean_fetch_batches_and_falls_back():
+    mailbox = FakeMailbox({"3": SINGLE_PART, "4": HTML_ONLY, "5": SINGLE_PART})
+    messages = list(fetch_alert_texts(mailbox, ["3", "4", "5"], bulk_size=2))
+
+    assert [m.uid for m in messages] == ["3", "5"]
+    # Two batches, each with a header fetch and a body fetch
+    assert len(mailbox.client.commands) == 4
+    assert mailbox.full_fetches == ["(UID 4)"]
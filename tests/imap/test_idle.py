@@ -0,0 +1,144 @@
+import threading
+import time
+
+import pytest
+import toml
+
+import security_notifier.imap.idle
+from security_notifier.config import Config
+from security_notifier.imap.idle import wait_for_new_mail
+from security_notifier.imap.session import MailboxSession
+
+
+class FakeIdle:
+    """Hands out `responses` on the first poll of an IDLE, then nothing, as if the server had gone quiet."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.starts = 0
+        self.stops = 0
+        self.timeouts = []
+
+    def start(self):
+        self.starts += 1
+
+    def poll(self, timeout):
+        self.timeouts.append(timeout)
+        if len(self.timeouts) == 1 and self.responses:
+            return self.responses
+        time.sleep(timeout)
+        return []
+
+    def stop(self):
+        self.stops += 1
+
+
+class FakeClient:
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+        self.untagged_responses = {}
+
+
+class FakeMailbox:
+    def __init__(self, capabilities=("IMAP4REV1", "IDLE"), responses=()):
+        self.client = FakeClient(capabilities)
+        self.idle = FakeIdle(list(responses))
+
+    def logout(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def config(tmp_path, monkeypatch):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({"imap": {"idle_timeout": 0.3}}))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+
+
+def _use_mailbox(mocker, mailbox):
+    session = MailboxSession(lambda: mailbox, keepalive_interval=60)
+    mocker.patch.object(security_notifier.imap.idle, "get_session", return_value=session)
+
+
+@pytest.mark.parametrize(
+    "responses, expected",
+    (
+            ([b"* 36 EXISTS", b"* 1 RECENT"], True),
+            ([b"* 2 EXPUNGE"], False),
+            ([], False),
+    )
+)
+def test_idle_wakes_on_new_mail(mocker, responses, expected):
+    mailbox = FakeMailbox(responses=responses)
+    _use_mailbox(mocker, mailbox)
+    sleep = mocker.patch.object(security_notifier.imap.idle._stopping, "wait")
+
+    assert wait_for_new_mail(30) == expected
+    assert mailbox.idle.starts == mailbox.idle.stops == 1
+    if expected:
+        assert len(mailbox.idle.timeouts) == 1, "We should stop polling as soon as there's new mail"
+    sleep.assert_not_called()
+
+
+def test_new_mail_seen_outside_idle_is_fetched(mocker):
+    # The server announced a new message in the middle of our last FETCH, so it never reaches the IDLE.
+    mailbox = FakeMailbox()
+    mailbox.client.untagged_responses["EXISTS"] = [b"37"]
+    _use_mailbox(mocker, mailbox)
+
+    assert wait_for_new_mail(30)
+    assert not mailbox.idle.starts, "There's no need to IDLE when we already know there's new mail"
+    assert "EXISTS" not in mailbox.client.untagged_responses
+
+    # Having been seen once, it doesn't wake us again.
+    assert not wait_for_new_mail(30)
+    assert mailbox.idle.starts == 1
+
+
+def test_falls_back_to_polling_without_idle(mocker):
+    mailbox = FakeMailbox(capabilities=("IMAP4REV1",))
+    _use_mailbox(mocker, mailbox)
+    sleep = mocker.patch.object(security_notifier.imap.idle._stopping, "wait")
+
+    assert wait_for_new_mail(30)
+    sleep.assert_called_once_with(30)
+    assert not mailbox.idle.starts
+
+
+def test_polling_wait_is_interrupted(mocker):
+    mailbox = FakeMailbox(capabilities=("IMAP4REV1",))
+    _use_mailbox(mocker, mailbox)
+
+    security_notifier.imap.idle.interrupt_waits()
+    try:
+        started = time.monotonic()
+        assert wait_for_new_mail(30)
+        assert time.monotonic() - started < 1
+    finally:
+        security_notifier.imap.idle.reset_waits()
+
+
+def test_idle_is_interrupted(tmp_path, monkeypatch, mocker):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({"imap": {"idle_timeout": 300}}))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    mailbox = FakeMailbox()
+    _use_mailbox(mocker, mailbox)
+
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(wait_for_new_mail(30)))
+    waiter.start()
+    try:
+        time.sleep(0.2)
+        started = time.monotonic()
+        security_notifier.imap.idle.interrupt_waits()
+        waiter.join(timeout=5)
+        assert not waiter.is_alive()
+        assert time.monotonic() - started < 1.5
+    finally:
+        security_notifier.imap.idle.interrupt_waits()
+        waiter.join()
+        security_notifier.imap.idle.reset_waits()
+
+    assert result == [False]
+    assert mailbox.idle.stops == 1, "The IDLE should be ended before we return"
@@ -7,7 +7,12 @@ import pytest
 import toml
 
 from security_notifier.imap.detection_info import DetectionInfo, EventType
-from security_notifier.imap.message_parser import parse_message, MessageParseFailure
+from security_notifier.imap.message_parser import (
+    parse_message,
+    parse_messages,
+    parse_message_batches,
+    MessageParseFailure
+)
 
 
 @pytest.fixture
@@ -99,3 +104,28 @@ def test_invalid_event(caplog, examples: Dict[Text, Text]):
                      [2],
                      EventType.Misc,
                      datetime.datetime(2022, 1, 15, 19, 30, 49))
+
+
+@pytest.mark.parametrize("processes", (1, 2))
+def test_parse_batches(examples: Dict[Text, Text], processes: int):
+    messages = [examples[k] for k in ("intrusion", "invalid_email", "line_crossing", "motion_cam1", "missing_event")]
+    failures = []
+
+    batches = list(parse_message_batches(messages, batch_size=2, processes=processes,
+                                         on_failures=lambda idx, reasons: failures.append((idx, reasons))))
+
+    assert [[d.type for d in b] for b in batches] == [[EventType.Intrusion], [EventType.LineCrossing, EventType.Motion],
+                                                       []]
+    assert failures == [(0, ["Could not extract the event type from the email."]),
+                        (2, ["Could not extract the event type from the email."])]
+
+
+def test_parse_messages_is_lazy(examples: Dict[Text, Text]):
+    def stream():
+        yield examples["intrusion"]
+        yield examples["motion_cam2"]
+        raise AssertionError("Should only have consumed the first batch")
+
+    detections = parse_messages(stream(), batch_size=2)
+    assert next(detections).type == EventType.Intrusion
+    assert next(detections).type == EventType.Motion
@@ -0,0 +1,53 @@
+import datetime
+import random
+from pathlib import Path
+from typing import List, Text
+
+import pytest
+import toml
+
+from security_notifier.imap.detection_info import EventType
+from security_notifier.imap.message_parser import parse_message
+
+pytest.importorskip("pytest_benchmark")
+
+CORPUS_SIZE = 2000
+
+
+@pytest.fixture(scope="module")
+def corpus() -> List[Text]:
+    """Synthetic DVR bodies, built from the parser fixtures with the event type, time and cameras varied. Roughly one
+    in ten is one of the malformed examples."""
+    examples = toml.load(Path(__file__).parent / "message_contents.toml")["message_examples"]
+    template = examples["motion_multi_cameras"]
+    malformed = [examples[k] for k in ("invalid_email", "motion_invalid_date", "motion_invalid_cameras")]
+
+    rng = random.Random(1234)
+    start = datetime.datetime(2022, 1, 1)
+    bodies = []
+    for _ in range(CORPUS_SIZE):
+        if rng.random() < 0.1:
+            bodies.append(rng.choice(malformed))
+            continue
+
+        event_type = rng.choice([EventType.Motion, EventType.LineCrossing, EventType.Intrusion])
+        date_time = start + datetime.timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+        cameras = "   ".join(f"Camera {c:02d}(A{c})" for c in sorted(rng.sample(range(1, 9), rng.randint(1, 3))))
+        bodies.append(
+            template
+            .replace("Motion Detected", event_type.value)
+            .replace("2022-01-15,19:30:49", date_time.strftime("%Y-%m-%d,%H:%M:%S"))
+            .replace("Camera 01(A1)   Camera 02(A2)", cameras)
+        )
+    return bodies
+
+
+def test_parse_throughput(benchmark, corpus: List[Text]):
+    def parse_all():
+        return [parse_message(body) for body in corpus]
+
+    detections = benchmark(parse_all)
+
+    assert sum(d is not None for d in detections) >= 0.85 * CORPUS_SIZE
+    if benchmark.stats is not None:
+        benchmark.extra_info["messages_per_second"] = CORPUS_SIZE / benchmark.stats.stats.mean
@@ -0,0 +1,136 @@
+import asyncio
+import datetime
+import threading
+import time
+from multiprocessing import Value
+from typing import List
+
+import pytest
+import toml
+
+from security_notifier.config import Config, current_site
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+from security_notifier.imap.idle import wait_for_new_mail
+from security_notifier.imap.poller import EmailPoller
+
+
+def _event(second: int) -> DetectionInfo:
+    return DetectionInfo(EventType.Motion, [1], datetime.datetime(2022, 1, 15, 19, 30, second))
+
+
+def _run_for(poller: EmailPoller, flag: Value, seconds: float) -> float:
+    """Run the poller's tasks until `seconds` from now, then stop it. Returns how long it took to stop."""
+    stopped_at = []
+
+    def stop():
+        flag.value = 0
+        stopped_at.append(time.monotonic())
+
+    timer = threading.Timer(seconds, stop)
+    timer.start()
+    try:
+        asyncio.run(poller.run_tasks())
+    finally:
+        timer.cancel()
+    return time.monotonic() - stopped_at[0]
+
+
+def test_slow_handler_doesnt_hold_up_fetching():
+    fetches, handled = [], []
+
+    def generator():
+        fetches.append(threading.current_thread())
+        return [_event(len(fetches) % 60)]
+
+    def handler(events: List[DetectionInfo]):
+        time.sleep(0.3)
+        handled.append(events)
+
+    flag = Value("i", 1)
+    poller = EmailPoller(flag, polling_freq=0.02, event_generator=generator, event_handler=handler)
+    _run_for(poller, flag, 0.5)
+
+    assert len(fetches) > 5, "Fetching should carry on while the handler is busy"
+    assert 1 <= len(handled) <= 3
+    assert threading.main_thread() not in fetches, "Fetching should happen off the event loop"
+
+
+def test_batches_generated_off_the_loop():
+    threads = []
+
+    def generator():
+        for second in range(3):
+            threads.append(threading.current_thread())
+            yield [_event(second)]
+
+    handled = []
+    flag = Value("i", 1)
+    poller = EmailPoller(flag, polling_freq=60, event_generator=generator, event_handler=handled.extend,
+                         replay_source=lambda: [_event(59)])
+    _run_for(poller, flag, 0.3)
+
+    assert handled == [_event(59), _event(0), _event(1), _event(2)]
+    assert len(threads) == 3 and threading.main_thread() not in threads
+
+
+def test_stop_is_prompt():
+    flag = Value("i", 1)
+    poller = EmailPoller(flag, polling_freq=60, event_generator=list, event_handler=lambda events: None)
+    assert _run_for(poller, flag, 0.2) < 1, "Stopping shouldn't wait for the next poll"
+
+
+def test_stop_lets_handler_finish():
+    finished = []
+
+    def handler(events: List[DetectionInfo]):
+        time.sleep(0.5)
+        finished.append(events)
+
+    flag = Value("i", 1)
+    poller = EmailPoller(flag, polling_freq=60, event_generator=lambda: [_event(0)], event_handler=handler)
+    _run_for(poller, flag, 0.1)
+    assert finished == [[_event(0)]]
+
+
+def test_handler_errors_stop_the_poller():
+    def handler(events: List[DetectionInfo]):
+        raise ValueError("Oops")
+
+    flag = Value("i", 1)
+    poller = EmailPoller(flag, polling_freq=60, event_generator=lambda: [_event(0)], event_handler=handler)
+    with pytest.raises(ValueError):
+        asyncio.run(poller.run_tasks())
+
+
+def test_sites_polled_side_by_side():
+    handled = []
+
+    def generator():
+        # Each site's fetch sees its own config.
+        return [_event(0 if current_site() == "home" else 1)]
+
+    def handler(events: List[DetectionInfo]):
+        handled.append((current_site(), events))
+        if current_site() == "home":
+            time.sleep(1)
+
+    flag = Value("i", 1)
+    poller = EmailPoller(flag, polling_freq=0.05, event_generator=generator, event_handler=handler,
+                         sites=["home", "office"])
+    _run_for(poller, flag, 0.5)
+
+    assert [events for site, events in handled if site == "home"] == [[_event(0)]]
+    assert handled.count(("office", [_event(1)])) > 3, "A slow site shouldn't hold up the others"
+    assert poller.metrics["office"].fetches > 3
+    assert poller.metrics["home"].fetches > 3, "Nor should its own slow handler"
+
+
+def test_stop_cuts_polling_waits_short(tmp_path, monkeypatch):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({"imap": {"idle": False}}))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+
+    flag = Value("i", 1)
+    poller = EmailPoller(flag, polling_freq=30, event_generator=lambda: [], event_handler=lambda events: None,
+                         waiter=wait_for_new_mail, sites=["home", "office"])
+    assert _run_for(poller, flag, 0.2) < 2, "Neither site should sit out its polling period before stopping"
@@ -0,0 +1,85 @@
+import imaplib
+
+import pytest
+
+from security_notifier.imap.session import MailboxSession
+
+
+class FakeClient:
+    def __init__(self, healthy: bool = True):
+        self.healthy = healthy
+        self.noops = 0
+
+    def noop(self):
+        self.noops += 1
+        if not self.healthy:
+            raise imaplib.IMAP4.abort("socket error: EOF")
+        return "OK", [b"NOOP completed"]
+
+
+class FakeMailbox:
+    def __init__(self):
+        self.client = FakeClient()
+        self.logged_out = False
+
+    def logout(self):
+        self.logged_out = True
+
+
+@pytest.fixture
+def connections():
+    return []
+
+
+@pytest.fixture
+def session(connections) -> MailboxSession:
+    def connect():
+        mb = FakeMailbox()
+        connections.append(mb)
+        return mb
+
+    return MailboxSession(connect, keepalive_interval=60)
+
+
+def test_connection_is_reused(session, connections):
+    first = session.mailbox()
+    second = session.mailbox()
+
+    assert first is second
+    assert len(connections) == 1
+    assert first.client.noops == 0, "Shouldn't NOOP a connection that was used recently"
+
+
+def test_keepalive_reconnects_dropped_connection(session, connections):
+    first = session.mailbox()
+    first.client.healthy = False
+    session.keepalive_interval = 0
+
+    second = session.mailbox()
+
+    assert first.client.noops == 1
+    assert second is not first
+    assert first.logged_out
+    assert len(connections) == 2
+
+
+def test_run_retries_once_on_drop(session, connections):
+    calls = []
+
+    def command(mailbox):
+        calls.append(mailbox)
+        if len(calls) == 1:
+            raise imaplib.IMAP4.abort("connection reset")
+        return "done"
+
+    assert session.run(command) == "done"
+    assert len(connections) == 2
+    assert calls[0] is not calls[1]
+
+
+def test_close(session, connections):
+    mb = session.mailbox()
+    session.close()
+
+    assert mb.logged_out
+    assert not session.connected
@@ -0,0 +1,157 @@
+import imaplib
+import re
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import toml
+
+import security_notifier.imap
+from security_notifier.config import Config, use_site
+from security_notifier.imap import get_events
+from security_notifier.imap.session import MailboxSession
+from security_notifier.imap.state import MailboxState, load_state, save_state
+
+ALERT_TEXT = """EVENT TYPE:      Motion Detected
+EVENT TIME:      2022-01-15,19:30:57
+CAMERA NAME(NUM):    Camera 01(A1)"""
+
+
+@pytest.fixture
+def config(tmp_path: Path, monkeypatch) -> Config:
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "imap": {"state_file": str(tmp_path / "imap_state.toml"), "processed_folder": "", "lean_fetch": False},
+        "cctv_alerts": {"email_sender": "dvr@example.com", "email_subject_filter": "Embedded Net DVR"},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    monkeypatch.setattr(security_notifier.imap, "_states", {})
+    return Config.instance()
+
+
+class FakeMailbox:
+    def __init__(self, uids, uidvalidity=7):
+        self.message_uids = uids
+        self.uidvalidity = uidvalidity
+        self.criteria = []
+        self.fetches = 0
+        self.folder = SimpleNamespace(status=self._status)
+
+    def _status(self, folder, options):
+        return {"UIDVALIDITY": self.uidvalidity, "UIDNEXT": max(self.message_uids, default=0) + 1}
+
+    def uids(self, criteria):
+        self.criteria.append(str(criteria))
+        return [str(u) for u in self.message_uids]
+
+    def fetch(self, criteria, bulk=False):
+        self.fetches += 1
+        requested = re.search(r"UID ([\d,]+)", str(criteria)).group(1).split(",")
+        return [SimpleNamespace(uid=u, text=ALERT_TEXT) for u in requested]
+
+    def logout(self):
+        pass
+
+
+def _use_mailbox(mocker, mailbox):
+    session = MailboxSession(lambda: mailbox, keepalive_interval=60)
+    mocker.patch.object(security_notifier.imap, "get_session", return_value=session)
+
+
+def _get_events():
+    return [e for batch in get_events() for e in batch]
+
+
+def test_state_round_trip(tmp_path: Path):
+    path = tmp_path / "state.toml"
+    assert load_state(path) == MailboxState()
+
+    save_state(MailboxState(12, 345), path)
+    assert load_state(path) == MailboxState(12, 345)
+
+
+def test_incremental_fetch(config, mocker):
+    mailbox = FakeMailbox([3, 4])
+    _use_mailbox(mocker, mailbox)
+
+    assert len(_get_events()) == 2
+    assert "UID" not in mailbox.criteria[-1], "First fetch has no high-water mark, so should search everything"
+    assert load_state(config.get("imap.state_file")) == MailboxState(7, 4)
+
+    # The server always returns the newest message for `n:*`, even when it's below the high-water mark.
+    mailbox.message_uids = [4]
+    assert _get_events() == []
+    assert "UID 5:*" in mailbox.criteria[-1]
+
+    mailbox.message_uids = [4, 9]
+    assert len(_get_events()) == 1
+    assert load_state(config.get("imap.state_file")) == MailboxState(7, 9)
+
+
+def test_uidvalidity_change_resets_mark(config, mocker):
+    save_state(MailboxState(1, 500), config.get("imap.state_file"))
+    mailbox = FakeMailbox([3], uidvalidity=2)
+    _use_mailbox(mocker, mailbox)
+
+    assert len(_get_events()) == 1
+    assert "UID" not in mailbox.criteria[-1]
+    assert load_state(config.get("imap.state_file")) == MailboxState(2, 3)
+
+
+def test_sites_sharing_a_state_file_keep_their_own(tmp_path: Path, monkeypatch):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "imap": {"state_file": str(tmp_path / "imap_state.toml")},
+        "sites": {"home": {}, "office": {}, "garage": {"imap": {"state_file": str(tmp_path / "garage.toml")}}},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+
+    for uidvalidity, site in enumerate(("home", "office", "garage")):
+        with use_site(site):
+            save_state(MailboxState(uidvalidity, 10))
+
+    with use_site("home"):
+        assert load_state() == MailboxState(0, 10)
+    with use_site("office"):
+        assert load_state() == MailboxState(1, 10), "One site's high-water mark shouldn't overwrite another's"
+    assert (tmp_path / "imap_state.home.toml").is_file()
+    assert (tmp_path / "imap_state.office.toml").is_file()
+    assert load_state(tmp_path / "garage.toml") == MailboxState(2, 10)
+    assert not (tmp_path / "imap_state.toml").exists()
+
+
+def test_batches_are_yielded_as_they_are_fetched(tmp_path: Path, mocker, monkeypatch):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "imap": {"state_file": str(tmp_path / "imap_state.toml"), "processed_folder": "", "lean_fetch": False,
+                 "fetch_batch_size": 2, "parse_batch_size": 2},
+        "cctv_alerts": {"email_sender": "dvr@example.com", "email_subject_filter": "Embedded Net DVR"},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    monkeypatch.setattr(security_notifier.imap, "_states", {})
+    mailbox = FakeMailbox(list(range(1, 7)))
+    _use_mailbox(mocker, mailbox)
+
+    batches = get_events()
+    assert len(next(batches)) == 2
+    assert mailbox.fetches == 1, "The first batch shouldn't wait for the rest of the backlog to download"
+    assert sum(len(b) for b in batches) == 4
+    assert mailbox.fetches == 3
+
+
+def test_dropped_connection_mid_fetch_is_retried(config, mocker):
+    mailbox = FakeMailbox(list(range(1, 4)))
+    fetch = mailbox.fetch
+    failures = []
+
+    def flaky_fetch(criteria, bulk=False):
+        if not failures:
+            failures.append(criteria)
+            raise imaplib.IMAP4.abort("socket error: EOF")
+        return fetch(criteria, bulk)
+
+    mailbox.fetch = flaky_fetch
+    _use_mailbox(mocker, mailbox)
+
+    assert len(_get_events()) == 3
+    assert failures
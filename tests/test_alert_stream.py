@@ -0,0 +1,223 @@
+import datetime
+import hashlib
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+import pytest
+import toml
+
+from security_notifier.alert_stream import AlertStream, AlertStreamSource, iter_parts, parse_alert
+from security_notifier.config import Config
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+
+USERNAME, PASSWORD, REALM, NONCE = "admin", "hunter2", "DVR", "4e4f4e4345"
+
+
+def _alert(event_type: str = "VMD", channel: int = 1, state: str = "active", post_count: int = 1,
+           when: str = "2022-01-15T19:30:57+00:00") -> bytes:
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<EventNotificationAlert version="2.0" xmlns="http://www.hikvision.com/ver20/XMLSchema">
+<ipAddress>192.168.1.64</ipAddress>
+<channelID>{channel}</channelID>
+<dateTime>{when}</dateTime>
+<activePostCount>{post_count}</activePostCount>
+<eventType>{event_type}</eventType>
+<eventState>{state}</eventState>
+<eventDescription>Test alarm</eventDescription>
+</EventNotificationAlert>""".encode()
+
+
+@pytest.mark.parametrize("body, expected", [
+    (_alert(), DetectionInfo(EventType.Motion, [1], datetime.datetime(2022, 1, 15, 19, 30, 57))),
+    (_alert("fielddetection", 3), DetectionInfo(EventType.Intrusion, [3], datetime.datetime(2022, 1, 15, 19, 30, 57))),
+    (_alert("linedetection"), DetectionInfo(EventType.LineCrossing, [1], datetime.datetime(2022, 1, 15, 19, 30, 57))),
+    (_alert(state="inactive"), None),
+    (_alert(post_count=2), None),
+    (_alert("videoloss", state="inactive"), None),
+    (b"<not xml", None),
+    (_alert().replace(b"<dateTime>2022-01-15T19:30:57+00:00</dateTime>", b""), None),
+    (_alert(when="yesterday"), None),
+    (_alert().replace(b"<channelID>1</channelID>", b"<channelID>A1</channelID>"), None),
+])
+def test_parse_alert(body: bytes, expected: Optional[DetectionInfo]):
+    assert parse_alert(body) == expected
+
+
+def _part(body: bytes, content_length: bool = True) -> bytes:
+    headers = b'Content-Type: application/xml; charset="UTF-8"\r\n'
+    if content_length:
+        headers += f"Content-Length: {len(body)}\r\n".encode()
+    return b"--boundary\r\n" + headers + b"\r\n" + body + b"\r\n"
+
+
+def test_iter_parts():
+    stream = io.BytesIO(_part(_alert()) + _part(_alert(channel=2), content_length=False) + b"--boundary--\r\n")
+    assert [parse_alert(p).camera_ids for p in iter_parts(stream, "boundary")] == [[1], [2]]
+
+
+def _digest_ok(header: str, method: str) -> bool:
+    if not header.startswith("Digest "):
+        return False
+    fields = {}
+    for item in header[len("Digest "):].split(","):
+        key, _, value = item.strip().partition("=")
+        fields[key] = value.strip('"')
+
+    def md5(text: str) -> str:
+        return hashlib.md5(text.encode()).hexdigest()
+
+    ha1 = md5(f"{USERNAME}:{REALM}:{PASSWORD}")
+    ha2 = md5(f"{method}:{fields['uri']}")
+    expected = md5(f"{ha1}:{NONCE}:{fields['nc']}:{fields['cnonce']}:{fields['qop']}:{ha2}")
+    return fields.get("username") == USERNAME and fields.get("response") == expected
+
+
+class FakeDVR(ThreadingHTTPServer):
+    """Stands in for the DVR: wants digest auth, then sends each connection's alerts down a multipart stream, one every
+    `interval` seconds, and hangs up."""
+    daemon_threads = True
+
+    def __init__(self, connections: List[List[bytes]], interval: float = 0.05):
+        super().__init__(("127.0.0.1", 0), AlertStreamHandler)
+        self.connections = connections
+        self.interval = interval
+        self.served = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/ISAPI/Event/notification/alertStream"
+
+
+class AlertStreamHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if not _digest_ok(self.headers.get("Authorization", ""), "GET"):
+            self.send_response(401)
+            self.send_header("WWW-Authenticate", f'Digest realm="{REALM}", nonce="{NONCE}", qop="auth"')
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        alerts = self.server.connections[min(self.server.served, len(self.server.connections) - 1)]
+        self.server.served += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/mixed; boundary=boundary")
+        self.end_headers()
+        for alert in alerts:
+            time.sleep(self.server.interval)
+            self.wfile.write(_part(alert))
+            self.wfile.flush()
+        # A stream that ends means the DVR hung up.
+        time.sleep(self.server.interval)
+
+
+@pytest.fixture
+def dvr(request):
+    server = FakeDVR(request.param)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("dvr", [[[_alert(channel=1), _alert("videoloss", state="inactive"), _alert(channel=2)]]],
+                         indirect=True)
+def test_alerts_arrive_as_they_happen(dvr: FakeDVR):
+    stream = AlertStream(dvr.url, USERNAME, PASSWORD, timeout=5)
+    stream.start()
+    try:
+        started = time.monotonic()
+        assert stream.wait(5), "The first alert should have arrived"
+        assert time.monotonic() - started < 1
+
+        events = stream.drain()
+        while len(events) < 2 and stream.wait(5):
+            events += stream.drain()
+    finally:
+        stream.stop()
+
+    assert [e.camera_ids for e in events] == [[1], [2]]
+
+
+# After the first connection drops, the DVR has nothing more to say, so only the backfill can find anything.
+@pytest.mark.parametrize("dvr", [[[_alert(channel=1)], []]], indirect=True)
+def test_backfill_after_reconnecting(dvr: FakeDVR, tmp_path, monkeypatch):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({"journal": {"enabled": False}}))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    backfills = []
+
+    def backfill():
+        backfills.append(time.monotonic())
+        return iter([])
+
+    source = AlertStreamSource(backfill=backfill,
+                               stream_factory=lambda: AlertStream(dvr.url, USERNAME, PASSWORD, reconnect_delay=0.05))
+    # Like the poller: fetch once, then only when the waiter says there's something to fetch.
+    events = [e for batch in source() for e in batch]
+    try:
+        deadline = time.monotonic() + 10
+        while (not events or len(backfills) < 2) and time.monotonic() < deadline:
+            if source.wait(1):
+                events += [e for batch in source() for e in batch]
+    finally:
+        source.close()
+
+    assert [e.camera_ids for e in events] == [[1]]
+    assert len(backfills) >= 2, "Emails should be checked on startup, and again after the stream dropped"
+
+
+class QuietStream:
+    """A stream that's connected, but never has anything to say."""
+    connections = 1
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def drain(self):
+        return []
+
+
+def test_backfill_interval_while_quiet(tmp_path, monkeypatch):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({"journal": {"enabled": False}}))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    backfills = []
+
+    def backfill():
+        backfills.append(time.monotonic())
+        return iter([])
+
+    source = AlertStreamSource(backfill=backfill, backfill_interval=0.2, max_wait=0.05, stream_factory=QuietStream)
+    list(source())
+    deadline = time.monotonic() + 1
+    while time.monotonic() < deadline:
+        if source.wait(1):
+            list(source())
+    source.close()
+
+    assert 4 <= len(backfills) <= 6
+
+
+@pytest.mark.parametrize("dvr", [[[_alert()]]], indirect=True)
+def test_wrong_password(dvr: FakeDVR):
+    stream = AlertStream(dvr.url, USERNAME, "wrong", timeout=5, reconnect_delay=0.05)
+    stream.start()
+    try:
+        assert not stream.wait(0.5)
+        assert stream.connections == 0
+    finally:
+        stream.stop()
@@ -4,7 +4,7 @@ from typing import Text, Any, List
 import pytest
 
 from security_notifier.config import Config, ClashingFieldException, InvalidNestedIndexException, \
-    MissingConfigEntryException
+    MissingConfigEntryException, current_site, use_site
 
 
 def check_nested_item(cfg: Config, keys: List[Text], expected_value: Any):
@@ -177,3 +177,20 @@ def test_with_none_default(tmp_path: Path):
         cfg.get("container.missing_item")
 
     assert cfg.get("container.missing_item", None) is None
+
+
+def test_site_overrides(tmp_path: Path):
+    cfg, _, _ = _create_mock_config(tmp_path)
+    cfg._data["sites"] = {"garage": {"top_level": 5, "container": {"inner_list": ["d"]}}, "shed": {}}
+
+    assert cfg.sites() == ["garage", "shed"]
+    with use_site("garage"):
+        assert current_site() == "garage"
+        assert cfg.get("top_level") == 5
+        assert cfg.get("container.inner_list") == ["d"]
+        assert cfg.get("container.inner_nested.a") == 0, "Anything the site doesn't set should come from the top level"
+    with use_site("shed"):
+        assert cfg.get("top_level") == 4
+
+    assert current_site() is None
+    assert cfg.get("top_level") == 4
@@ -0,0 +1,159 @@
+import datetime
+import sqlite3
+from pathlib import Path
+
+import pytest
+import toml
+
+from security_notifier.__main__ import main
+from security_notifier.config import Config
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+from security_notifier.journal import EventJournal, EventState, close_journal, get_journal
+
+
+@pytest.fixture
+def journal(tmp_path: Path) -> EventJournal:
+    journal = EventJournal(tmp_path / "events.sqlite3")
+    yield journal
+    journal.close()
+
+
+def _events():
+    return [
+        DetectionInfo(EventType.Motion, [1], datetime.datetime(2022, 1, 15, 19, 30, 57)),
+        DetectionInfo(EventType.Intrusion, [1, 2], datetime.datetime(2022, 1, 15, 19, 37, 30)),
+        DetectionInfo(EventType.LineCrossing, [2], datetime.datetime(2022, 1, 16, 8, 0, 0)),
+    ]
+
+
+def test_add_skips_duplicates(journal: EventJournal):
+    events = _events()
+    assert journal.add(events[:2]) == events[:2]
+    assert journal.add(events) == events[2:], "Only the new event should be added"
+    assert journal.counts() == {EventState.Queued: 3}
+
+
+def test_unfinished_survives_reopen(tmp_path: Path, journal: EventJournal):
+    events = _events()
+    journal.add(events)
+    journal.set_state(events[:1], EventState.Done)
+    journal.set_state(events[1:2], EventState.Capturing)
+    journal.close()
+
+    reopened = EventJournal(tmp_path / "events.sqlite3")
+    try:
+        assert reopened.unfinished() == events[1:]
+    finally:
+        reopened.close()
+
+
+def test_history(journal: EventJournal):
+    events = _events()
+    journal.add(events)
+    journal.set_state(events[1:2], EventState.Capturing)
+    journal.set_state(events[1:2], EventState.Failed)
+
+    entries = journal.history(start=datetime.datetime(2022, 1, 15, 19, 35), end=datetime.datetime(2022, 1, 17))
+    assert [e.event for e in entries] == events[1:]
+    assert entries[0].state == EventState.Failed
+    assert entries[0].attempts == 1
+    assert entries[1].state == EventState.Queued
+
+
+def test_query_by_camera_and_type(journal: EventJournal):
+    events = _events()
+    journal.add(events)
+
+    assert [e.event for e in journal.query(camera_id=2)] == events[1:]
+    assert [e.event for e in journal.query(camera_id=1, end=datetime.datetime(2022, 1, 15, 19, 37, 30))] == events[:1]
+    assert [e.event for e in journal.query(event_types=[EventType.Intrusion, EventType.LineCrossing])] == events[1:]
+    assert [e.event for e in journal.query(camera_id=2, event_types=[EventType.LineCrossing])] == events[2:]
+    assert [e.event for e in journal.query(limit=1)] == events[:1]
+    assert journal.query(camera_id=3) == []
+
+
+@pytest.mark.parametrize("query, index", [
+    ("SELECT key FROM events WHERE date_and_time >= ? AND date_and_time < ?", "events_time"),
+    ("SELECT key FROM events WHERE type = ? AND date_and_time >= ?", "events_type_time"),
+    ("SELECT key FROM event_cameras WHERE camera_id = ? AND date_and_time >= ?", "PRIMARY KEY"),
+])
+def test_queries_use_index(journal: EventJournal, query: str, index: str):
+    plan = journal._conn.execute(f"EXPLAIN QUERY PLAN {query}", ("a", "b")).fetchall()
+    assert any(index in row[-1] for row in plan), plan
+
+
+def test_camera_index_backfilled(tmp_path: Path):
+    path = tmp_path / "events.sqlite3"
+    old = sqlite3.connect(str(path))
+    old.executescript("""
+        CREATE TABLE events (key TEXT PRIMARY KEY, type TEXT NOT NULL, camera_ids TEXT NOT NULL,
+            date_and_time TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL, updated_at REAL NOT NULL);
+        INSERT INTO events VALUES ('k', 'Intrusion', '1,2', '2022-01-15T19:37:30', 'done', 1, 0, 0);
+    """)
+    old.close()
+
+    journal = EventJournal(path)
+    try:
+        assert [e.event.camera_ids for e in journal.query(camera_id=2)] == [[1, 2]]
+    finally:
+        journal.close()
+
+
+def test_events_command(tmp_path: Path, monkeypatch, capsys):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({"journal": {"path": str(tmp_path / "events.sqlite3")}}))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    try:
+        get_journal().add(_events())
+        main(["events", "--camera", "2", "--since", "2022-01-16", "--type", "LineCrossing"])
+    finally:
+        close_journal()
+
+    assert capsys.readouterr().out.splitlines() == [
+        "2022-01-16 08:00:00  LineCrossing    cameras 2        queued"
+    ]
+
+
+def test_labels(tmp_path: Path, monkeypatch, capsys):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({"journal": {"path": str(tmp_path / "events.sqlite3")}}))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    events = _events()
+    try:
+        journal = get_journal()
+        journal.add(events)
+        journal.set_labels(events[:1], ["car", "person"])
+        journal.set_labels(events[1:2], [])
+
+        assert [e.event for e in journal.query(label="person")] == events[:1]
+        main(["events"])
+    finally:
+        close_journal()
+
+    assert capsys.readouterr().out.splitlines() == [
+        "2022-01-15 19:30:57  Motion          cameras 1        queued  found: car, person",
+        "2022-01-15 19:37:30  Intrusion       cameras 1,2      queued  found: nothing",
+        "2022-01-16 08:00:00  LineCrossing    cameras 2        queued",
+    ]
+
+
+def test_motion_scores(tmp_path: Path, monkeypatch, capsys):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({"journal": {"path": str(tmp_path / "events.sqlite3")}}))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    events = _events()
+    try:
+        journal = get_journal()
+        journal.add(events)
+        journal.set_motion_score(events[:1], 0.002)
+        journal.set_motion_score(events[1:], 0.25)
+
+        assert [e.motion_score for e in journal.history()] == [0.002, 0.25, 0.25]
+        main(["events", "--min-motion", "0.01", "--limit", "1"])
+    finally:
+        close_journal()
+
+    assert capsys.readouterr().out.splitlines() == [
+        "2022-01-15 19:37:30  Intrusion       cameras 1,2      queued  motion 0.250"
+    ]
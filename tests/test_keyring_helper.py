@@ -0,0 +1,81 @@
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import pytest
+import toml
+
+import security_notifier.keyring_helper as keyring_helper
+from security_notifier.config import Config
+
+
+class FakeKeyring:
+    """Stands in for CryptFileKeyring, counting how many times it gets unlocked and read."""
+    instances: List["FakeKeyring"] = []
+    store: Dict[Tuple[str, str], str] = {}
+
+    def __init__(self):
+        self.keyring_key = None
+        self.reads = 0
+        FakeKeyring.instances.append(self)
+
+    def get_password(self, service, username):
+        self.reads += 1
+        return FakeKeyring.store.get((service, username))
+
+    def set_password(self, service, username, password):
+        FakeKeyring.store[(service, username)] = password
+
+
+@pytest.fixture
+def fake_keyring(tmp_path: Path, monkeypatch):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "dvr": {"keyring_secret_name": "dvr_secret", "username": "admin"},
+        "keyring": {"cache_ttl": 60},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    monkeypatch.setenv("KEYRING_CRYPTFILE_PASSWORD", "hunter2")
+
+    FakeKeyring.instances, FakeKeyring.store = [], {("dvr_secret", "admin"): "letmein"}
+    monkeypatch.setattr(keyring_helper, "CryptFileKeyring", FakeKeyring)
+    keyring_helper.invalidate_cache()
+    yield
+    keyring_helper.invalidate_cache()
+
+
+def test_password_is_cached(fake_keyring):
+    for _ in range(10):
+        assert keyring_helper.password_is_set("dvr.keyring_secret_name", "dvr.username")
+        assert keyring_helper.get_password("dvr.keyring_secret_name", "dvr.username") == "letmein"
+
+    assert len(FakeKeyring.instances) == 1, "Keyring should only be unlocked once"
+    assert FakeKeyring.instances[0].reads == 1
+
+
+def test_cache_expires(fake_keyring, monkeypatch):
+    keyring_helper.get_password("dvr.keyring_secret_name", "dvr.username")
+    monkeypatch.setattr(keyring_helper, "_cache_ttl", lambda: 0)
+    keyring_helper.get_password("dvr.keyring_secret_name", "dvr.username")
+
+    assert len(FakeKeyring.instances) == 2
+
+
+def test_invalidate_and_set(fake_keyring):
+    keyring_helper.get_password("dvr.keyring_secret_name", "dvr.username")
+    FakeKeyring.store[("dvr_secret", "admin")] = "changed"
+    assert keyring_helper.get_password("dvr.keyring_secret_name", "dvr.username") == "letmein"
+
+    keyring_helper.invalidate_cache()
+    assert keyring_helper.get_password("dvr.keyring_secret_name", "dvr.username") == "changed"
+
+    keyring_helper.set_password("DVR", "dvr.keyring_secret_name", "dvr.username", "newer")
+    assert keyring_helper.get_password("dvr.keyring_secret_name", "dvr.username") == "newer"
+    assert FakeKeyring.instances[-1].reads == 1
+
+
+def test_missing_password_not_cached(fake_keyring):
+    FakeKeyring.store.clear()
+    assert not keyring_helper.password_is_set("dvr.keyring_secret_name", "dvr.username")
+
+    FakeKeyring.store[("dvr_secret", "admin")] = "set elsewhere"
+    assert keyring_helper.password_is_set("dvr.keyring_secret_name", "dvr.username")
@@ -0,0 +1,66 @@
+"""A stand-in for a YOLO model, so the detector can be tested through OpenCV's DNN module without shipping (or
+downloading) real weights.
+
+The "model" average-pools the image in 8x8 blocks and lays the result out as YOLOv8 does: (batch, 4 + classes,
+anchors), here with 2 classes. Every anchor's class scores are just the block's average colour, so a white frame is a
+confident class 0 detection everywhere and a black one is nothing at all. It has no weights, so the ONNX file is small
+enough to write out by hand."""
+import struct
+from pathlib import Path
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+def _field(num: int, value) -> bytes:
+    if isinstance(value, int):
+        return _varint(num << 3) + _varint(value)
+    if isinstance(value, str):
+        value = value.encode()
+    return _varint(num << 3 | 2) + _varint(len(value)) + value
+
+
+def _ints_attribute(name: str, values) -> bytes:
+    return b"".join([_field(1, name), _field(20, 7)] + [_field(8, v) for v in values])
+
+
+def _int_attribute(name: str, value: int) -> bytes:
+    return _field(1, name) + _field(20, 2) + _field(3, value)
+
+
+def _node(op: str, inputs, outputs, attributes=()) -> bytes:
+    return b"".join([_field(1, i) for i in inputs] + [_field(2, o) for o in outputs] + [_field(4, op)] +
+                    [_field(5, a) for a in attributes])
+
+
+def _value_info(name: str, dims) -> bytes:
+    shape = b"".join(_field(1, _field(2, d) if isinstance(d, str) else _field(1, d)) for d in dims)
+    return _field(1, name) + _field(2, _field(1, _field(1, 1) + _field(2, shape)))
+
+
+def _int64_tensor(name: str, values) -> bytes:
+    return b"".join([_field(1, len(values)), _field(2, 7), _field(8, name),
+                     _field(9, struct.pack(f"<{len(values)}q", *values))])
+
+
+def write_stub_model(path: Path) -> Path:
+    graph = b"".join([
+        _field(1, _node("AveragePool", ["images"], ["pooled"],
+                        [_ints_attribute("kernel_shape", [8, 8]), _ints_attribute("strides", [8, 8])])),
+        _field(1, _node("Concat", ["pooled", "pooled"], ["boxes_and_scores"], [_int_attribute("axis", 1)])),
+        _field(1, _node("Reshape", ["boxes_and_scores", "shape"], ["output"])),
+        _field(2, "stub"),
+        _field(5, _int64_tensor("shape", [0, 6, -1])),
+        _field(11, _value_info("images", ["batch", 3, "height", "width"])),
+        _field(12, _value_info("output", ["batch", 6, "anchors"])),
+    ])
+    model = _field(1, 8) + _field(8, _field(1, "") + _field(2, 13)) + _field(7, graph)
+    path.write_bytes(model)
+    return path
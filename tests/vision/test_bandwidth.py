@@ -0,0 +1,57 @@
+from security_notifier.vision.bandwidth import BandwidthScheduler
+
+
+def test_window_grows_and_backs_off():
+    scheduler = BandwidthScheduler(max_streams=8)
+    assert scheduler.window == 1
+
+    first = scheduler.admit(1)
+    assert scheduler.admit(1) is None, "Only one stream to start with"
+
+    scheduler.release(first, success=True)
+    assert scheduler.window == 2, "Slow start adds a stream per success"
+    admissions = [scheduler.admit(1), scheduler.admit(1)]
+    assert None not in admissions and scheduler.admit(1) is None
+
+    scheduler.release(admissions[0], success=False)
+    assert scheduler.window == 1
+    scheduler.release(admissions[1], success=True)
+    assert scheduler.window == 2, "After a failure the window grows by one per window's worth of successes"
+    scheduler.release(scheduler.admit(1), success=True)
+    assert scheduler.window == 2.5
+
+
+def test_window_is_capped():
+    scheduler = BandwidthScheduler(max_streams=2)
+    for _ in range(5):
+        scheduler.release(scheduler.admit(1), success=True)
+    assert scheduler.window == 2
+
+
+def test_multi_camera_capture_always_admitted_when_idle():
+    scheduler = BandwidthScheduler(max_streams=1)
+    admission = scheduler.admit(3)
+    assert admission.streams == 3
+    assert scheduler.active_streams == 3
+
+
+def test_falls_back_to_sub_stream_under_budget():
+    scheduler = BandwidthScheduler(max_streams=8, budget=5, preferred_stream=1, fallback_stream=2,
+                                   bitrates={1: 4.0, 2: 0.5})
+    scheduler.window = 8
+
+    assert scheduler.admit(1).stream_id == 1
+    fallback = scheduler.admit(2)
+    assert fallback.stream_id == 2, "A second main stream would go over budget"
+    assert scheduler.active_bandwidth == 5
+    assert scheduler.admit(1) is None, "Nothing else fits"
+
+    scheduler.release(fallback, success=True)
+    assert scheduler.admit(1).stream_id == 2
+
+
+def test_measured_bitrate_replaces_estimate():
+    scheduler = BandwidthScheduler(max_streams=8, budget=10, bitrates={1: 4.0}, smoothing=0.5)
+    scheduler.release(scheduler.admit(2), success=True, bitrate=12.0)
+    assert scheduler.bitrates[1] == 5.0
+    assert scheduler.active_bandwidth == 0
@@ -0,0 +1,147 @@
+import datetime
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+import toml
+
+from security_notifier.config import Config
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+from security_notifier.vision import get_rtsp_capture
+from security_notifier.vision.pipeline import CapturePipeline
+from security_notifier.vision.utils import NoFrameFromFeedException
+
+CLIP_FPS = 30
+
+
+class FakeCapture:
+    """Produces `num_frames` frames at `fps`, then reports that the feed has gone."""
+
+    def __init__(self, num_frames: int, fps: float = 200):
+        self.remaining = num_frames
+        self.interval = 1 / fps
+
+    def read(self):
+        time.sleep(self.interval)
+        if self.remaining == 0:
+            return False, None
+        self.remaining -= 1
+        return True, np.zeros((4, 4, 3), dtype=np.uint8)
+
+
+def test_slow_writer_drops_frames_instead_of_blocking_reads():
+    written = []
+
+    def slow_write(imgs):
+        time.sleep(0.02)
+        written.append(imgs)
+
+    captures = [FakeCapture(10_000), FakeCapture(10_000)]
+    pipeline = CapturePipeline(captures, slow_write, buffer_size=4, late_threshold=0.01)
+    stats = pipeline.run(time.time() + 0.5)
+
+    assert stats.frames_written == len(written)
+    assert all(len(imgs) == 2 for imgs in written)
+    # Reading runs at ~200fps, while writing is limited to ~50fps.
+    assert all(r > 2 * stats.frames_written for r in stats.frames_read)
+    assert all(d > 0 for d in stats.frames_dropped)
+    assert stats.frames_late > 0
+
+
+def test_feed_failure_is_raised():
+    pipeline = CapturePipeline([FakeCapture(1000), FakeCapture(3)], lambda imgs: None)
+
+    with pytest.raises(NoFrameFromFeedException):
+        pipeline.run(time.time() + 5)
+
+
+class StalledCapture:
+    """Sends one frame, then nothing for `stall` seconds."""
+
+    def __init__(self, stall: float):
+        self.stall = stall
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        if self.reads > 1:
+            time.sleep(self.stall)
+            return False, None
+        return True, np.zeros((4, 4, 3), dtype=np.uint8)
+
+
+def test_stalled_feed_times_out():
+    pipeline = CapturePipeline([FakeCapture(10_000), StalledCapture(2)], lambda imgs: None, frame_timeout=0.3)
+
+    started = time.monotonic()
+    with pytest.raises(NoFrameFromFeedException, match="No frame"):
+        pipeline.run(time.time() + 30)
+    # Once the stalled read gives up, not at the end of the clip.
+    assert time.monotonic() - started < 5
+
+
+class BrokenCapture:
+    def read(self):
+        raise cv2.error("Decoder fell over")
+
+
+def test_reader_failure_is_raised():
+    pipeline = CapturePipeline([FakeCapture(1000), BrokenCapture()], lambda imgs: None)
+
+    with pytest.raises(NoFrameFromFeedException, match="Decoder fell over"):
+        pipeline.run(time.time() + 5)
+
+
+def _write_clip(path: Path, seconds: float, fps: int = CLIP_FPS):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), fps, (64, 48))
+    for i in range(int(seconds * fps)):
+        writer.write(np.full((48, 64, 3), i % 256, dtype=np.uint8))
+    writer.release()
+
+
+@pytest.fixture
+def recordings(tmp_path: Path, monkeypatch) -> Path:
+    """Stands in for the DVR: a 4s recording per camera, in place of its playback streams."""
+    for camera in (1, 2):
+        _write_clip(tmp_path / f"cam{camera}.avi", seconds=4)
+
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "dvr": {"uri_template": str(tmp_path / "cam{camera}.avi")},
+        "stream_capture": {"fast_playback": True, "detection_clip_length": 2, "storage_location": str(tmp_path)},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    return tmp_path
+
+
+def test_playback_stops_on_stream_time(recordings: Path):
+    captures = [cv2.VideoCapture(str(recordings / f"cam{c}.avi")) for c in (1, 2)]
+    written = []
+    try:
+        stats = CapturePipeline(captures, written.append, buffer_size=4).run(time.time() + 30, stream_length=2)
+    finally:
+        for c in captures:
+            c.release()
+
+    assert stats.frames_written == len(written) == 2 * CLIP_FPS
+    assert stats.frames_dropped == [0, 0], "Recorded footage should never be dropped"
+    assert stats.stream_seconds == pytest.approx(2, abs=1 / CLIP_FPS)
+
+
+def test_end_of_recording_is_not_a_failure(recordings: Path):
+    capture = cv2.VideoCapture(str(recordings / "cam1.avi"))
+    try:
+        stats = CapturePipeline([capture], lambda imgs: None).run(time.time() + 30, stream_length=10)
+    finally:
+        capture.release()
+    assert stats.frames_written == 4 * CLIP_FPS
+
+
+def test_fast_capture_is_faster_than_real_time(recordings: Path):
+    event = DetectionInfo(EventType.Motion, [1, 2], datetime.datetime(2022, 1, 15, 19, 30, 57))
+
+    start = time.time()
+    assert get_rtsp_capture(event)
+    assert time.time() - start < 2, "A 2s clip of recorded footage should take less than 2s to capture"
@@ -0,0 +1,199 @@
+import datetime
+import time
+from pathlib import Path
+from typing import List
+
+import toml
+
+from security_notifier.config import Config, current_site, use_site
+
+from security_notifier.imap.detection_info import (
+    EventType,
+    DetectionInfo
+)
+from security_notifier.journal import EventState, close_journal, get_journal
+from security_notifier.vision.bandwidth import BandwidthScheduler
+from security_notifier.vision.capture_pool import CaptureWorkerPool
+from security_notifier.vision.coalesce import EventCoalescer
+from security_notifier.vision.retry import RetryPolicy
+from security_notifier.vision.utils import CaptureResult
+
+handled_failures: List[DetectionInfo] = []
+
+
+def mock_handler(event: DetectionInfo) -> bool:
+    if event.type == EventType.Intrusion and event not in handled_failures:
+        handled_failures.append(event)
+        return False
+    return True
+
+
+def test_pool_is_reused_and_retries(mocker):
+    pool = CaptureWorkerPool(mock_handler,
+                             processes=1,
+                             retry_policy=RetryPolicy(base_delay=0.01, breaker_cooldown=0.01),
+                             coalesce=False)
+    spy = mocker.spy(pool, "_on_result")
+
+    first_batch = [
+        DetectionInfo(EventType.Motion, [0], datetime.datetime.now()),
+        DetectionInfo(EventType.Intrusion, [1, 2], datetime.datetime.now()),
+    ]
+    second_batch = [
+        DetectionInfo(EventType.Motion, [1, 2], datetime.datetime.now()),
+    ]
+
+    pool.start()
+    try:
+        workers = pool._pool._pool[:]
+        pool(first_batch)
+        pool(second_batch)
+        assert pool.wait(timeout=60), "Captures didn't finish"
+        assert pool._pool._pool == workers, "Workers should be reused across batches"
+    finally:
+        pool.close()
+
+    results = [call.args[3] for call in spy.call_args_list]
+    assert sorted(results) == [False, True, True, True], "The intrusion should have been retried once"
+    assert not pool.running
+
+
+def always_fails(event: DetectionInfo) -> bool:
+    return False
+
+
+def test_pool_gives_up_after_max_attempts():
+    pool = CaptureWorkerPool(always_fails,
+                             processes=1,
+                             retry_policy=RetryPolicy(base_delay=0.01, max_attempts=3),
+                             coalesce=False)
+    event = DetectionInfo(EventType.Motion, [0], datetime.datetime.now())
+
+    pool.start()
+    try:
+        pool([event])
+        assert pool.wait(timeout=60), "Retries should stop after max_attempts"
+        assert pool.dead_letters == [event]
+    finally:
+        pool.close()
+
+
+def succeeds(event: DetectionInfo) -> bool:
+    return True
+
+
+def test_pool_merges_bursts(mocker):
+    mocker.patch.object(EventCoalescer, "from_config", return_value=EventCoalescer(merge_gap=0.2, hold=0.2))
+    pool = CaptureWorkerPool(succeeds, processes=1, use_journal=False)
+    spy = mocker.spy(pool, "_submit")
+
+    now = datetime.datetime.now()
+    burst = [
+        DetectionInfo(EventType.Motion, [1], now),
+        DetectionInfo(EventType.Intrusion, [1], now + datetime.timedelta(seconds=2)),
+        DetectionInfo(EventType.Motion, [2], now),
+    ]
+
+    pool.start()
+    try:
+        pool(burst[:1])
+        pool(burst[1:])
+        assert pool.wait(timeout=60), "Captures didn't finish"
+    finally:
+        pool.close()
+
+    submitted = [e for call in spy.call_args_list for e in call.args[1]]
+    assert len(submitted) == 2, "The two alerts for camera 1 should have been captured together"
+    assert submitted[0].sources == burst[:2]
+    assert submitted[1] == burst[2]
+
+
+def needs_sub_stream(event: DetectionInfo, stream_id: int = 1) -> CaptureResult:
+    return CaptureResult(stream_id == 2, bitrate=0.5)
+
+
+def test_pool_uses_sub_stream_over_budget(mocker):
+    scheduler = BandwidthScheduler(max_streams=2, budget=1, preferred_stream=1, fallback_stream=2,
+                                   bitrates={1: 4.0, 2: 0.5})
+    mocker.patch.object(BandwidthScheduler, "from_config", return_value=scheduler)
+    pool = CaptureWorkerPool(needs_sub_stream, processes=2, use_journal=False, coalesce=False,
+                             retry_policy=RetryPolicy(max_attempts=1))
+
+    events = [DetectionInfo(EventType.Motion, [c], datetime.datetime.now()) for c in range(4)]
+    pool.start()
+    try:
+        pool(events)
+        assert pool.wait(timeout=60), "Captures didn't finish"
+    finally:
+        pool.close()
+
+    assert pool.dead_letters == [], "Every capture should have been sent to the sub-stream"
+    assert scheduler.window == 2
+    assert scheduler.active_streams == 0
+
+
+def test_pool_captures_high_priority_first(mocker):
+    pool = CaptureWorkerPool(succeeds, processes=1, use_journal=False, coalesce=False)
+    spy = mocker.spy(pool, "_start")
+
+    events = [DetectionInfo(EventType.Motion, [c], datetime.datetime.now()) for c in range(3)]
+    events.append(DetectionInfo(EventType.Intrusion, [3], datetime.datetime.now()))
+
+    pool.start()
+    try:
+        pool(events)
+        assert pool.wait(timeout=60), "Captures didn't finish"
+    finally:
+        pool.close()
+
+    started = [call.args[1] for call in spy.call_args_list]
+    assert started == [events[3]] + events[:3]
+
+
+def captured_at_own_site(event: DetectionInfo) -> bool:
+    time.sleep(0.05)
+    return current_site() == f"site{event.camera_ids[0] % 2}"
+
+
+def test_sites_share_workers_fairly(tmp_path: Path, monkeypatch, mocker):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "sites": {f"site{i}": {"journal": {"path": str(tmp_path / f"site{i}.sqlite3")}} for i in range(2)},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    pool = CaptureWorkerPool(captured_at_own_site,
+                             processes=1,
+                             coalesce=False,
+                             retry_policy=RetryPolicy(max_attempts=1))
+    spy = mocker.spy(pool, "_start")
+
+    now = datetime.datetime.now()
+    backlog = [DetectionInfo(EventType.Motion, [c], now) for c in (0, 2, 4, 6)]
+    other_site = [DetectionInfo(EventType.Motion, [1], now)]
+
+    pool.start()
+    try:
+        with use_site("site0"):
+            get_journal().add(backlog)
+            pool(backlog)
+        with use_site("site1"):
+            get_journal().add(other_site)
+            pool(other_site)
+        assert pool.wait(timeout=60), "Captures didn't finish"
+    finally:
+        pool.close()
+
+    assert pool.dead_letters == [], "Every capture should have run with its own site's config"
+    started = [call.args[1] for call in spy.call_args_list]
+    assert started.index(other_site[0]) <= 2, "The second site shouldn't have to wait for the first's backlog"
+
+    metrics = pool.metrics
+    assert (metrics["site0"].submitted, metrics["site0"].captured) == (4, 4)
+    assert (metrics["site1"].submitted, metrics["site1"].captured) == (1, 1)
+    try:
+        for site, events in (("site0", backlog), ("site1", other_site)):
+            with use_site(site):
+                entries = get_journal().history()
+                assert [(e.event, e.state) for e in entries] == [(e, EventState.Done) for e in events]
+    finally:
+        close_journal()
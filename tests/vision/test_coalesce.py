@@ -0,0 +1,91 @@
+import datetime
+
+import toml
+
+from security_notifier.config import Config
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+from security_notifier.vision.coalesce import EventCoalescer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+START = datetime.datetime(2022, 1, 15, 19, 30)
+
+
+def _at(seconds: int, type: EventType = EventType.Motion, cameras=(1,)) -> DetectionInfo:
+    return DetectionInfo(type, list(cameras), START + datetime.timedelta(seconds=seconds))
+
+
+def test_burst_is_merged():
+    clock = FakeClock()
+    coalescer = EventCoalescer(merge_gap=10, max_clip_length=60, clip_length=5, hold=10, clock=clock)
+    burst = [_at(0), _at(3, EventType.LineCrossing), _at(12, EventType.Intrusion)]
+
+    coalescer.add(burst[:2])
+    clock.now = 5
+    coalescer.add(burst[2:])
+    clock.now = 14
+    assert coalescer.pop_ready() == [], "Should wait `hold` after the last alert"
+
+    clock.now = 15
+    [merged] = coalescer.pop_ready()
+    assert merged.type == EventType.Misc
+    assert merged.date_and_time == burst[0].date_and_time
+    assert merged.duration == 17
+    assert merged.sources == burst
+    assert len(coalescer) == 0
+
+
+def test_separate_cameras_and_distant_events_not_merged():
+    clock = FakeClock()
+    coalescer = EventCoalescer(merge_gap=10, max_clip_length=60, clip_length=5, hold=10, clock=clock)
+    other_camera = _at(1, cameras=[2])
+    later = _at(30)
+
+    coalescer.add([_at(0), other_camera, later])
+    assert coalescer.pop_ready() == [_at(0)], "The first window closed as soon as a later alert didn't fit in it"
+    assert coalescer.next_due() == 10
+
+    clock.now = 10
+    assert coalescer.pop_ready() == [other_camera, later]
+    assert later.duration is None and later.sources == [], "Lone alerts should be passed through untouched"
+
+
+def test_max_clip_length():
+    coalescer = EventCoalescer(merge_gap=10, max_clip_length=20, clip_length=5, clock=FakeClock())
+    events = [_at(0), _at(10), _at(20)]
+    coalescer.add(events)
+
+    first, second = coalescer.flush()
+    assert first.sources == events[:2] and first.duration == 15
+    assert second == events[2]
+
+
+def test_lone_alert_is_not_held_by_default():
+    coalescer = EventCoalescer(merge_gap=10, max_clip_length=60, clip_length=5, clock=FakeClock())
+    burst = [_at(0), _at(3)]
+
+    coalescer.add(burst)
+    [merged] = coalescer.pop_ready()
+    assert merged.sources == burst, "Alerts that arrive together are still merged"
+
+    coalescer.add([_at(30)])
+    assert coalescer.pop_ready() == [_at(30)]
+    assert len(coalescer) == 0
+
+
+def test_hold_is_kept_inside_the_pre_roll_buffer(tmp_path, monkeypatch):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "stream_capture": {"merge_hold": 60},
+        "preroll": {"enabled": True, "seconds": 30, "pre_roll": 10},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+
+    assert EventCoalescer.from_config().hold == 10
@@ -0,0 +1,56 @@
+import tracemalloc
+
+import numpy as np
+
+from security_notifier.vision.compositor import FrameCompositor
+
+
+def _frame(value: int, width: int = 8, height: int = 6) -> np.ndarray:
+    return np.full((height, width, 3), value, dtype=np.uint8)
+
+
+def test_grid_layout():
+    compositor = FrameCompositor(3, (8, 6), columns=2)
+    assert compositor.size == (16, 12)
+
+    out = compositor.compose([_frame(1), _frame(2), _frame(3)])
+    assert (out[:6, :8] == 1).all()
+    assert (out[:6, 8:] == 2).all()
+    assert (out[6:, :8] == 3).all()
+    assert (out[6:, 8:] == 0).all(), "The unused slot should stay black"
+
+
+def test_default_is_one_row():
+    compositor = FrameCompositor.from_config([_frame(1), _frame(2)])
+    assert compositor.size == (16, 6)
+    assert (compositor.compose([_frame(1), _frame(2)])[:, 8:] == 2).all()
+
+
+def test_mismatched_resolutions_are_resized():
+    compositor = FrameCompositor(2, (8, 6))
+    out = compositor.compose([_frame(1), _frame(2, width=16, height=12)])
+    assert out.shape == (6, 16, 3)
+    assert (out[:, 8:] == 2).all()
+
+
+def test_single_camera_is_passed_through():
+    compositor = FrameCompositor(1, (8, 6))
+    frame = _frame(5)
+    assert compositor.compose([frame]) is frame
+
+
+def test_no_allocations_per_frame():
+    compositor = FrameCompositor(4, (64, 48), columns=2)
+    frames = [_frame(i, 64, 48) for i in range(3)] + [_frame(3, 128, 96)]
+    first = compositor.compose(frames)
+
+    tracemalloc.start()
+    try:
+        for _ in range(100):
+            assert compositor.compose(frames) is first
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # A single composite frame is 128 * 96 * 3 bytes; a fresh one per frame would go well over this.
+    assert peak < 8 * 1024
@@ -0,0 +1,145 @@
+import datetime
+import threading
+from pathlib import Path
+from typing import List
+
+import cv2
+import numpy as np
+import pytest
+import toml
+
+import security_notifier.vision.detector
+from security_notifier.config import Config
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+from security_notifier.vision import get_rtsp_capture
+from security_notifier.vision.detector import DetectionBatcher, DetectionWorker, ObjectDetector
+from tests.vision.stub_model import write_stub_model
+
+
+@pytest.fixture
+def stub_model(tmp_path: Path) -> Path:
+    return write_stub_model(tmp_path / "stub.onnx")
+
+
+def _frame(value: int) -> np.ndarray:
+    return np.full((48, 64, 3), value, dtype=np.uint8)
+
+
+def test_detect_batch(stub_model: Path):
+    detector = ObjectDetector(stub_model, input_size=(64, 64), confidence=0.9)
+    white, black = detector.detect([_frame(255), _frame(0)])
+
+    assert black == []
+    assert {d.label for d in white} == {"person"}
+    assert all(d.confidence == pytest.approx(1.0) for d in white)
+
+
+def test_class_filter(stub_model: Path):
+    detector = ObjectDetector(stub_model, input_size=(64, 64), confidence=0.9, classes=["car"])
+    assert detector.detect([_frame(255)]) == [[]]
+
+
+def test_yolov5_output(stub_model: Path):
+    detector = ObjectDetector(stub_model, input_size=(100, 100), confidence=0.5, output_format="yolov5",
+                              labels=["person", "car"])
+    # Two anchors: a car whose objectness is too low to count, and a confident person.
+    output = np.array([
+        [50, 50, 20, 20, 0.4, 0.1, 0.9],
+        [25, 25, 10, 10, 0.9, 0.9, 0.1],
+    ], dtype=np.float32)
+
+    [detection] = detector._parse(output, (200, 200, 3))
+    assert detection.label == "person"
+    assert detection.box == (40, 40, 20, 20), "Boxes should be scaled up to the frame"
+
+
+class CountingDetector:
+    def __init__(self):
+        self.batches: List[int] = []
+
+    def detect(self, frames):
+        self.batches.append(len(frames))
+        return [[] for _ in frames]
+
+
+def test_batcher_stride_and_batches():
+    detector = CountingDetector()
+    batcher = DetectionBatcher(detector, frame_stride=3, batch_size=4)
+    for _ in range(10):
+        batcher.add([_frame(0), _frame(0)])
+    assert batcher.finish() == {}
+
+    # Sets 1, 4, 7 and 10 are sampled, with a frame from each camera.
+    assert detector.batches == [4, 4]
+    assert batcher.frames_analysed == 8
+
+
+class BrokenDetector:
+    def detect(self, frames):
+        raise cv2.error("Model only takes a batch of 1")
+
+
+class BlockedDetector(CountingDetector):
+    def __init__(self):
+        super().__init__()
+        self.go = threading.Event()
+
+    def detect(self, frames):
+        self.go.wait()
+        return super().detect(frames)
+
+
+def test_worker_survives_detector_errors():
+    worker = DetectionWorker(DetectionBatcher(BrokenDetector(), frame_stride=1, batch_size=2))
+    for _ in range(5):
+        worker.add([_frame(0)])
+    assert worker.finish() is None
+    assert worker.failed
+
+
+def test_worker_drops_frames_rather_than_waiting():
+    detector = BlockedDetector()
+    worker = DetectionWorker(DetectionBatcher(detector, frame_stride=1, batch_size=1), max_pending=2)
+    # At most one set is with the detector, and two more fit in the queue. The rest can't wait.
+    for _ in range(10):
+        worker.add([_frame(0)])
+    detector.go.set()
+    assert worker.finish() == {}
+    assert worker.dropped >= 7
+    assert len(detector.batches) + worker.dropped == 10
+
+
+def _write_clip(tmp_path: Path, stub_model: Path, monkeypatch):
+    writer = cv2.VideoWriter(str(tmp_path / "cam1.avi"), cv2.VideoWriter_fourcc(*"MJPG"), 15, (64, 48))
+    for _ in range(30):
+        writer.write(_frame(255))
+    writer.release()
+
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "dvr": {"uri_template": str(tmp_path / "cam{camera}.avi")},
+        "stream_capture": {"fast_playback": True, "detection_clip_length": 1, "storage_location": str(tmp_path)},
+        "detector": {"model": str(stub_model), "input_size": [64, 64], "confidence": 0.9, "frame_stride": 4},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+
+
+def test_capture_reports_labels(tmp_path: Path, stub_model: Path, monkeypatch):
+    _write_clip(tmp_path, stub_model, monkeypatch)
+    # Load the detector afresh for this config, and put back whatever was there before afterwards.
+    monkeypatch.setattr(security_notifier.vision.detector, "_detector", None)
+    monkeypatch.setattr(security_notifier.vision.detector, "_detector_loaded", False)
+
+    result = get_rtsp_capture(DetectionInfo(EventType.Motion, [1], datetime.datetime(2022, 1, 15, 19, 30, 57)))
+    assert result
+    assert result.labels == ["person"]
+
+
+def test_capture_survives_detector_errors(tmp_path: Path, stub_model: Path, monkeypatch):
+    _write_clip(tmp_path, stub_model, monkeypatch)
+    monkeypatch.setattr(security_notifier.vision.detector, "_detector", BrokenDetector())
+    monkeypatch.setattr(security_notifier.vision.detector, "_detector_loaded", True)
+
+    result = get_rtsp_capture(DetectionInfo(EventType.Motion, [1], datetime.datetime(2022, 1, 15, 19, 30, 57)))
+    assert result, "The clip was written, so the capture shouldn't be retried"
+    assert result.labels is None
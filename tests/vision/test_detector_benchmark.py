@@ -0,0 +1,59 @@
+from typing import List
+
+import cv2
+import numpy as np
+import pytest
+
+from security_notifier.vision.detector import DetectionBatcher, ObjectDetector
+from tests.vision.stub_model import write_stub_model
+
+pytest.importorskip("pytest_benchmark")
+
+CLIP_FRAMES = 75
+
+
+@pytest.fixture(scope="module")
+def clip(tmp_path_factory) -> List[np.ndarray]:
+    """Five seconds of 640x360 at 15fps, with a square moving across it, read back from a file so the frames are
+    what a decoder would really hand us."""
+    path = tmp_path_factory.mktemp("clip") / "clip.avi"
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 15, (640, 360))
+    for i in range(CLIP_FRAMES):
+        frame = np.zeros((360, 640, 3), dtype=np.uint8)
+        cv2.rectangle(frame, (i * 8, 120), (i * 8 + 100, 240), (255, 255, 255), -1)
+        writer.write(frame)
+    writer.release()
+
+    capture = cv2.VideoCapture(str(path))
+    frames = []
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        frames.append(frame)
+    capture.release()
+    return frames
+
+
+@pytest.fixture(scope="module")
+def detector(tmp_path_factory) -> ObjectDetector:
+    # The stub's cost doesn't compare to a real model's, but the per-frame overheads (blob preparation, output parsing,
+    # NMS) and the batching around them are all real.
+    model = write_stub_model(tmp_path_factory.mktemp("model") / "stub.onnx")
+    return ObjectDetector(model, input_size=(320, 320), confidence=0.9)
+
+
+@pytest.mark.parametrize("batch_size", [1, 8])
+def test_detection_throughput(benchmark, clip: List[np.ndarray], detector: ObjectDetector, batch_size: int):
+    def detect_clip():
+        batcher = DetectionBatcher(detector, frame_stride=1, batch_size=batch_size)
+        for frame in clip:
+            batcher.add([frame])
+        return batcher.finish(), batcher.frames_analysed
+
+    labels, frames_analysed = benchmark(detect_clip)
+
+    assert frames_analysed == len(clip)
+    assert "person" in labels
+    if benchmark.stats is not None:
+        benchmark.extra_info["frames_per_second"] = len(clip) / benchmark.stats.stats.mean
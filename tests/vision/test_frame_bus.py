@@ -0,0 +1,179 @@
+import datetime
+import multiprocessing
+import os
+import signal
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+import toml
+
+from security_notifier.config import Config
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+import security_notifier.vision.frame_bus
+from security_notifier.vision import get_rtsp_capture
+from security_notifier.vision.capture_pool import CaptureWorkerPool
+from security_notifier.vision.frame_bus import FrameBus, FrameSubscriber, frame_bus_names, get_worker_bus
+
+SHAPE = (6, 8, 3)
+
+
+@pytest.fixture
+def bus() -> FrameBus:
+    bus = FrameBus.create(slots=4, frame_bytes=int(np.prod(SHAPE)))
+    yield bus
+    bus.close()
+    bus.unlink()
+
+
+def _frame(value: int) -> np.ndarray:
+    return np.full(SHAPE, value, dtype=np.uint8)
+
+
+def test_publish_and_read(bus: FrameBus):
+    subscriber = FrameSubscriber(bus)
+    bus.publish(_frame(7), camera_id=2, timestamp=12.5, event_key="20220115T193057_motion_2")
+
+    meta, frame = subscriber.next(timeout=1)
+    assert (meta.sequence, meta.camera_id, meta.timestamp, meta.event_key) == \
+           (0, 2, 12.5, "20220115T193057_motion_2")
+    assert frame.shape == SHAPE and (frame == 7).all()
+    assert subscriber.next(timeout=0.01) is None
+
+
+def test_reserve_writes_in_place(bus: FrameBus):
+    subscriber = FrameSubscriber(bus)
+    slot = bus.reserve(SHAPE)
+    slot[:] = 3
+    bus.commit(camera_id=1, timestamp=0)
+
+    meta, frame = subscriber.next(timeout=1)
+    assert np.shares_memory(frame, slot), "Readers should see the writer's buffer, not a copy"
+
+
+def test_slow_reader_skips_overwritten_frames(bus: FrameBus):
+    subscriber = FrameSubscriber(bus)
+    for i in range(7):
+        bus.publish(_frame(i), camera_id=1, timestamp=i)
+
+    meta, frame = subscriber.next(timeout=1, copy=True)
+    assert meta.sequence == 3 and (frame == 3).all()
+    assert subscriber.dropped == 3
+
+    meta, _ = subscriber.next(timeout=1)
+    bus.publish(_frame(7), camera_id=1, timestamp=7)
+    for i in range(4):
+        bus.publish(_frame(8 + i), camera_id=1, timestamp=8 + i)
+    assert not bus.is_current(meta), "The writer has lapped the frame we were looking at"
+
+
+def test_frame_too_big(bus: FrameBus):
+    with pytest.raises(ValueError):
+        bus.publish(np.zeros((100, 100, 3), dtype=np.uint8), camera_id=1, timestamp=0)
+
+
+def _publish_frames(name: str, count: int):
+    bus = FrameBus.attach(name)
+    for i in range(count):
+        bus.publish(_frame(i), camera_id=1, timestamp=i)
+    bus.mark_closed()
+    bus.close()
+
+
+def test_frames_cross_processes(bus: FrameBus):
+    subscriber = FrameSubscriber(bus)
+    process = multiprocessing.get_context("spawn").Process(target=_publish_frames, args=(bus.name, 3))
+    process.start()
+
+    received = []
+    item = subscriber.next(timeout=30)
+    while item is not None:
+        received.append(int(item[1][0, 0, 0]))
+        item = subscriber.next(timeout=30)
+    process.join()
+
+    assert received == [0, 1, 2]
+
+
+def publishing_handler(event: DetectionInfo) -> bool:
+    get_worker_bus().publish(_frame(event.camera_ids[0]), event.camera_ids[0], 0, event.key)
+    return True
+
+
+def _frame_bus_config(tmp_path: Path, monkeypatch):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "frame_bus": {"enabled": True, "slots": 4, "max_frame_bytes": 1024, "name": f"sn_test_{os.getpid()}"},
+        "stream_capture": {"max_capture_processes": 1},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+
+
+def _publish_through(pool: CaptureWorkerPool, camera_id: int):
+    """Capture an event, and return the frame a reader that found the bus by name got from it."""
+    [name] = frame_bus_names()
+    reader = FrameBus.attach(name)
+    try:
+        subscriber = FrameSubscriber(reader)
+        event = DetectionInfo(EventType.Motion, [camera_id], datetime.datetime(2022, 1, 15, 19, 30, 57))
+        pool([event])
+        assert pool.wait(timeout=60)
+        meta, frame = subscriber.next(timeout=5, copy=True)
+    finally:
+        reader.close()
+
+    assert meta.event_key == event.key and meta.camera_id == camera_id
+    assert (frame == camera_id).all()
+
+
+def test_pool_workers_publish(tmp_path: Path, monkeypatch):
+    _frame_bus_config(tmp_path, monkeypatch)
+    pool = CaptureWorkerPool(publishing_handler, use_journal=False, coalesce=False)
+    pool.start()
+    try:
+        assert pool.frame_buses == frame_bus_names()
+        _publish_through(pool, 5)
+    finally:
+        pool.close()
+
+    assert pool.frame_buses == []
+
+
+def test_replacement_worker_gets_a_bus(tmp_path: Path, monkeypatch):
+    _frame_bus_config(tmp_path, monkeypatch)
+    pool = CaptureWorkerPool(publishing_handler, use_journal=False, coalesce=False)
+    pool.start()
+    try:
+        [worker] = pool._pool._pool
+        os.kill(worker.pid, signal.SIGKILL)
+        deadline = time.monotonic() + 10
+        while pool._pool._pool == [worker] and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        _publish_through(pool, 6)
+    finally:
+        pool.close()
+
+
+def test_oversized_frames_arent_published(tmp_path: Path, monkeypatch):
+    writer = cv2.VideoWriter(str(tmp_path / "cam1.avi"), cv2.VideoWriter_fourcc(*"MJPG"), 15, (64, 48))
+    for _ in range(15):
+        writer.write(np.zeros((48, 64, 3), dtype=np.uint8))
+    writer.release()
+
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "dvr": {"uri_template": str(tmp_path / "cam{camera}.avi")},
+        "stream_capture": {"fast_playback": True, "detection_clip_length": 1, "storage_location": str(tmp_path)},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    small_bus = FrameBus.create(slots=4, frame_bytes=int(np.prod(SHAPE)))
+    monkeypatch.setattr(security_notifier.vision.frame_bus, "_worker_bus", small_bus)
+    try:
+        assert get_rtsp_capture(DetectionInfo(EventType.Motion, [1], datetime.datetime(2022, 1, 15, 19, 30, 57)))
+        assert small_bus.write_seq == 0
+    finally:
+        small_bus.close()
+        small_bus.unlink()
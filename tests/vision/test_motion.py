@@ -0,0 +1,98 @@
+import datetime
+from pathlib import Path
+from typing import List
+
+import cv2
+import numpy as np
+import pytest
+import toml
+
+import security_notifier.vision
+from security_notifier.config import Config
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+from security_notifier.vision import get_rtsp_capture
+from security_notifier.vision.motion import MotionGate
+
+FPS = 15
+
+
+def _static_frames(count: int) -> List[np.ndarray]:
+    rng = np.random.default_rng(1)
+    background = rng.integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    # A little noise on every frame, which the gate should see through.
+    return [np.clip(background + rng.integers(-3, 4, background.shape), 0, 255).astype(np.uint8)
+            for _ in range(count)]
+
+
+def _moving_frames(count: int, moving: range) -> List[np.ndarray]:
+    frames = _static_frames(count)
+    for i in moving:
+        cv2.rectangle(frames[i], (i * 4, 40), (i * 4 + 30, 80), (255, 255, 255), -1)
+    return frames
+
+
+def test_static_frames_skipped():
+    gate = MotionGate(hold_frames=3)
+    assert not any(gate.keep([frame]) for frame in _static_frames(20))
+    assert not gate.motion
+    assert gate.peak_score < gate.threshold
+
+
+def test_motion_kept_with_hold():
+    gate = MotionGate(hold_frames=3)
+    kept = [gate.keep([frame]) for frame in _moving_frames(30, range(10, 15))]
+
+    # The square appears at frame 10 and is gone after 14 (which is itself a change), then 3 more frames are held.
+    assert kept == [False] * 10 + [True] * 9 + [False] * 11
+    assert gate.motion
+    assert (gate.frames_seen, gate.frames_kept) == (30, 9)
+
+
+def test_busiest_camera_counts():
+    gate = MotionGate(hold_frames=0)
+    static, moving = _static_frames(10), _moving_frames(10, range(5, 6))
+    kept = [gate.keep([s, m]) for s, m in zip(static, moving)]
+    assert kept[5] and kept[6]
+    assert sum(kept) == 2
+
+
+@pytest.fixture
+def motion_config(tmp_path: Path, monkeypatch) -> Path:
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "dvr": {"uri_template": str(tmp_path / "cam{camera}.avi"), "camera_fps": FPS},
+        "stream_capture": {"fast_playback": True, "detection_clip_length": 2, "storage_location": str(tmp_path)},
+        "motion_gate": {"enabled": True, "hold_seconds": 0.5},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    return tmp_path
+
+
+def _write_clip(path: Path, frames: List[np.ndarray]):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), FPS, (160, 120))
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+
+
+def test_capture_without_motion_is_discarded(motion_config: Path, mocker):
+    _write_clip(motion_config / "cam1.avi", _static_frames(2 * FPS))
+    create_writer = mocker.patch.object(security_notifier.vision, "create_writer")
+
+    result = get_rtsp_capture(DetectionInfo(EventType.Motion, [1], datetime.datetime(2022, 1, 15, 19, 30, 57)))
+    assert result
+    assert result.motion_score < 0.01
+    create_writer.assert_not_called()
+
+
+def test_capture_writes_only_motion(motion_config: Path, mocker):
+    _write_clip(motion_config / "cam1.avi", _moving_frames(2 * FPS, range(10, 15)))
+    create_writer = mocker.patch.object(security_notifier.vision, "create_writer")
+    written = mocker.patch.object(security_notifier.vision, "write_all_frames")
+
+    result = get_rtsp_capture(DetectionInfo(EventType.Motion, [1], datetime.datetime(2022, 1, 15, 19, 30, 57)))
+    assert result
+    assert result.motion_score > 0.01
+    create_writer.assert_called_once()
+    # The five frames with the square in, the one after it's gone, then half a second's hold.
+    assert written.call_count == 6 + round(0.5 * FPS)
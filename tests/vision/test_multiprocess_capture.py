@@ -7,6 +7,7 @@ from security_notifier.imap.detection_info import (
     DetectionInfo
 )
 from security_notifier.vision import multi_process_capture
+from security_notifier.vision.retry import RetryPolicy
 
 handled_failures = []
 
@@ -21,6 +22,7 @@ def mock_handler(event: DetectionInfo, camera_idx: Optional[int] = None):
 
 def test_failure_retries(mocker):
     spy = mocker.spy(security_notifier.vision, "_run_retry_loop")
+    mocker.patch.object(RetryPolicy, "from_config", return_value=RetryPolicy(base_delay=0.01, breaker_cooldown=0.01))
 
     mock_events = [
         DetectionInfo(EventType.Motion, [0], datetime.datetime.now()),
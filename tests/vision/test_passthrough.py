@@ -0,0 +1,96 @@
+import datetime
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+import toml
+
+from security_notifier.config import Config
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+from security_notifier.vision import get_rtsp_capture
+from security_notifier.vision.passthrough import copy_stream, open_passthrough_capture, open_passthrough_writer
+from security_notifier.vision.utils import event_to_filename
+
+FPS = 30
+
+
+def _count_frames(path: Path) -> int:
+    capture = cv2.VideoCapture(str(path))
+    frames = 0
+    while capture.read()[0]:
+        frames += 1
+    capture.release()
+    return frames
+
+
+@pytest.fixture
+def recording(tmp_path: Path, monkeypatch) -> Path:
+    path = tmp_path / "cam1.avi"
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), FPS, (64, 48))
+    for i in range(4 * FPS):
+        writer.write(np.full((48, 64, 3), i, dtype=np.uint8))
+    writer.release()
+
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "dvr": {"uri_template": str(tmp_path / "cam{camera}.avi")},
+        "stream_capture": {"fast_playback": True, "detection_clip_length": 2, "storage_location": str(tmp_path)},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    return path
+
+
+def test_copy_stream(recording: Path, tmp_path: Path):
+    capture = open_passthrough_capture(str(recording))
+    writer = open_passthrough_writer(capture, tmp_path / "out.mkv", FPS)
+    assert writer is not None
+    try:
+        stats = copy_stream(capture, writer, time.time() + 30, stream_length=2)
+    finally:
+        writer.release()
+        capture.release()
+
+    assert stats.packets_written == 2 * FPS
+    assert _count_frames(tmp_path / "out.mkv") == 2 * FPS
+
+
+def test_single_camera_capture_is_copied(recording: Path):
+    event = DetectionInfo(EventType.Motion, [1], datetime.datetime(2022, 1, 15, 19, 30, 57))
+    assert get_rtsp_capture(event)
+    assert _count_frames(event_to_filename(event, None)) == 2 * FPS
+
+
+class FakePacketCapture:
+    def __init__(self, keyframes):
+        self.keyframes = keyframes
+        self.index = -1
+
+    def read(self):
+        self.index += 1
+        if self.index == len(self.keyframes):
+            return False, None
+        return True, np.array([[self.index]], dtype=np.uint8)
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_LRF_HAS_KEY_FRAME:
+            return float(self.keyframes[self.index])
+        return self.index * 1000 / FPS
+
+
+class FakeWriter:
+    def __init__(self):
+        self.packets = []
+
+    def write(self, packet):
+        self.packets.append(int(packet[0, 0]))
+
+
+def test_copying_starts_at_first_keyframe():
+    writer = FakeWriter()
+    stats = copy_stream(FakePacketCapture([False, False, True, False, True, False]), writer, time.time() + 30,
+                        stream_length=10)
+
+    assert writer.packets == [2, 3, 4, 5]
+    assert stats.packets_skipped == 2
@@ -0,0 +1,239 @@
+import datetime
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+import toml
+
+from security_notifier.config import Config
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+from security_notifier.vision import capture_pool, preroll
+from security_notifier.vision.capture_pool import CaptureWorkerPool
+from security_notifier.vision.passthrough import StreamFormat, open_passthrough_capture, open_raw_writer
+from security_notifier.vision.preroll import LiveBuffer, LiveRecorder, Packet, PacketRing
+from security_notifier.vision.utils import CaptureResult, event_to_filename
+
+FPS = 30
+
+
+def _packet(timestamp: float, keyframe: bool, size: int = 10) -> Packet:
+    return Packet(np.zeros(size, dtype=np.uint8), timestamp, keyframe)
+
+
+def test_ring_starts_at_a_keyframe():
+    ring = PacketRing(max_seconds=10, max_bytes=1000)
+    ring.append(_packet(0, False))
+    assert len(ring) == 0, "Packets before the first keyframe can't be decoded"
+
+    ring.append(_packet(1, True))
+    ring.append(_packet(2, False))
+    assert len(ring) == 2
+    assert ring.oldest == 1 and ring.newest == 2
+
+
+def test_ring_drops_whole_gops():
+    ring = PacketRing(max_seconds=3, max_bytes=1000)
+    # A keyframe every 2 seconds.
+    for t in range(8):
+        ring.append(_packet(t, t % 2 == 0))
+
+    # 4 is the oldest packet within 3 seconds of 7 that starts a GOP.
+    assert ring.oldest == 4
+    assert ring.nbytes == 40
+
+
+def test_ring_respects_max_bytes():
+    ring = PacketRing(max_seconds=100, max_bytes=35)
+    for t in range(8):
+        ring.append(_packet(t, t % 2 == 0))
+    assert ring.nbytes <= 35
+    assert ring.oldest == 6
+
+
+def test_between_starts_at_the_keyframe_before_start():
+    ring = PacketRing(max_seconds=100, max_bytes=1000)
+    for t in range(10):
+        ring.append(_packet(t, t % 3 == 0))
+
+    assert [p.timestamp for p in ring.between(4.5, 7)] == [3, 4, 5, 6, 7]
+    # The ring doesn't go back as far as asked, so we get what there is.
+    assert [p.timestamp for p in ring.between(-5, 1)] == [0, 1]
+
+
+@pytest.fixture
+def live_feed(tmp_path: Path, monkeypatch) -> Path:
+    path = tmp_path / "live1.avi"
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), FPS, (64, 48))
+    for i in range(4 * FPS):
+        writer.write(np.full((48, 64, 3), i, dtype=np.uint8))
+    writer.release()
+
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({
+        "stream_capture": {"detection_clip_length": 2, "storage_location": str(tmp_path)},
+        "preroll": {"enabled": True, "cameras": [1], "uri_template": str(tmp_path / "live{camera}.avi")},
+    }))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+    return path
+
+
+def _fill(recorder: LiveRecorder, start: float):
+    """Read the whole of the recorder's feed into its ring, as if it had arrived at `FPS` from `start`."""
+    capture = open_passthrough_capture(recorder.uri)
+    try:
+        recorder.stream_format = StreamFormat.of(capture, FPS)
+        recorder._read(capture)
+    finally:
+        capture.release()
+
+    packets = list(recorder.ring._packets)
+    recorder.ring.clear()
+    for i, packet in enumerate(packets):
+        packet.timestamp = start + i / FPS
+        recorder.ring.append(packet)
+    recorder.connected = True
+
+
+def test_from_config(live_feed: Path):
+    live = LiveBuffer.from_config()
+    assert list(live.recorders) == [1]
+    assert live.recorders[1].uri == str(live_feed)
+
+
+def test_live_capture_writes_pre_roll(live_feed: Path):
+    live = LiveBuffer.from_config()
+    live.pre_roll = 1
+    # A whole second, so the clip's ends land exactly on packets.
+    start = float(int(time.time()) - 10)
+    _fill(live.recorders[1], start)
+
+    event = DetectionInfo(EventType.Motion, [1], datetime.datetime.fromtimestamp(start + 1))
+    assert live.capture(event)
+
+    # From a second before the event to the end of its 2s clip.
+    capture = cv2.VideoCapture(str(event_to_filename(event, None)))
+    frames = 0
+    while capture.read()[0]:
+        frames += 1
+    capture.release()
+    assert frames == 3 * FPS + 1
+
+
+def test_live_capture_falls_back_when_not_buffered(live_feed: Path):
+    live = LiveBuffer.from_config()
+    _fill(live.recorders[1], time.time() - 10)
+
+    too_old = DetectionInfo(EventType.Motion, [1], datetime.datetime.fromtimestamp(time.time() - 60))
+    assert not live.capture(too_old)
+
+    live.recorders[1].connected = False
+    assert not live.covers(DetectionInfo(EventType.Motion, [1], datetime.datetime.now()))
+
+
+def test_live_capture_falls_back_when_pre_roll_is_gone(live_feed: Path):
+    live = LiveBuffer.from_config()
+    live.pre_roll = 5
+    live.timeout = 0
+    start = time.time() - 10
+    _fill(live.recorders[1], start)
+
+    # The clip itself is buffered, but the ring only goes back half of the pre-roll.
+    event = DetectionInfo(EventType.Motion, [1], datetime.datetime.fromtimestamp(start + 2.5))
+    assert not live.capture(event)
+    assert not event_to_filename(event, None).exists()
+
+
+def test_live_capture_cleans_up_when_a_writer_fails(live_feed: Path, monkeypatch):
+    live = LiveBuffer.from_config()
+    live.recorders[2] = LiveRecorder(2, str(live_feed), 30, 1024 * 1024)
+    live.pre_roll = 1
+    start = float(int(time.time()) - 10)
+    for recorder in live.recorders.values():
+        _fill(recorder, start)
+
+    opened = []
+
+    def open_first_only(output_path, stream_format):
+        opened.append(output_path)
+        return open_raw_writer(output_path, stream_format) if len(opened) == 1 else None
+
+    monkeypatch.setattr(preroll, "open_raw_writer", open_first_only)
+    event = DetectionInfo(EventType.Motion, [1, 2], datetime.datetime.fromtimestamp(start + 1))
+    assert not live.capture(event)
+    assert len(opened) == 2
+    assert not any(path.exists() for path in opened), "The first camera's file shouldn't be left behind"
+
+
+def test_recorder_reads_the_feed(live_feed: Path):
+    recorder = LiveRecorder(1, str(live_feed), max_seconds=30, max_bytes=1024 * 1024, reconnect_delay=60)
+    recorder.start()
+    try:
+        deadline = time.monotonic() + 10
+        while recorder.stream_format is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        recorder.stop()
+
+    assert recorder.stream_format.size == (64, 48)
+    assert not recorder.connected, "The feed ran out, so the recorder should be waiting to reconnect"
+
+
+class FakeLiveBuffer:
+    """Has camera 0 buffered, and captures everything on it."""
+    recorders = {0: None}
+
+    def __init__(self, success: bool):
+        self.success = success
+        self.captured = []
+        self.stopped = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.stopped = True
+
+    def covers(self, event: DetectionInfo) -> bool:
+        return event.camera_ids == [0]
+
+    def capture(self, event: DetectionInfo) -> CaptureResult:
+        self.captured.append(event)
+        return CaptureResult(self.success)
+
+
+def succeeds(event: DetectionInfo) -> bool:
+    return True
+
+
+@pytest.mark.parametrize("live_succeeds", [True, False])
+def test_pool_captures_from_live_buffer(monkeypatch, mocker, live_succeeds: bool):
+    live = FakeLiveBuffer(live_succeeds)
+    monkeypatch.setattr(capture_pool.LiveBuffer, "from_config", staticmethod(lambda: live))
+
+    pool = CaptureWorkerPool(succeeds, processes=1, coalesce=False, use_journal=False)
+    spy = mocker.spy(pool, "_on_result")
+    events = [
+        DetectionInfo(EventType.Motion, [0], datetime.datetime.now()),
+        DetectionInfo(EventType.Motion, [1], datetime.datetime.now()),
+    ]
+
+    pool.start()
+    try:
+        pool(events)
+        assert pool.wait(timeout=60), "Captures didn't finish"
+        metrics = pool.metrics[None]
+    finally:
+        pool.close()
+
+    assert live.captured == events[:1]
+    assert live.stopped
+    assert metrics.captured == 2
+    if live_succeeds:
+        assert metrics.live == 1
+        assert [call.args[1] for call in spy.call_args_list] == events[1:]
+    else:
+        assert metrics.live == 0
+        assert sorted(call.args[1].camera_ids[0] for call in spy.call_args_list) == [0, 1], \
+            "The event the buffer couldn't serve should have been captured from the recordings"
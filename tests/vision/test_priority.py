@@ -0,0 +1,74 @@
+import datetime
+from pathlib import Path
+
+import toml
+
+from security_notifier.config import Config
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+from security_notifier.vision.priority import CapturePriority, CaptureQueue
+
+NOW = datetime.datetime(2022, 1, 15, 19, 30)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _event(type: EventType, camera: int = 1) -> DetectionInfo:
+    return DetectionInfo(type, [camera], NOW)
+
+
+def _drain(queue: CaptureQueue):
+    return [queue.pop() for _ in range(len(queue))]
+
+
+def test_higher_weight_first_and_ties_in_order():
+    queue = CaptureQueue(CapturePriority(camera_weights={3: 2.0}), clock=FakeClock())
+    events = [_event(EventType.Motion, 1), _event(EventType.Motion, 2), _event(EventType.Intrusion),
+              _event(EventType.LineCrossing), _event(EventType.Motion, 3)]
+    for e in events:
+        queue.push(e)
+
+    assert _drain(queue) == [events[2], events[3], events[4], events[0], events[1]]
+
+
+def test_waiting_events_age():
+    clock = FakeClock()
+    queue = CaptureQueue(CapturePriority(aging=1.0), clock=clock)
+    motion, intrusion = _event(EventType.Motion), _event(EventType.Intrusion)
+
+    queue.push(motion)
+    clock.now = 8 * 60
+    queue.push(intrusion)
+    assert queue.peek() == intrusion, "8 minutes of aging isn't enough to close a gap of 9"
+
+    queue.pop()
+    clock.now = 10 * 60
+    queue.push(intrusion)
+    assert _drain(queue) == [motion, intrusion], "After 10 minutes the motion event has caught up"
+
+
+def test_merged_event_counts_as_its_most_important_alert():
+    priority = CapturePriority()
+    merged = DetectionInfo(EventType.Misc, [1], NOW, duration=10,
+                           sources=[_event(EventType.Motion), _event(EventType.Intrusion)])
+    assert priority.weight(merged) == priority.weight(_event(EventType.Intrusion))
+
+
+def test_from_config(tmp_path: Path, monkeypatch):
+    cfg_file = tmp_path / "config.toml"
+    cfg_file.write_text(toml.dumps({"capture_priority": {
+        "aging": 0.5,
+        "event_types": {"Motion": 3},
+        "cameras": {"2": 4},
+    }}))
+    monkeypatch.setattr(Config, "DEFAULT_CONFIG_PATH", cfg_file)
+
+    priority = CapturePriority.from_config()
+    assert priority.aging == 0.5
+    assert priority.weight(_event(EventType.Motion, 2)) == 7
+    assert priority.weight(_event(EventType.Intrusion)) == 10
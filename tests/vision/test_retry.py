@@ -0,0 +1,83 @@
+import datetime
+import random
+
+import pytest
+
+from security_notifier.imap.detection_info import DetectionInfo, EventType
+from security_notifier.vision.retry import RetryPolicy, RetryScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+def _event(camera: int, second: int = 0) -> DetectionInfo:
+    return DetectionInfo(EventType.Motion, [camera], datetime.datetime(2022, 1, 15, 19, 30, second))
+
+
+def test_backoff_grows_and_is_capped():
+    policy = RetryPolicy(base_delay=2, max_delay=10, jitter=0)
+    rng = random.Random(0)
+    assert [policy.delay(a, rng) for a in range(1, 6)] == [2, 4, 8, 10, 10]
+
+    policy = RetryPolicy(base_delay=4, jitter=0.25)
+    assert all(3 <= policy.delay(1, rng) <= 5 for _ in range(100))
+
+
+def test_failure_schedules_retry(clock):
+    retries = RetryScheduler(RetryPolicy(base_delay=5, jitter=0, breaker_threshold=10), clock)
+    event = _event(1)
+
+    assert retries.record_failure(event) == 1005
+    assert retries.pop_due() == [], "Shouldn't retry before the backoff has passed"
+
+    clock.now = 1005
+    assert retries.pop_due() == [event]
+    assert len(retries) == 0
+
+    assert retries.record_failure(event) == 1015, "Second failure should back off for longer"
+
+
+def test_dead_letter_after_max_attempts(clock):
+    retries = RetryScheduler(RetryPolicy(base_delay=1, jitter=0, max_attempts=3, breaker_threshold=10), clock)
+    event = _event(1)
+
+    for _ in range(2):
+        assert retries.record_failure(event) is not None
+        clock.now += 100
+        assert retries.pop_due() == [event]
+
+    assert retries.record_failure(event) is None
+    assert retries.dead_letters == [event]
+    assert len(retries) == 0
+
+
+def test_circuit_breaker_holds_camera_back(clock):
+    policy = RetryPolicy(base_delay=1, jitter=0, breaker_threshold=2, breaker_cooldown=60)
+    retries = RetryScheduler(policy, clock)
+    first, second, other = _event(1, 0), _event(1, 1), _event(2, 0)
+
+    retries.record_failure(first)
+    assert retries.blocked_until([1]) is None
+    retries.record_failure(second)
+    assert retries.blocked_until([1]) == 1060
+    retries.record_failure(other)
+
+    clock.now += 5
+    assert retries.pop_due() == [other], "Other cameras should be unaffected"
+    assert len(retries) == 2
+
+    clock.now = 1060
+    assert {e.key for e in retries.pop_due()} == {first.key, second.key}
+
+    retries.record_success(first)
+    assert retries.blocked_until([1]) is None